@@ -0,0 +1,155 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), os.pardir, "transformer")
+)
+
+from architecture.models import Transformer  # noqa: E402
+from architecture.sampling import get_token_sampler  # noqa: E402
+from architecture.speculative import speculative_generate  # noqa: E402
+
+VOCAB_SIZE = 64
+BLOCK_SIZE = 16
+
+
+def build_model(num__decoder_layers: int = 2) -> Transformer:
+    """
+    Build a small, randomly initialized transformer with extra heads.
+
+    Args:
+        num__decoder_layers: Number of decoder blocks.
+
+    Returns:
+        Transformer in evaluation mode.
+    """
+    model = Transformer(
+        num__decoder_layers=num__decoder_layers,
+        embedding_dim=16,
+        num_heads=4,
+        vocab_size=VOCAB_SIZE,
+        dim_feedfwd=32,
+        # such that rolling caches are re-encoded (cf. `generate`)
+        max__seq_length=4 * BLOCK_SIZE,
+        num__extra_heads=3,
+    )
+    # the extra heads are initialized to zero, i.e. they would draft the
+    # next token again
+    for head in model.extra_heads:
+        torch.nn.init.normal_(head.linear.weight, std=0.1)
+
+    return model.eval()
+
+
+@pytest.mark.parametrize(
+    "mode", ["draft_model", "prompt_lookup", "extra_heads"]
+)
+@pytest.mark.parametrize("rolling_kv_cache", [False, True])
+@pytest.mark.parametrize("seed", range(8))
+def test_greedy_matches_generate(
+    mode: str, rolling_kv_cache: bool, seed: int
+) -> None:
+    """
+    Greedy speculative decoding yields the greedy output of the target model,
+    also when the context exceeds the block size (and with rolling caches,
+    when they are re-encoded).
+    """
+    torch.manual_seed(seed)
+    model = build_model()
+    x = torch.randint(0, VOCAB_SIZE, (1, 12))
+
+    expected = model.generate(
+        x,
+        max_new_tokens=4 * BLOCK_SIZE,
+        block_size=BLOCK_SIZE,
+        sampler=get_token_sampler(
+            vocab_size=VOCAB_SIZE, device=x.device, top_k=1
+        ),
+        rolling_kv_cache=rolling_kv_cache,
+        num_sink_tokens=2,
+    )
+    output, stats = speculative_generate(
+        model,
+        x,
+        max_new_tokens=4 * BLOCK_SIZE,
+        block_size=BLOCK_SIZE,
+        draft_model=build_model(1) if mode == "draft_model" else None,
+        sampler=get_token_sampler(
+            vocab_size=VOCAB_SIZE, device=x.device, top_k=1
+        ),
+        num_draft_tokens=4,
+        use_extra_heads=mode == "extra_heads",
+        rolling_kv_cache=rolling_kv_cache,
+        num_sink_tokens=2,
+    )
+
+    assert torch.equal(output, expected)
+    assert stats["num_new_tokens"] == 4 * BLOCK_SIZE
+
+
+@pytest.mark.parametrize(
+    "mode", ["draft_model", "prompt_lookup", "extra_heads"]
+)
+def test_drafting_beyond_block_size(mode: str) -> None:
+    """
+    Beyond the block size, tokens are drafted (and verified incrementally)
+    only with rolling caches.
+    """
+    torch.manual_seed(0)
+    model = build_model()
+    x = torch.randint(0, VOCAB_SIZE, (1, BLOCK_SIZE))
+
+    num_draft_tokens = {}
+    for rolling_kv_cache in [False, True]:
+        _, stats = speculative_generate(
+            model,
+            x,
+            max_new_tokens=2 * BLOCK_SIZE,
+            block_size=BLOCK_SIZE,
+            draft_model=build_model(1) if mode == "draft_model" else None,
+            num_draft_tokens=4,
+            use_extra_heads=mode == "extra_heads",
+            rolling_kv_cache=rolling_kv_cache,
+        )
+        num_draft_tokens[rolling_kv_cache] = stats["num_draft_tokens"]
+
+    assert num_draft_tokens[False] == 0
+    assert num_draft_tokens[True] > 0
+
+
+def test_per_row_sampling_parameters() -> None:
+    """
+    Sampling parameters given per row are rejected unless they are sliced to
+    the decoded prompt, after which greedy decoding matches `generate`.
+    """
+    torch.manual_seed(0)
+    model = build_model()
+    x = torch.randint(0, VOCAB_SIZE, (1, 12))
+    sampler = get_token_sampler(
+        vocab_size=VOCAB_SIZE,
+        device=x.device,
+        temperature=torch.tensor([1.0, 0.5]),
+        top_k=torch.tensor([VOCAB_SIZE, 1]),
+    )
+
+    with pytest.raises(AssertionError):
+        speculative_generate(
+            model, x, max_new_tokens=8, block_size=BLOCK_SIZE, sampler=sampler
+        )
+
+    sampler.reorder(torch.tensor([1]))
+    output, _ = speculative_generate(
+        model, x, max_new_tokens=8, block_size=BLOCK_SIZE, sampler=sampler
+    )
+    expected = model.generate(
+        x,
+        max_new_tokens=8,
+        block_size=BLOCK_SIZE,
+        sampler=get_token_sampler(
+            vocab_size=VOCAB_SIZE, device=x.device, top_k=1
+        ),
+    )
+    assert torch.equal(output, expected)
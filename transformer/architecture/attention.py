@@ -3,35 +3,172 @@ from typing import Optional, Tuple
 
 import torch
 from torch import nn
-from torch.nn.functional import softmax
+from torch.nn.functional import scaled_dot_product_attention, softmax
 from torch.nn.init import xavier_uniform_
 
+# "naive": materialize attention logits and weights (always returned),
+# "sdpa": fused `torch.nn.functional.scaled_dot_product_attention` (weights
+# are never materialized), "auto": "sdpa" unless weights are requested
+ATTN_BACKENDS = ("naive", "sdpa", "auto")
 
-def get_subsequent_mask(size: int, rank: int | torch.device) -> torch.Tensor:
+
+def get_subsequent_mask(
+    size: int, rank: int | torch.device, offset: int = 0
+) -> torch.Tensor:
     """
     Define mask to prevent the decoder from attending to subsequent tokens,
     also cf. https://peterbloem.nl/blog/transformers.
 
     Args:
-        size: Size of the square mask.
+        size: Number of queries (rows of the mask).
         rank: Device.
+        offset: Number of preceding (cached) keys that every query may
+            attend to. For `offset = 0`, the mask is square.
 
     Returns:
-        Subsequent mask, shape: `(size, size)`.
+        Subsequent mask, shape: `(size, offset + size)`.
     """
 
     mask = torch.tril(
         torch.ones(
             size,
-            size,
+            offset + size,
             device=rank,
         ),
-        diagonal=0,
+        diagonal=offset,
     )
 
     return mask
 
 
+def get_padding_mask(padding_mask: torch.Tensor, size: int) -> torch.Tensor:
+    """
+    Combine the subsequent mask with a padding mask, such that queries attend
+    neither to subsequent tokens nor to padding tokens. Padding queries
+    attend to themselves only, since a query without any key would lead to
+    NaNs.
+
+    Args:
+        padding_mask: Mask of all keys (including cached ones) in shape
+            `(N, seq_length')`, which is `1` for tokens and `0` for padding.
+        size: Number of queries, which are the last `size` keys.
+
+    Returns:
+        Boolean mask in shape `(N, size, seq_length')`.
+    """
+    S_kv = padding_mask.shape[-1]
+    mask = get_subsequent_mask(
+        size=size, rank=padding_mask.device, offset=S_kv - size
+    ).bool()
+    mask = mask & padding_mask.bool().unsqueeze(1)
+
+    # position of each query among the keys
+    query_idx = torch.arange(S_kv - size, S_kv, device=padding_mask.device)
+    key_idx = torch.arange(S_kv, device=padding_mask.device)
+
+    return mask | (query_idx.unsqueeze(1) == key_idx)
+
+
+def get_cache_mask(
+    padding_mask: torch.Tensor, cache_position: torch.Tensor
+) -> torch.Tensor:
+    """
+    Mask for queries at given positions of a preallocated (static) cache:
+    queries attend neither to subsequent (or not yet written) slots nor to
+    padding. Padding queries attend to themselves only.
+
+    Args:
+        padding_mask: Mask of all slots of the cache in shape
+            `(N, max_length)`, which is `1` for tokens and `0` for padding.
+        cache_position: Slots of the queries in shape `(seq_length,)`.
+
+    Returns:
+        Boolean mask in shape `(N, seq_length, max_length)`.
+    """
+    key_idx = torch.arange(padding_mask.shape[-1], device=padding_mask.device)
+    mask = key_idx <= cache_position.unsqueeze(-1)
+    mask = mask & padding_mask.bool().unsqueeze(1)
+
+    return mask | (key_idx == cache_position.unsqueeze(-1))
+
+
+def get_rolling_cache_position(
+    num_tokens: torch.Tensor, max_length: int, num_sink_tokens: int
+) -> torch.Tensor:
+    """
+    Slots of the next tokens in rolling caches (cf. `RollingKVCache`): the
+    caches are filled in order, after which the oldest token outside of the
+    first `num_sink_tokens` slots is overwritten.
+
+    Args:
+        num_tokens: Number of tokens written to the caches so far per row in
+            shape `(N,)`.
+        max_length: Number of slots per cache.
+        num_sink_tokens: Number of pinned slots.
+
+    Returns:
+        Slot of the next token of each row in shape `(N,)`.
+    """
+    ring_idx = num_sink_tokens + (num_tokens - num_sink_tokens) % (
+        max_length - num_sink_tokens
+    )
+
+    return torch.where(num_tokens < max_length, num_tokens, ring_idx)
+
+
+def get_rolling_mask(
+    num_tokens: torch.Tensor, max_length: int
+) -> torch.Tensor:
+    """
+    Mask for the next token of each row in rolling caches: it attends to all
+    slots written so far (in any order, since keys carry their positions)
+    and to its own slot.
+
+    Args:
+        num_tokens: Number of tokens written to the caches so far per row in
+            shape `(N,)`.
+        max_length: Number of slots per cache.
+
+    Returns:
+        Boolean mask in shape `(N, 1, max_length)`.
+    """
+    key_idx = torch.arange(max_length, device=num_tokens.device)
+
+    return (key_idx <= num_tokens.unsqueeze(-1)).unsqueeze(1)
+
+
+def get_rolling_window_mask(
+    query_positions: torch.Tensor,
+    key_positions: torch.Tensor,
+    max_length: int,
+    num_sink_tokens: int,
+) -> torch.Tensor:
+    """
+    Mask for queries over keys of tokens at given positions in the order in
+    which they are written to rolling caches: a query attends to the keys
+    that the caches hold once it is written, i.e. to the first
+    `num_sink_tokens` tokens and to the last `max_length - num_sink_tokens`
+    tokens up to itself (cf. `get_rolling_cache_position`).
+
+    Args:
+        query_positions: Positions of the queries in shape `(seq_length,)`.
+        key_positions: Positions of the keys in shape `(seq_length',)`.
+        max_length: Number of slots per cache.
+        num_sink_tokens: Number of pinned slots.
+
+    Returns:
+        Boolean mask in shape `(seq_length, seq_length')`.
+    """
+    query_positions = query_positions.unsqueeze(-1)
+    is_recent = key_positions > query_positions - (
+        max_length - num_sink_tokens
+    )
+
+    return (key_positions <= query_positions) & (
+        (key_positions < num_sink_tokens) | is_recent
+    )
+
+
 def expand_mask(mask: torch.Tensor) -> torch.Tensor:
     """
     Helper function to support different mask shapes.
@@ -103,12 +240,267 @@ def scaled_dot_product_attn(
     return attn_weights @ v, attn_weights
 
 
+class KVCache:
+    """
+    Key/value cache of a single attention layer, used for incremental
+    decoding: keys and values of previously processed tokens are stored, so
+    that only the newest tokens need to be projected in each step.
+    """
+
+    def __init__(self) -> None:
+        self.k = None  # `(N, num_heads, seq_length, head_dim)`
+        self.v = None  # `(N, num_heads, seq_length, head_dim)`
+
+    @property
+    def seq_length(self) -> int:
+        """
+        Number of cached tokens.
+        """
+        return 0 if self.k is None else self.k.shape[-2]
+
+    def update(
+        self, k: torch.Tensor, v: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Append keys and values of new tokens to the cache.
+
+        Args:
+            k: Keys in shape `(N, num_heads, seq_length, head_dim)`
+            v: Values in shape `(N, num_heads, seq_length, head_dim)`
+
+        Returns:
+            Keys and values of all cached tokens in shape
+            `(N, num_heads, seq_length', head_dim)`
+        """
+        if self.k is None:
+            self.k, self.v = k, v
+        else:
+            self.k = torch.cat([self.k, k], dim=-2)
+            self.v = torch.cat([self.v, v], dim=-2)
+
+        return self.k, self.v
+
+    def reorder(self, indices: torch.Tensor) -> None:
+        """
+        Select (and reorder) rows of the cache, e.g. to drop finished
+        sequences from the batch.
+
+        Args:
+            indices: Indices of the rows to keep in shape `(N',)`
+        """
+        if self.k is not None:
+            self.k = self.k.index_select(0, indices)
+            self.v = self.v.index_select(0, indices)
+
+    def crop(self, seq_length: int) -> None:
+        """
+        Drop all but the first `seq_length` cached tokens, e.g. rejected
+        tokens in speculative decoding.
+
+        Args:
+            seq_length: Number of cached tokens to keep.
+        """
+        if self.k is not None:
+            self.k = self.k[:, :, :seq_length]
+            self.v = self.v[:, :, :seq_length]
+
+
+class StaticKVCache:
+    """
+    Preallocated key/value cache of a single attention layer, whose shape is
+    fixed, such that a compiled decoding step can be reused for every token.
+    Keys and values are written into the slots `cache_position` (set before
+    each forward pass), and all `max_length` slots are attended to (with a
+    mask hiding slots that have not been written yet).
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        num_heads: int,
+        max_length: int,
+        head_dim: int,
+        device: torch.device | str | int = "cpu",
+        dtype: torch.dtype = torch.float32,
+    ) -> None:
+        shape = (batch_size, num_heads, max_length, head_dim)
+        self.k = torch.zeros(shape, device=device, dtype=dtype)
+        self.v = torch.zeros(shape, device=device, dtype=dtype)
+        self.cache_position = None  # `(seq_length,)`
+
+    @property
+    def seq_length(self) -> int:
+        """
+        Number of slots (including those not written yet).
+        """
+        return self.k.shape[-2]
+
+    def update(
+        self, k: torch.Tensor, v: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Write keys and values of new tokens into the slots `cache_position`.
+
+        Args:
+            k: Keys in shape `(N, num_heads, seq_length, head_dim)`
+            v: Values in shape `(N, num_heads, seq_length, head_dim)`
+
+        Returns:
+            Keys and values of all slots in shape
+            `(N, num_heads, max_length, head_dim)`
+        """
+        self.k.index_copy_(2, self.cache_position, k.to(self.k.dtype))
+        self.v.index_copy_(2, self.cache_position, v.to(self.v.dtype))
+
+        return self.k, self.v
+
+
+class RollingKVCache:
+    """
+    Key/value cache of a single attention layer with a fixed number of
+    slots, for generating beyond the context window with constant memory
+    and cost per token: the first `num_sink_tokens` slots are pinned
+    (attention sinks [1]), the others form a ring buffer in which each new
+    token overwrites the oldest one (cf. `get_rolling_cache_position`).
+    Since the positional encoding is added to the embeddings, keys and
+    values carry the positions of their tokens, so the order of the slots
+    is irrelevant. The keys and values of one new token per row are written
+    into the slots `cache_position` (set before each forward pass). Without
+    `cache_position`, the keys and values of new tokens are kept pending
+    instead and attended to after those of the slots (with a mask hiding the
+    slots they will overwrite, cf. `get_rolling_window_mask`), until
+    `commit` writes them, e.g. such that rejected draft tokens in
+    speculative decoding never overwrite a slot.
+
+    [1] http://arxiv.org/abs/2309.17453
+    """
+
+    def __init__(self, k: torch.Tensor, v: torch.Tensor) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            k: Keys of all slots in shape `(N, num_heads, max_length,
+                head_dim)`.
+            v: Values of all slots in shape `(N, num_heads, max_length,
+                head_dim)`.
+        """
+        self.k = k
+        self.v = v
+        self.cache_position = None  # `(N,)`
+        # `(N, num_heads, num_pending, head_dim)`
+        self.pending_k = None
+        self.pending_v = None
+
+    @classmethod
+    def from_kv_cache(
+        cls, kv_cache: KVCache, num_padding: torch.Tensor
+    ) -> "RollingKVCache":
+        """
+        Convert a full cache of left-padded rows, moving the tokens of each
+        row to the first slots (and the padding to the last ones, which are
+        overwritten next).
+
+        Args:
+            kv_cache: Cache of `max_length` tokens.
+            num_padding: Number of (leading) padding tokens per row in shape
+                `(N,)`.
+
+        Returns:
+            Rolling cache with `max_length` slots.
+        """
+        N, num_heads, max_length, head_dim = kv_cache.k.shape
+        slot_idx = torch.arange(max_length, device=kv_cache.k.device)
+        idx = (slot_idx + num_padding.unsqueeze(-1)) % max_length
+        idx = idx[:, None, :, None].expand(-1, num_heads, -1, head_dim)
+
+        return cls(kv_cache.k.gather(2, idx), kv_cache.v.gather(2, idx))
+
+    @property
+    def seq_length(self) -> int:
+        """
+        Number of slots (including those not written yet).
+        """
+        return self.k.shape[-2]
+
+    def update(
+        self, k: torch.Tensor, v: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Write keys and values of a new token per row into the slots
+        `cache_position`, or append those of new tokens to the pending ones
+        if `cache_position` is not set.
+
+        Args:
+            k: Keys in shape `(N, num_heads, seq_length, head_dim)`, where
+                `seq_length = 1` if `cache_position` is set
+            v: Values in shape `(N, num_heads, seq_length, head_dim)`
+
+        Returns:
+            Keys and values of all slots (followed by those of the pending
+            tokens) in shape `(N, num_heads, max_length, head_dim)` (or
+            `(N, num_heads, max_length + num_pending, head_dim)`)
+        """
+        if self.cache_position is None:
+            k, v = k.to(self.k.dtype), v.to(self.v.dtype)
+            if self.pending_k is not None:
+                k = torch.cat([self.pending_k, k], dim=-2)
+                v = torch.cat([self.pending_v, v], dim=-2)
+            self.pending_k, self.pending_v = k, v
+
+            return (
+                torch.cat([self.k, self.pending_k], dim=-2),
+                torch.cat([self.v, self.pending_v], dim=-2),
+            )
+
+        idx = self.cache_position[:, None, None, None].expand_as(k)
+        self.k.scatter_(2, idx, k.to(self.k.dtype))
+        self.v.scatter_(2, idx, v.to(self.v.dtype))
+
+        return self.k, self.v
+
+    def reorder(self, indices: torch.Tensor) -> None:
+        """
+        Select (and reorder) rows of the cache, e.g. to drop finished
+        sequences from the batch.
+
+        Args:
+            indices: Indices of the rows to keep in shape `(N',)`
+        """
+        self.k = self.k.index_select(0, indices)
+        self.v = self.v.index_select(0, indices)
+
+    def commit(
+        self, pending_idx: torch.Tensor, cache_position: torch.Tensor
+    ) -> None:
+        """
+        Write keys and values of pending tokens into slots and drop all
+        pending tokens.
+
+        Args:
+            pending_idx: Indices of the pending tokens to write in shape
+                `(num_written,)`
+            cache_position: Distinct slots of these tokens in shape
+                `(num_written,)`
+        """
+        if self.pending_k is not None:
+            self.k.index_copy_(
+                2, cache_position, self.pending_k[:, :, pending_idx]
+            )
+            self.v.index_copy_(
+                2, cache_position, self.pending_v[:, :, pending_idx]
+            )
+        self.pending_k = None
+        self.pending_v = None
+
+
 class MultiHeadAttention(nn.Module):
     def __init__(
         self,
         embed_dim: int,
         num_heads: int,
         use_bias: bool = False,
+        attn_backend: str = "auto",
     ) -> None:
         """
         Multi-head attention.
@@ -117,6 +509,8 @@ class MultiHeadAttention(nn.Module):
             embed_dim: Embedding dim, referred to as `d_model` in [1]
             num_heads: Number of heads, `h` in [1]
             use_bias: Whether a bias term is used. Default is `False`
+            attn_backend: Implementation of the scaled dot-product
+                attention, one of `ATTN_BACKENDS`. Default is `"auto"`
 
         [1] http://arxiv.org/abs/1706.03762
         """
@@ -126,10 +520,15 @@ class MultiHeadAttention(nn.Module):
             f"was chosen, hence `d_model`:`num_heads` cannot be {embed_dim}: "
             f"{num_heads}"
         )
+        assert attn_backend in ATTN_BACKENDS, (
+            f"Attention backend should be one of {ATTN_BACKENDS}, but is "
+            f"'{attn_backend}'."
+        )
 
         self.embed_dim = embed_dim
         self.num_heads = num_heads
         self.use_bias = use_bias
+        self.attn_backend = attn_backend
 
         # dim of queries, keys and values per self-attention head:
         # (cf. Sec. 3.2.2 of [1])
@@ -168,6 +567,8 @@ class MultiHeadAttention(nn.Module):
         x: torch.Tensor,
         attn_mask: Optional[torch.Tensor] = None,
         return_attention: Optional[bool] = False,
+        kv_cache: Optional[KVCache] = None,
+        is_causal: bool = False,
     ) -> torch.Tensor:
         """
         Forward pass.
@@ -178,13 +579,28 @@ class MultiHeadAttention(nn.Module):
             attn_mask: Optional look-ahead mask. All values set to `1` will
                 be excluded for attention calculation.
             return_attention: Whether to return the attention weights
+            kv_cache: Optional cache of keys and values of preceding tokens.
+                If provided, keys and values of `x` are appended to it and
+                the queries attend to all cached tokens.
+            is_causal: Whether to prevent attending to subsequent tokens
+                without passing an explicit `attn_mask`. With `kv_cache`,
+                the queries are the last `seq_length` of all tokens.
 
         Returns:
             Output in shape `(N, seq_length, self.embed_dim)` and optionally
             attention weights in shape
-            `(N, self.num_heads, seq_length, seq_length)`
+            `(N, self.num_heads, seq_length, seq_length')`, where
+            `seq_length'` includes the cached tokens
         """
         N, S, E = x.shape  # batch size, sequence length, embedding dim
+        assert attn_mask is None or not is_causal, (
+            "Please either provide an attention mask or set `is_causal`, "
+            "but not both."
+        )
+        assert not (return_attention and self.attn_backend == "sdpa"), (
+            "Attention weights are not materialized by the 'sdpa' backend, "
+            "please choose the 'naive' or 'auto' backend."
+        )
 
         if attn_mask is not None:
             attn_mask = expand_mask(attn_mask)
@@ -205,15 +621,43 @@ class MultiHeadAttention(nn.Module):
         v_proj = v_proj.reshape(N, S, self.num_heads, self.head_dim).permute(
             dims=(0, 2, 1, 3)
         )
+        if kv_cache is not None:
+            k_proj, v_proj = kv_cache.update(k_proj, v_proj)
+
+        # number of keys, including cached ones
+        S_kv = k_proj.shape[-2]
+        use_sdpa = self.attn_backend == "sdpa" or (
+            self.attn_backend == "auto" and not return_attention
+        )
+
+        # causal masking: the fused kernel masks implicitly if queries and
+        # keys are aligned, otherwise a mask is built (a single query may
+        # attend to all cached keys)
+        if is_causal and not (use_sdpa and S == S_kv):
+            if S > 1:
+                attn_mask = get_subsequent_mask(
+                    size=S, rank=x.device, offset=S_kv - S
+                )
+            is_causal = False
 
         # Determine value outputs
         # `(N, self.num_heads, seq_length, self.head_dim)`
-        values, attn_weights = scaled_dot_product_attn(
-            q_proj,
-            k_proj,
-            v_proj,
-            attn_mask=attn_mask,
-        )
+        if use_sdpa:
+            values = scaled_dot_product_attention(
+                q_proj,
+                k_proj,
+                v_proj,
+                attn_mask=attn_mask.bool() if attn_mask is not None else None,
+                is_causal=is_causal,
+            )
+            attn_weights = None
+        else:
+            values, attn_weights = scaled_dot_product_attn(
+                q_proj,
+                k_proj,
+                v_proj,
+                attn_mask=attn_mask,
+            )
         values = (values := values.permute(0, 2, 1, 3)).reshape(N, S, E)
         o = self.o_proj(values)  # `(N, seq_length, self.embed_dim)`
 
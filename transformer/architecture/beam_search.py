@@ -0,0 +1,253 @@
+from typing import List, Optional
+
+import torch
+from torch import nn
+
+
+def _length_normalize(
+    scores: torch.Tensor, length: int, length_penalty: float
+) -> torch.Tensor:
+    """
+    Divide summed log-probabilities by `length ** length_penalty`.
+
+    Args:
+        scores: Summed log-probabilities.
+        length: Number of generated tokens.
+        length_penalty: Exponent of the length.
+
+    Returns:
+        Normalized scores.
+    """
+    return scores / length**length_penalty
+
+
+@torch.no_grad()
+def beam_search(
+    model: nn.Module,
+    x: torch.Tensor,
+    max_new_tokens: int,
+    block_size: int,
+    num_beams: int = 4,
+    length_penalty: float = 1.0,
+    early_stopping: bool = False,
+    padding_mask: Optional[torch.Tensor] = None,
+    stop_tokens: Optional[List[int]] = None,
+    stop_sequences: Optional[List[List[int]]] = None,
+    max_lengths: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Batched beam search: for every row, the `num_beams` most likely
+    continuations (by summed log-probabilities) are extended in each step.
+    The beams are folded into the batch, i.e. the rows of the batch are
+    `(row, beam)` pairs, such that each step is a single forward pass. The
+    prompts are encoded once and their key/value caches are then copied to
+    the beams; when beams are reordered, the caches are reordered with a
+    single `index_select` per layer (cf. `KVCache.reorder`) instead of
+    recomputing the prefixes.
+
+    A hypothesis is finished once it generates a stop token (or sequence),
+    or once it reaches the maximum number of new tokens. Finished hypotheses
+    are ranked by their score divided by `length ** length_penalty`, where
+    `length` is the number of generated tokens, so `length_penalty > 0`
+    favors longer and `length_penalty < 0` shorter sequences. A row is done
+    once it has `num_beams` finished hypotheses and, without
+    `early_stopping`, none of its beams can still beat the worst of them
+    (estimated with the current length, as in Hugging Face's
+    `transformers`). Rows that are done are dropped from the batch.
+
+    Args:
+        model: Transformer (not wrapped). Its compiled forward pass is used
+            if available (cf. `Transformer.compile_decoding`).
+        x: Input tokens to decoder, shape: `(N, T)`.
+        max_new_tokens: Maximum number of tokens to generate.
+        block_size: Maximum context length for predictions.
+        num_beams: Number of beams per row.
+        length_penalty: Exponent of the length normalization of the scores.
+        early_stopping: Whether a row is done as soon as it has `num_beams`
+            finished hypotheses.
+        padding_mask: Mask of the prompts in shape `(N, T)`, which is `1`
+            for tokens and `0` for left padding.
+        stop_tokens: Tokens that finish a hypothesis (e.g. the end-of-text
+            token), which are included in the output.
+        stop_sequences: Token sequences that finish a hypothesis, which are
+            included in the output.
+        max_lengths: Maximum number of new tokens per row in shape `(N,)`,
+            at most `max_new_tokens`.
+
+    Returns:
+        Output tensor of shape `(N, T + num_new_tokens)` with the best
+        hypothesis of each row, right-padded with `-1`.
+    """
+    forward = model._compiled_forward or model
+    vocab_size = model.embedding.num_embeddings
+    N, T = x.shape
+    B = num_beams
+    device = x.device
+
+    if padding_mask is not None:
+        padding_mask = padding_mask.long()
+    if stop_tokens is not None:
+        stop_tokens = torch.tensor(stop_tokens, device=device)
+    stop_sequences = [
+        torch.tensor(stop_sequence, device=device)
+        for stop_sequence in stop_sequences or []
+    ]
+    if max_lengths is None:
+        max_lengths = torch.full((N,), max_new_tokens, device=device)
+    max_lengths = max_lengths.to(device).clamp(max=max_new_tokens)
+
+    # finished hypotheses of each row, sorted by their normalized scores
+    # (the generated tokens are right-padded with `-1`)
+    hyp_scores = torch.full((N, B), -torch.inf, device=device)
+    hyp_tokens = torch.full(
+        (N, B, max_new_tokens), -1, dtype=x.dtype, device=device
+    )
+
+    # rows of the batch are `(row, beam)` pairs of the unfinished rows
+    # `row_ids` (after the first step)
+    row_ids = torch.arange(N, device=device)
+    beam_scores = torch.zeros(N, B, device=device)
+    beam_scores[:, 1:] = -torch.inf  # the beams are identical initially
+    kv_caches = model.init_kv_caches()
+    prompts = x
+    x_new = x  # tokens that have not been fed through the model yet
+
+    for step in range(max_new_tokens):
+        if kv_caches[0].seq_length + x_new.shape[1] > block_size:
+            # slide the context window (re-encoding it)
+            x_cond = x[:, -block_size:]
+            kv_caches = model.init_kv_caches()
+        else:
+            x_cond = x_new
+        pos_offset = kv_caches[0].seq_length
+        logits = forward(
+            x_cond,
+            kv_caches=kv_caches,
+            pos_offset=pos_offset,
+            num_logits=1,
+            is_causal=padding_mask is None,
+            padding_mask=(
+                padding_mask[:, -(pos_offset + x_cond.shape[1]) :]
+                if padding_mask is not None
+                else None
+            ),
+        )
+        log_probs = torch.log_softmax(logits[:, -1].float(), dim=-1)
+
+        if step == 0:
+            # copy the encoded prompts to the beams
+            beam_ids = torch.arange(N, device=device).repeat_interleave(B)
+            x, log_probs = x[beam_ids], log_probs[beam_ids]
+            if padding_mask is not None:
+                padding_mask = padding_mask[beam_ids]
+            for kv_cache in kv_caches:
+                kv_cache.reorder(beam_ids)
+
+        # best `2 * B` candidates per row, such that at least `B` of them
+        # are unfinished unless many of them are stop tokens
+        R = row_ids.shape[0]
+        scores = beam_scores.unsqueeze(-1) + log_probs.view(R, B, vocab_size)
+        top_scores, top_ids = scores.view(R, -1).topk(2 * B, dim=-1)
+        # rows of the batch that the candidates extend
+        src = (
+            torch.arange(R, device=device).unsqueeze(-1) * B
+            + top_ids // vocab_size
+        )
+        tokens = top_ids % vocab_size
+        num_new_tokens = step + 1
+
+        is_stop = torch.zeros_like(tokens, dtype=torch.bool)
+        if stop_tokens is not None:
+            is_stop |= torch.isin(tokens, stop_tokens)
+        for stop_sequence in stop_sequences:
+            L = len(stop_sequence)
+            if num_new_tokens >= L:
+                tails = torch.cat(
+                    [x[:, x.shape[1] - (L - 1) :][src], tokens.unsqueeze(-1)],
+                    dim=-1,
+                )
+                is_stop |= (tails == stop_sequence).all(dim=-1)
+
+        # continue the best `B` unfinished candidates
+        beam_scores, idx = top_scores.masked_fill(is_stop, -torch.inf).topk(
+            B, dim=-1
+        )
+        beam_ids = src.gather(-1, idx).view(-1)
+        prev_x = x
+        next_token = tokens.gather(-1, idx).view(-1, 1)
+        x = torch.cat([x[beam_ids], next_token], dim=-1)
+        x_new = next_token
+        if padding_mask is not None:
+            padding_mask = torch.cat(
+                [padding_mask[beam_ids], torch.ones_like(next_token)], dim=-1
+            )
+        for kv_cache in kv_caches:
+            kv_cache.reorder(beam_ids)
+
+        # new finished hypotheses: stop candidates that rank among the best
+        # `B` candidates, and all beams of rows at their maximum length
+        is_exhausted = max_lengths[row_ids] <= num_new_tokens
+        is_finished = torch.cat(
+            [
+                is_stop[:, :B] & top_scores[:, :B].isfinite(),
+                is_exhausted.unsqueeze(-1) & beam_scores.isfinite(),
+            ],
+            dim=-1,
+        )
+        # (this synchronizes with the device)
+        if is_finished.any():
+            new_scores = _length_normalize(
+                torch.cat([top_scores[:, :B], beam_scores], dim=-1),
+                length=num_new_tokens,
+                length_penalty=length_penalty,
+            ).masked_fill(~is_finished, -torch.inf)
+            new_tokens = torch.full(
+                (R, 2 * B, max_new_tokens), -1, dtype=x.dtype, device=device
+            )
+            new_tokens[:, :B, :num_new_tokens] = torch.cat(
+                [prev_x[:, T:][src[:, :B]], tokens[:, :B].unsqueeze(-1)],
+                dim=-1,
+            )
+            new_tokens[:, B:, :num_new_tokens] = x[:, T:].view(R, B, -1)
+
+            # keep the best `B` hypotheses
+            all_scores = torch.cat([hyp_scores[row_ids], new_scores], dim=-1)
+            all_tokens = torch.cat([hyp_tokens[row_ids], new_tokens], dim=1)
+            all_scores, idx = all_scores.topk(B, dim=-1)
+            hyp_scores[row_ids] = all_scores
+            hyp_tokens[row_ids] = all_tokens[
+                torch.arange(R, device=device).unsqueeze(-1), idx
+            ]
+
+        # a row is done if its best beam cannot beat its worst hypothesis
+        is_full = hyp_scores[row_ids, -1].isfinite()
+        if early_stopping:
+            is_done = is_full
+        else:
+            best_possible = _length_normalize(
+                beam_scores[:, 0],
+                length=num_new_tokens,
+                length_penalty=length_penalty,
+            )
+            is_done = is_full & (hyp_scores[row_ids, -1] >= best_possible)
+        is_done |= is_exhausted | beam_scores[:, 0].isinf()
+
+        # drop the rows that are done (this synchronizes with the device)
+        if is_done.any():
+            keep = (~is_done).nonzero().squeeze(-1)
+            if keep.numel() == 0:
+                break
+            row_ids, beam_scores = row_ids[keep], beam_scores[keep]
+            beam_ids = (
+                keep.unsqueeze(-1) * B + torch.arange(B, device=device)
+            ).view(-1)
+            x, x_new = x[beam_ids], x_new[beam_ids]
+            if padding_mask is not None:
+                padding_mask = padding_mask[beam_ids]
+            for kv_cache in kv_caches:
+                kv_cache.reorder(beam_ids)
+
+    # best hypothesis of each row
+    num_new_tokens = int((hyp_tokens[:, 0] >= 0).sum(dim=-1).max())
+
+    return torch.cat([prompts, hyp_tokens[:, 0, :num_new_tokens]], dim=-1)
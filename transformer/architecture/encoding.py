@@ -1,4 +1,5 @@
 import math
+from typing import Optional
 
 import torch
 from torch import nn
@@ -21,48 +22,83 @@ class PositionalEncoding(nn.Module):
 
         super().__init__()
 
+        self.max__seq_length = max__seq_length
+        self.embed_dim = embed_dim
+
+        # not a trainable param, but make a registered buffer for device
+        # handling; positional encoding doesn't need to be part of the state
+        # dict, so use `persistent=False`
+        self.register_buffer(
+            name="pos_encod",
+            tensor=self._compute_encoding(),
+            persistent=False,
+        )
+
+    def _compute_encoding(self) -> torch.Tensor:
+        """
+        Compute the sinusoidal positional encoding.
+
+        Returns:
+            Positional encoding in shape `(1, max__seq_length, embed_dim)`
+        """
         # create initial encoding tensor filled with zeros
         pos_encod = torch.zeros(
-            max__seq_length,
-            embed_dim,
+            self.max__seq_length,
+            self.embed_dim,
         )
 
         # sinusodial and cosinusoidal positional encodings
         pos_idx = torch.arange(
-            0, max__seq_length, 1, dtype=torch.float32
+            0, self.max__seq_length, 1, dtype=torch.float32
         ).unsqueeze(
             1
         )  # `(max__seq_length, 1)`
-        embed_idx = torch.arange(0, embed_dim // 2, 1, dtype=torch.float32)
+        embed_idx = torch.arange(
+            0, self.embed_dim // 2, 1, dtype=torch.float32
+        )
 
         div = torch.exp(
-            -2 * embed_idx / embed_dim * math.log(max__seq_length)
+            -2 * embed_idx / self.embed_dim * math.log(self.max__seq_length)
         )  # for numerical stability
 
         pos_encod[:, ::2] = torch.sin(pos_idx * div)
         pos_encod[:, 1::2] = torch.cos(pos_idx * div)
-        pos_encod = pos_encod.unsqueeze(0)  # `(1, max__seq_length, embed_dim)`
 
-        # not a trainable param, but make a registered buffer for device
-        # handling; positional encoding doesn't need to be part of the state
-        # dict, so use `persistent=False`
-        self.register_buffer(
-            name="pos_encod",
-            tensor=pos_encod,
-            persistent=False,
-        )
+        return pos_encod.unsqueeze(0)  # `(1, max__seq_length, embed_dim)`
+
+    def reset_buffer(self, dtype: torch.dtype = torch.float32) -> None:
+        """
+        Recompute the positional encoding (on the CPU), e.g. after the module
+        was constructed on the `meta` device, where buffers hold no data.
+
+        Args:
+            dtype: Data type of the positional encoding.
+        """
+        self.pos_encod = self._compute_encoding().to(dtype)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        x: torch.Tensor,
+        offset: int = 0,
+        positions: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
         """ "
         Forward pass.
 
         Args:
             x: Input tensor of shape `(N, seq_length, input_dim)`,
                 where `input_dim = embed_dim = d_model`
+            offset: Position of the first token in `x`, e.g. the number of
+                tokens already processed when decoding incrementally.
+            positions: Positions of the tokens in shape `(N, seq_length)`,
+                e.g. for left-padded sequences. Overrides `offset`.
 
         Returns:
             Tensor to which positional encoding is added in shape
-            `(N, seq_length, input_dim)` if `seq_length <= max__seq_length`,
-            else `(N, max__seq_length, input_dim)`
+            `(N, seq_length, input_dim)` if
+            `offset + seq_length <= max__seq_length`
         """
-        return x + self.pos_encod[:, : x.shape[1]]  # uses registered buffer
+        # uses registered buffer
+        if positions is not None:
+            return x + self.pos_encod[0, positions]
+        return x + self.pos_encod[:, offset : offset + x.shape[1]]
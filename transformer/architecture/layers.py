@@ -1,7 +1,9 @@
+from typing import Optional
+
 import torch
 from torch import nn
 
-from .attention import MultiHeadAttention
+from .attention import KVCache, MultiHeadAttention
 
 
 class DecoderBlock(nn.Module):
@@ -12,6 +14,7 @@ class DecoderBlock(nn.Module):
         dim_feedfwd: int = 2048,
         dropout: bool = 0.0,
         use_bias: bool = False,
+        attn_backend: str = "auto",
     ) -> None:
         """
         Initialization function.
@@ -22,6 +25,7 @@ class DecoderBlock(nn.Module):
             dim_feedfwd: Hidden dimension when applying two-layer MLP
             dropout: Amount of dropout to be applied.
             use_bias: Whether a bias term is used. Default is `False`
+            attn_backend: Implementation of the scaled dot-product attention.
 
         [1] http://arxiv.org/abs/1706.03762
         """
@@ -38,6 +42,7 @@ class DecoderBlock(nn.Module):
             embed_dim=embed_dim,
             num_heads=num_heads,
             use_bias=use_bias,
+            attn_backend=attn_backend,
         )
 
         # two-layer MLP (called "feed forward" in [1], cf. Eq. (2) in [1])
@@ -50,7 +55,13 @@ class DecoderBlock(nn.Module):
         self.norm_b = nn.LayerNorm(normalized_shape=[embed_dim])
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        x: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+        kv_cache: Optional[KVCache] = None,
+        is_causal: bool = False,
+    ) -> torch.Tensor:
         """
         Forward pass.
 
@@ -59,13 +70,18 @@ class DecoderBlock(nn.Module):
                 (`input_dim = embed_dim = d_model` in [1])
             mask: Mask for the target sequence, either 2D, 3D or 4D (prevents
                 attending to subsequent tokens)
+            kv_cache: Optional key/value cache of the attention layer.
+            is_causal: Whether to prevent attending to subsequent tokens
+                without an explicit `mask`.
 
         Returns:
             Output tensor of shape `(N, T, input_dim)`
         """
 
         # multi-head attention part
-        out_a = self.multihead_attn(x=x, attn_mask=mask)
+        out_a = self.multihead_attn(
+            x=x, attn_mask=mask, kv_cache=kv_cache, is_causal=is_causal
+        )
         out_a = self.norm_a(self.dropout(out_a) + x)
 
         # feed-forward part
@@ -117,3 +133,40 @@ class PositionwiseFeedForward(nn.Module):
         """
 
         return self.mlp(x)
+
+
+class PredictionHead(nn.Module):
+    def __init__(self, embed_dim: int) -> None:
+        """
+        Extra prediction head in the style of [1]: a residual block applied
+        to the final hidden states, whose output is fed through the (shared)
+        pre-softmax linear layer to predict a token further ahead. The
+        linear layer is initialized to zero, such that the head initially
+        predicts the same as the next-token head.
+
+        Args:
+            embed_dim: Embedding dim.
+
+        [1] http://arxiv.org/abs/2401.10774
+        """
+        super().__init__()
+
+        self.linear = nn.Linear(
+            in_features=embed_dim, out_features=embed_dim, bias=True
+        )
+        self.act = nn.SiLU()
+        nn.init.zeros_(self.linear.weight)
+        nn.init.zeros_(self.linear.bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass.
+
+        Args:
+            x: Hidden states of shape `(N, seq_length, embed_dim)`
+
+        Returns:
+            Output tensor of shape `(N, seq_length, embed_dim)`
+        """
+
+        return x + self.act(self.linear(x))
@@ -1,12 +1,67 @@
 import math
-from typing import Optional
+from typing import Callable, List, Optional, Tuple, Union
 
 import torch
 from torch import nn
+from torch.nn.functional import cross_entropy
+from torch.utils.checkpoint import checkpoint
 
-from .attention import get_subsequent_mask
+from .attention import (
+    KVCache,
+    RollingKVCache,
+    StaticKVCache,
+    get_cache_mask,
+    get_padding_mask,
+    get_rolling_cache_position,
+    get_rolling_mask,
+)
 from .encoding import PositionalEncoding
-from .layers import DecoderBlock
+from .layers import DecoderBlock, PredictionHead
+from .sampling import Sampler, get_token_sampler
+
+
+def chunked_cross_entropy(
+    hidden: torch.Tensor,
+    linear: nn.Linear,
+    targets: torch.Tensor,
+    chunk_size: int,
+) -> torch.Tensor:
+    """
+    Mean cross-entropy loss of the logits `linear(hidden)`, computed in chunks
+    along the sequence dimension, such that only the logits of a single
+    chunk are materialized at a time. The logits are not kept for the
+    backward pass, but recomputed chunk by chunk.
+
+    Args:
+        hidden: Hidden states in shape `(N, T, embed_dim)`.
+        linear: Pre-softmax linear layer.
+        targets: Target tokens in shape `(N, T)`.
+        chunk_size: Number of positions per chunk.
+
+    Returns:
+        Mean cross-entropy loss (same as without chunking).
+    """
+
+    def chunk_loss(
+        hidden_chunk: torch.Tensor, targets_chunk: torch.Tensor
+    ) -> torch.Tensor:
+        logits = linear(hidden_chunk)  # `(N, chunk_size, vocab_size)`
+        return cross_entropy(
+            logits.reshape(-1, logits.shape[-1]),
+            targets_chunk.reshape(-1),
+            reduction="sum",
+        )
+
+    loss = 0
+    for idx in range(0, hidden.shape[1], chunk_size):
+        loss = loss + checkpoint(
+            chunk_loss,
+            hidden[:, idx : idx + chunk_size],
+            targets[:, idx : idx + chunk_size],
+            use_reentrant=False,
+        )
+
+    return loss / targets.numel()
 
 
 class Decoder(nn.Module):
@@ -18,6 +73,7 @@ class Decoder(nn.Module):
         dim_feedfwd: int,
         dropout: bool = 0.0,
         use_bias: bool = False,
+        attn_backend: str = "auto",
     ) -> None:
         """
         Transformer decoder.
@@ -29,6 +85,7 @@ class Decoder(nn.Module):
             dim_feedfwd: Hidden dimension when applying two-layer MLP
             dropout: Amount of dropout to be applied.
             use_bias: Whether a bias term is used. Default is `False`
+            attn_backend: Implementation of the scaled dot-product attention.
         """
         super().__init__()
         self.num_layers = num_layers
@@ -40,6 +97,7 @@ class Decoder(nn.Module):
                     dim_feedfwd=dim_feedfwd,
                     dropout=dropout,
                     use_bias=use_bias,
+                    attn_backend=attn_backend,
                 )
                 for _ in range(num_layers)
             ]
@@ -48,7 +106,9 @@ class Decoder(nn.Module):
     def forward(
         self,
         x: torch.Tensor,
-        mask: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+        kv_caches: Optional[List[KVCache]] = None,
+        is_causal: bool = False,
     ) -> torch.Tensor:
         """
         Forward pass.
@@ -57,6 +117,9 @@ class Decoder(nn.Module):
             x: Input tensor of shape `(N, T, input_dim)`
                 (`input_dim = embed_dim = d_model` in [1])
             mask: Mask for the target sequence, either 2D, 3D or 4D
+            kv_caches: Optional key/value caches, one per decoder block.
+            is_causal: Whether to prevent attending to subsequent tokens
+                without an explicit `mask`.
 
         Returns:
             Output tensor of shape `(N, seq_length, input_dim)`
@@ -64,7 +127,12 @@ class Decoder(nn.Module):
         [1] http://arxiv.org/abs/1706.03762
         """
         for idx in range(self.num_layers):
-            x = self.decoder_blocks[idx](x=x, mask=mask)
+            x = self.decoder_blocks[idx](
+                x=x,
+                mask=mask,
+                kv_cache=kv_caches[idx] if kv_caches is not None else None,
+                is_causal=is_causal,
+            )
 
         return x
 
@@ -80,6 +148,8 @@ class Transformer(nn.Module):
         dim_feedfwd: int = 2048,
         dropout_rate: float = 0.0,
         use_bias: bool = False,
+        attn_backend: str = "auto",
+        num__extra_heads: int = 0,
     ) -> None:
         """
         Transformer model.
@@ -95,6 +165,12 @@ class Transformer(nn.Module):
             dropout_rate: Dropout rate.
             use_bias: Whether a bias term is used when performing the
                 self-attention calculation. Default is `False`.
+            attn_backend: Implementation of the scaled dot-product attention,
+                `"naive"`, `"sdpa"` or `"auto"`. Default is `"auto"`.
+            num__extra_heads: Number of extra prediction heads, which
+                predict the tokens `2, 3, ...` positions ahead (cf.
+                `get_extra_heads_loss`), e.g. to draft tokens in speculative
+                decoding.
 
         Returns:
             Output tensor of shape `(N, num_classes)`
@@ -111,6 +187,7 @@ class Transformer(nn.Module):
             dim_feedfwd=dim_feedfwd,
             dropout=dropout_rate,
             use_bias=use_bias,
+            attn_backend=attn_backend,
         )
         self.pos_encod = PositionalEncoding(
             max__seq_length=max__seq_length,
@@ -130,11 +207,83 @@ class Transformer(nn.Module):
         # high)
         self.embedding.weight = self.pre_softmax_linear.weight
         self.dropout = nn.Dropout(p=dropout_rate)
+        self.extra_heads = nn.ModuleList(
+            [
+                PredictionHead(embed_dim=embedding_dim)
+                for _ in range(num__extra_heads)
+            ]
+        )
+
+        # compiled forward pass used for decoding (cf. `compile_decoding`)
+        self._compiled_forward = None
+
+    def init_kv_caches(self) -> List[KVCache]:
+        """
+        Create empty key/value caches for incremental decoding.
+
+        Returns:
+            One (empty) cache per decoder block.
+        """
+        return [KVCache() for _ in range(self.decoder.num_layers)]
+
+    def init_static_kv_caches(
+        self, batch_size: int, max_length: int
+    ) -> List[StaticKVCache]:
+        """
+        Create preallocated key/value caches for decoding with static shapes.
+
+        Args:
+            batch_size: Batch size.
+            max_length: Number of slots per cache.
+
+        Returns:
+            One (zero-initialized) cache per decoder block.
+        """
+        num_heads = self.decoder.decoder_blocks[0].multihead_attn.num_heads
+        return [
+            StaticKVCache(
+                batch_size=batch_size,
+                num_heads=num_heads,
+                max_length=max_length,
+                head_dim=self.embed_dim // num_heads,
+                device=self.embedding.weight.device,
+                dtype=self.embedding.weight.dtype,
+            )
+            for _ in range(self.decoder.num_layers)
+        ]
+
+    def compile_decoding(
+        self, mode: Optional[str] = None, dynamic: Optional[bool] = None
+    ) -> None:
+        """
+        Compile the forward pass used by `generate` (the module itself is
+        not replaced, so training is unaffected).
+
+        Args:
+            mode: Mode of `torch.compile`.
+            dynamic: Whether to compile with dynamic shapes. For decoding
+                with `static_shapes=True`, `False` avoids any dynamic-shape
+                overhead, as shapes never change.
+        """
+        self._compiled_forward = torch.compile(
+            self.forward, mode=mode, dynamic=dynamic
+        )
 
     def forward(
         self,
         x: torch.Tensor,
         mask: Optional[torch.Tensor] = None,
+        kv_caches: Optional[List[KVCache]] = None,
+        pos_offset: int = 0,
+        num_logits: Optional[int] = None,
+        is_causal: bool = False,
+        targets: Optional[torch.Tensor] = None,
+        loss_chunk_size: Optional[int] = None,
+        padding_mask: Optional[torch.Tensor] = None,
+        cache_position: Optional[torch.Tensor] = None,
+        positions: Optional[torch.Tensor] = None,
+        return_hidden_states: bool = False,
+        return_extra_loss: bool = False,
     ) -> torch.Tensor:
         """
         Forward pass through the transformer model.
@@ -142,23 +291,185 @@ class Transformer(nn.Module):
         Args:
             x: Input tokens to decoder , shape: `(N, block_size)`.
             mask: Mask in shape `(block_size, block_size)`, prevent attending
-                to subsequent tokens.
+                to subsequent tokens. When decoding with `kv_caches`, the
+                mask has shape `(block_size, pos_offset + block_size)`.
+            kv_caches: Optional key/value caches (cf. `init_kv_caches`),
+                which are updated in-place with the keys and values of `x`.
+            pos_offset: Position of the first token in `x`, i.e. the number
+                of tokens already stored in `kv_caches`.
+            num_logits: If provided, the pre-softmax linear layer is only
+                applied to the hidden states of the last `num_logits`
+                positions (e.g. `1` when sampling the next token).
+            is_causal: Whether to prevent attending to subsequent tokens
+                without materializing a `mask`.
+            targets: Target tokens in shape `(N, block_size)`. If provided,
+                the mean cross-entropy loss is returned instead of logits.
+            loss_chunk_size: If provided (together with `targets`), the
+                logits are computed in chunks of `loss_chunk_size` positions
+                and never materialized for the whole sequence at once.
+            padding_mask: Mask of the cached tokens and `x` in shape
+                `(N, pos_offset + block_size)`, which is `1` for tokens and
+                `0` for (left) padding. If provided, padding is masked on top
+                of subsequent tokens (replacing `mask` and `is_causal`), and
+                the positions of each row start at its first token.
+            cache_position: Slots of `x` in the static caches (cf.
+                `init_static_kv_caches`) in shape `(block_size,)`. Then,
+                `padding_mask` covers all slots of the caches and is
+                required; `pos_offset` is ignored. For rolling caches (cf.
+                `RollingKVCache`), one slot per row in shape `(N,)`, which
+                requires `mask` and `positions` instead.
+            positions: Positions of the tokens of `x` in shape
+                `(N, block_size)`, replacing `pos_offset` (ignored if
+                `padding_mask` is provided).
+            return_hidden_states: Whether to also return the final hidden
+                states (of the positions the logits are returned for), e.g.
+                for the extra prediction heads.
+            return_extra_loss: Whether to also return the auxiliary loss of
+                the extra prediction heads (cf. `get_extra_heads_loss`),
+                if `targets` are provided.
 
         Returns:
-            Output tensor of shape `(N, block_size, vocab_size)`.
+            Output tensor of shape `(N, block_size, vocab_size)`, or
+            `(N, num_logits, vocab_size)` if `num_logits` is provided, or the
+            loss if `targets` are provided. Optionally, the hidden states or
+            the auxiliary loss are returned as well.
         """
 
+        if padding_mask is not None:
+            assert mask is None, "Please provide either `mask` or padding."
+            # positions of all tokens, not counting padding
+            positions = (padding_mask.long().cumsum(dim=-1) - 1).clamp(min=0)
+            if cache_position is not None:
+                mask = get_cache_mask(padding_mask, cache_position)
+                positions = positions[:, cache_position]
+                for kv_cache in kv_caches:
+                    kv_cache.cache_position = cache_position
+            else:
+                mask = get_padding_mask(padding_mask, size=x.shape[1])
+                positions = positions[:, -x.shape[1] :]
+            is_causal = False
+        elif cache_position is not None:
+            for kv_cache in kv_caches:
+                kv_cache.cache_position = cache_position
+
         # embedding and positional encoding for the decoder,
         # `(N, block_size, embed_dim)`
         x = math.sqrt(self.embed_dim) * self.embedding(x)
-        x = self.pos_encod(x)
+        x = self.pos_encod(x, offset=pos_offset, positions=positions)
         x = self.dropout(x)
 
         # forward pass through decoder and linear layer
-        x = self.decoder(x, mask=mask)
-        x = self.pre_softmax_linear(x)  # `(N, block_size, vocab_size)`
+        x = self.decoder(
+            x, mask=mask, kv_caches=kv_caches, is_causal=is_causal
+        )
+        if targets is not None:
+            loss = self.get_loss(
+                x,
+                linear=self.pre_softmax_linear,
+                targets=targets,
+                loss_chunk_size=loss_chunk_size,
+            )
+            if return_extra_loss:
+                return loss, self.get_extra_heads_loss(
+                    x, targets=targets, loss_chunk_size=loss_chunk_size
+                )
+            return loss
 
-        return x
+        if num_logits is not None:
+            x = x[:, -num_logits:]
+        logits = self.pre_softmax_linear(x)  # `(N, block_size, vocab_size)`
+
+        if return_hidden_states:
+            return logits, x
+        return logits
+
+    @staticmethod
+    def get_loss(
+        hidden: torch.Tensor,
+        linear: nn.Module,
+        targets: torch.Tensor,
+        loss_chunk_size: Optional[int] = None,
+    ) -> torch.Tensor:
+        """
+        Mean cross-entropy loss of the logits `linear(hidden)`.
+
+        Args:
+            hidden: Hidden states in shape `(N, T, embed_dim)`.
+            linear: Maps hidden states to logits.
+            targets: Target tokens in shape `(N, T)`.
+            loss_chunk_size: If provided, the logits are computed in chunks
+                of `loss_chunk_size` positions (cf. `chunked_cross_entropy`).
+
+        Returns:
+            Mean cross-entropy loss.
+        """
+        if loss_chunk_size is not None:
+            return chunked_cross_entropy(
+                hidden,
+                linear=linear,
+                targets=targets,
+                chunk_size=loss_chunk_size,
+            )
+
+        logits = linear(hidden)
+        return cross_entropy(
+            logits.reshape(-1, logits.shape[-1]), targets.reshape(-1)
+        )
+
+    def get_extra_heads_loss(
+        self,
+        hidden: torch.Tensor,
+        targets: torch.Tensor,
+        loss_chunk_size: Optional[int] = None,
+    ) -> torch.Tensor:
+        """
+        Auxiliary loss of the extra prediction heads: head `i` (`i >= 1`)
+        predicts the token `i + 1` positions ahead, i.e. the target `i`
+        positions after the next-token target.
+
+        Args:
+            hidden: Final hidden states in shape `(N, T, embed_dim)`.
+            targets: Next-token targets in shape `(N, T)`.
+            loss_chunk_size: If provided, the logits are computed in chunks
+                of `loss_chunk_size` positions.
+
+        Returns:
+            Mean cross-entropy loss over the extra heads (`0` without extra
+            heads).
+        """
+        losses = [
+            self.get_loss(
+                hidden[:, :-idx],
+                linear=lambda h, head=head: self.pre_softmax_linear(head(h)),
+                targets=targets[:, idx:],
+                loss_chunk_size=loss_chunk_size,
+            )
+            for idx, head in enumerate(self.extra_heads, start=1)
+            if idx < targets.shape[1]
+        ]
+        if not losses:
+            return hidden.new_zeros(())
+
+        return torch.stack(losses).mean()
+
+    def get_extra_heads_logits(self, hidden: torch.Tensor) -> torch.Tensor:
+        """
+        Logits of the extra prediction heads.
+
+        Args:
+            hidden: Final hidden states in shape `(..., embed_dim)`.
+
+        Returns:
+            Logits in shape `(..., num_extra_heads, vocab_size)`, where head
+            `i` predicts the token `i + 1` positions ahead.
+        """
+        return torch.stack(
+            [
+                self.pre_softmax_linear(head(hidden))
+                for head in self.extra_heads
+            ],
+            dim=-2,
+        )
 
     @torch.no_grad()
     def generate(
@@ -166,8 +477,18 @@ class Transformer(nn.Module):
         x: torch.Tensor,
         max_new_tokens: int,
         block_size: int,
-        temperature: float = 1.0,
-        top_k: Optional[int] = None,
+        temperature: Union[float, torch.Tensor] = 1.0,
+        top_k: Optional[Union[int, torch.Tensor]] = None,
+        sampler: Optional[Sampler] = None,
+        use_kv_cache: bool = True,
+        padding_mask: Optional[torch.Tensor] = None,
+        stop_tokens: Optional[List[int]] = None,
+        stop_sequences: Optional[List[List[int]]] = None,
+        max_lengths: Optional[torch.Tensor] = None,
+        static_shapes: bool = False,
+        bucket_size: int = 64,
+        rolling_kv_cache: bool = False,
+        num_sink_tokens: int = 4,
     ) -> torch.tensor:
         """
         Generate text using the transformer model.
@@ -175,34 +496,492 @@ class Transformer(nn.Module):
         Args:
             x: Input tokens to decoder, shape: `(N, T)`.
             max_new_tokens: Maximum number of tokens to generate.
+            block_size: Maximum context length for predictions.
             temperature: Temperature for sampling. For `temperature > 1`,
                 predictions will be more diverse, for `temperature < 1`,
-                predictions will be more conservative.
-            top_k: Top-k sampling.
+                predictions will be more conservative. Either a float or
+                one temperature per row in shape `(N,)`.
+            top_k: Top-k sampling. Either an int or one `k` per row in shape
+                `(N,)`.
+            sampler: Sampling pipeline (cf. `get_token_sampler`), e.g. with
+                top-p, min-p or repetition penalties. If provided,
+                `temperature` and `top_k` are ignored.
+            use_kv_cache: Whether to cache keys and values, such that after
+                encoding the prompt, only the newest token is processed in
+                each step. Once the context exceeds `block_size`, the
+                truncated window is re-encoded in every step (since the
+                positions of all tokens shift), as without the cache.
+            padding_mask: Mask of the prompts in shape `(N, T)`, which is `1`
+                for tokens and `0` for left padding, such that prompts of
+                different lengths are generated from in lockstep.
+            stop_tokens: Tokens after which a row is finished (e.g. the
+                end-of-text token), which are included in the output.
+            stop_sequences: Token sequences after whose generation a row is
+                finished, which are included in the output.
+            max_lengths: Maximum number of new tokens per row in shape
+                `(N,)`, at most `max_new_tokens`.
+            static_shapes: Whether to decode with shapes that never change
+                (cf. `_generate_static`), also beyond `block_size`, such that
+                a compiled decoding step (cf. `compile_decoding`) is reused
+                for every token. Stop conditions are not supported.
+            bucket_size: With `static_shapes`, prompts are left-padded to a
+                multiple of `bucket_size`, which bounds the number of
+                compiled prefill shapes.
+            rolling_kv_cache: Whether to keep decoding a single token per
+                step once the context exceeds `block_size`, instead of
+                re-encoding the truncated window: the caches are converted
+                to rolling caches of `block_size` slots (cf.
+                `RollingKVCache`), which keep the first `num_sink_tokens`
+                tokens of the window and the most recent ones, so that
+                memory and cost per token stay constant. Positions keep
+                increasing; before those of any row exceed
+                `max__seq_length`, the cached tokens of all rows are
+                re-encoded from position `0` (about once every
+                `max__seq_length - block_size` tokens).
+            num_sink_tokens: Number of pinned (attention sink) tokens of the
+                rolling caches.
 
         Returns:
-            Output tensor of shape `(N, T + max_new_tokens)`.
+            Output tensor of shape `(N, T + max_new_tokens)`. With stop
+            conditions, finished rows are dropped from the batch (so that
+            later steps only process unfinished rows) and right-padded with
+            `-1`; the output ends after the last generated token.
         """
-        for _ in range(max_new_tokens):
-            # truncate input if it exceeds the block size
-            x_cond = x if x.shape[1] <= block_size else x[:, -block_size:]
-            # generate mask
-            mask = get_subsequent_mask(size=x_cond.shape[1], rank=x.device)
-            # get model predictions for next token
-            logits = self(x_cond, mask=mask)
-            # get logits at last token in sequence and scale by temperature
-            logits = logits[:, -1, :] / temperature
-            # apply top-k sampling
-            if top_k is not None:
-                max_vals, _ = torch.topk(
-                    logits, k=min(top_k, logits.shape[-1]), dim=-1
+        max__seq_length = self.pos_encod.pos_encod.shape[1]
+        if rolling_kv_cache:
+            assert use_kv_cache, "Rolling caches require `use_kv_cache`."
+            assert 0 <= num_sink_tokens < block_size, (
+                f"`num_sink_tokens` is {num_sink_tokens}, must be in "
+                f"[0, {block_size})."
+            )
+            assert 2 * block_size <= max__seq_length, (
+                f"Rolling caches require `2 * block_size` ({2 * block_size}) "
+                f"to be at most `max__seq_length` ({max__seq_length})."
+            )
+
+        if static_shapes:
+            assert (
+                stop_tokens is None and stop_sequences is None
+            ), "Stop conditions are not supported with static shapes."
+            assert (
+                max_lengths is None
+            ), "Stop conditions are not supported with static shapes."
+            return self._generate_static(
+                x,
+                max_new_tokens=max_new_tokens,
+                block_size=block_size,
+                temperature=temperature,
+                top_k=top_k,
+                sampler=sampler,
+                padding_mask=padding_mask,
+                bucket_size=bucket_size,
+                rolling_kv_cache=rolling_kv_cache,
+                num_sink_tokens=num_sink_tokens,
+            )
+
+        forward = self._compiled_forward or self
+        kv_caches = self.init_kv_caches() if use_kv_cache else None
+        x_new = x  # tokens that have not been fed through the model yet
+        # with rolling caches: number of tokens written to them per row
+        # (i.e. the position of the next token), its maximum over the rows
+        # and the column of the first sink token of each row
+        num_rolling_tokens = None
+
+        if padding_mask is not None:
+            padding_mask = padding_mask.long()
+
+        if sampler is None:
+            sampler = get_token_sampler(
+                vocab_size=self.embedding.num_embeddings,
+                device=x.device,
+                temperature=temperature,
+                top_k=top_k,
+            )
+        sampler.init_token_counts(
+            x,
+            vocab_size=self.embedding.num_embeddings,
+            padding_mask=padding_mask,
+        )
+
+        # with stop conditions, the generated tokens are written to `output`
+        # and `row_ids` maps the rows of the (shrinking) batch to its rows
+        has_stop_conditions = (
+            stop_tokens is not None
+            or stop_sequences is not None
+            or max_lengths is not None
+        )
+        if has_stop_conditions:
+            N, T = x.shape
+            output = torch.full(
+                (N, T + max_new_tokens), -1, dtype=x.dtype, device=x.device
+            )
+            output[:, :T] = x
+            row_ids = torch.arange(N, device=x.device)
+            num_new_tokens = 0
+            if stop_tokens is not None:
+                stop_tokens = torch.tensor(stop_tokens, device=x.device)
+            stop_sequences = [
+                torch.tensor(stop_sequence, device=x.device)
+                for stop_sequence in stop_sequences or []
+            ]
+            if max_lengths is not None:
+                max_lengths = max_lengths.to(x.device)
+
+        for step in range(max_new_tokens):
+            if (
+                rolling_kv_cache
+                and num_rolling_tokens is None
+                and kv_caches[0].seq_length > 0
+                and kv_caches[0].seq_length + x_new.shape[1] > block_size
+            ):
+                # the window is full (it holds the tokens before `x_new`)
+                num_padding = (
+                    block_size
+                    - padding_mask[:, -(block_size + 1) : -1].sum(dim=-1)
+                    if padding_mask is not None
+                    else torch.zeros_like(x[:, 0])
+                )
+                kv_caches = [
+                    RollingKVCache.from_kv_cache(kv_cache, num_padding)
+                    for kv_cache in kv_caches
+                ]
+                num_rolling_tokens = block_size - num_padding
+                max__rolling_tokens = int(num_rolling_tokens.max())
+                sink_start = x.shape[1] - 1 - block_size + num_padding
+
+            if num_rolling_tokens is not None:
+                (
+                    logits,
+                    kv_caches,
+                    num_rolling_tokens,
+                    max__rolling_tokens,
+                ) = self._rolling_forward(
+                    forward,
+                    x,
+                    kv_caches=kv_caches,
+                    num_rolling_tokens=num_rolling_tokens,
+                    max__rolling_tokens=max__rolling_tokens,
+                    sink_start=sink_start,
+                    block_size=block_size,
+                    num_sink_tokens=num_sink_tokens,
                 )
-                logits[logits < max_vals[:, [-1]]] = float("-inf")
-            # convert logits to probabilities
-            probs = nn.Softmax(dim=-1)(logits)
-            # sample from distribution
-            next_token = torch.multinomial(probs, num_samples=1)
+            else:
+                if (
+                    kv_caches is None
+                    or kv_caches[0].seq_length + x_new.shape[1] > block_size
+                ):
+                    # truncate input if it exceeds the block size
+                    x_cond = (
+                        x if x.shape[1] <= block_size else x[:, -block_size:]
+                    )
+                    if kv_caches is not None and kv_caches[0].seq_length > 0:
+                        kv_caches = self.init_kv_caches()
+                else:
+                    x_cond = x_new
+                pos_offset = (
+                    0 if kv_caches is None else kv_caches[0].seq_length
+                )
+                # get model predictions for next token
+                logits = forward(
+                    x_cond,
+                    kv_caches=kv_caches,
+                    pos_offset=pos_offset,
+                    num_logits=1,
+                    is_causal=padding_mask is None,
+                    padding_mask=(
+                        padding_mask[:, -(pos_offset + x_cond.shape[1]) :]
+                        if padding_mask is not None
+                        else None
+                    ),
+                )
+            # sample from logits at last token in sequence
+            next_token = sampler(logits[:, -1, :])
             # append new token to sequence
             x = torch.cat([x, next_token], dim=-1)
+            x_new = next_token
+            if padding_mask is not None:
+                padding_mask = torch.cat(
+                    [padding_mask, torch.ones_like(next_token)], dim=-1
+                )
+            if not has_stop_conditions:
+                continue
+
+            output[row_ids, T + step] = next_token.squeeze(-1)
+            num_new_tokens = step + 1
+
+            finished = torch.zeros_like(row_ids, dtype=torch.bool)
+            if stop_tokens is not None:
+                finished |= torch.isin(next_token.squeeze(-1), stop_tokens)
+            for stop_sequence in stop_sequences:
+                if num_new_tokens >= len(stop_sequence):
+                    finished |= (
+                        x[:, -len(stop_sequence) :] == stop_sequence
+                    ).all(dim=-1)
+            if max_lengths is not None:
+                finished |= max_lengths <= num_new_tokens
+
+            # drop finished rows (this synchronizes with the device)
+            if finished.any():
+                keep = (~finished).nonzero().squeeze(-1)
+                if keep.numel() == 0:
+                    break
+                x, x_new, row_ids = x[keep], x_new[keep], row_ids[keep]
+                if padding_mask is not None:
+                    padding_mask = padding_mask[keep]
+                sampler.reorder(keep)
+                if max_lengths is not None:
+                    max_lengths = max_lengths[keep]
+                if kv_caches is not None:
+                    for kv_cache in kv_caches:
+                        kv_cache.reorder(keep)
+                if num_rolling_tokens is not None:
+                    num_rolling_tokens = num_rolling_tokens[keep]
+                    sink_start = sink_start[keep]
+
+        if has_stop_conditions:
+            return output[:, : T + num_new_tokens]
 
         return x
+
+    def _rolling_forward(
+        self,
+        forward: Callable,
+        x: torch.Tensor,
+        kv_caches: List[RollingKVCache],
+        num_rolling_tokens: torch.Tensor,
+        max__rolling_tokens: int,
+        sink_start: torch.Tensor,
+        block_size: int,
+        num_sink_tokens: int,
+    ) -> Tuple[torch.Tensor, List[RollingKVCache], torch.Tensor, int]:
+        """
+        Process the newest token of each row with rolling caches (cf.
+        `generate`). Before the positions of any row exceed
+        `max__seq_length`, the sink tokens and the most recent tokens of all
+        rows are re-encoded from position `0` instead.
+
+        Args:
+            forward: Forward pass of the model.
+            x: Tokens in shape `(N, T)`, the last of which are new.
+            kv_caches: Rolling caches of `block_size` slots.
+            num_rolling_tokens: Number of tokens written to the caches so far
+                per row (i.e. the position of the new token) in shape `(N,)`.
+            max__rolling_tokens: Maximum of `num_rolling_tokens`.
+            sink_start: Column of the first sink token of each row in `x` in
+                shape `(N,)`.
+            block_size: Maximum context length for predictions.
+            num_sink_tokens: Number of pinned (attention sink) tokens.
+
+        Returns:
+            Logits of the new tokens in shape `(N, 1, vocab_size)`, the
+            (possibly new) caches, and the updated `num_rolling_tokens` and
+            `max__rolling_tokens`.
+        """
+        if max__rolling_tokens < self.pos_encod.pos_encod.shape[1]:
+            logits = forward(
+                x[:, -1:],
+                mask=get_rolling_mask(num_rolling_tokens, block_size),
+                kv_caches=kv_caches,
+                num_logits=1,
+                cache_position=get_rolling_cache_position(
+                    num_rolling_tokens,
+                    max_length=block_size,
+                    num_sink_tokens=num_sink_tokens,
+                ),
+                positions=num_rolling_tokens.unsqueeze(-1),
+            )
+            return (
+                logits,
+                kv_caches,
+                num_rolling_tokens + 1,
+                max__rolling_tokens + 1,
+            )
+
+        # re-encode the sink tokens and the most recent tokens from position
+        # `0` (all rows have more than `block_size` tokens by now)
+        sink_idx = sink_start.unsqueeze(-1) + torch.arange(
+            num_sink_tokens, device=x.device
+        )
+        x_cond = torch.cat(
+            [
+                x.gather(1, sink_idx),
+                x[:, x.shape[1] - (block_size - num_sink_tokens) :],
+            ],
+            dim=-1,
+        )
+        kv_caches = self.init_kv_caches()
+        logits = forward(
+            x_cond,
+            kv_caches=kv_caches,
+            num_logits=1,
+            is_causal=True,
+        )
+        kv_caches = [
+            RollingKVCache.from_kv_cache(kv_cache, torch.zeros_like(x[:, 0]))
+            for kv_cache in kv_caches
+        ]
+
+        return (
+            logits,
+            kv_caches,
+            torch.full_like(x[:, 0], block_size),
+            block_size,
+        )
+
+    def _generate_static(
+        self,
+        x: torch.Tensor,
+        max_new_tokens: int,
+        block_size: int,
+        temperature: Union[float, torch.Tensor] = 1.0,
+        top_k: Optional[Union[int, torch.Tensor]] = None,
+        sampler: Optional[Sampler] = None,
+        padding_mask: Optional[torch.Tensor] = None,
+        bucket_size: int = 64,
+        rolling_kv_cache: bool = False,
+        num_sink_tokens: int = 4,
+    ) -> torch.Tensor:
+        """
+        Generate with static shapes: the output tokens and the key/value
+        caches (of `block_size` slots) are preallocated, the prompts are
+        left-padded to a multiple of `bucket_size` and every decoding step
+        processes a single token per row, so that neither the shapes of the
+        inputs nor those of the caches change between steps. Once the slots
+        are full, the context window slides as in `generate`, which keeps
+        the shapes static as well: either the last `block_size` tokens are
+        re-encoded in every step, or the caches are converted to rolling
+        caches of `block_size` slots (cf. `RollingKVCache`).
+
+        Args:
+            x: Input tokens to decoder, shape: `(N, T)`.
+            max_new_tokens: Maximum number of tokens to generate.
+            block_size: Maximum context length for predictions.
+            temperature: Temperature for sampling, cf. `generate`.
+            top_k: Top-k sampling, cf. `generate`.
+            sampler: Sampling pipeline, cf. `generate`.
+            padding_mask: Mask of the prompts in shape `(N, T)`, cf.
+                `generate`.
+            bucket_size: Prompts are left-padded to a multiple of
+                `bucket_size` (at most `block_size`).
+            rolling_kv_cache: Whether to continue with rolling caches once
+                the slots are full, cf. `generate`.
+            num_sink_tokens: Number of pinned (attention sink) tokens of the
+                rolling caches.
+
+        Returns:
+            Output tensor of shape `(N, T + max_new_tokens)`.
+        """
+        N, T = x.shape
+        forward = self._compiled_forward or self
+        if sampler is None:
+            sampler = get_token_sampler(
+                vocab_size=self.embedding.num_embeddings,
+                device=x.device,
+                temperature=temperature,
+                top_k=top_k,
+            )
+        sampler.init_token_counts(
+            x,
+            vocab_size=self.embedding.num_embeddings,
+            padding_mask=padding_mask,
+        )
+
+        # as in `generate`, only the last `block_size` tokens of the prompts
+        # are encoded
+        prompts = x
+        if T > block_size:
+            x = x[:, -block_size:]
+            if padding_mask is not None:
+                padding_mask = padding_mask[:, -block_size:]
+        T_x = x.shape[1]
+        T_bucket = min(bucket_size * math.ceil(T_x / bucket_size), block_size)
+
+        # preallocated output tokens and their padding mask, whose first
+        # `block_size` columns correspond to the slots of the caches
+        tokens = torch.zeros(
+            N,
+            max(T_bucket + max_new_tokens, block_size),
+            dtype=x.dtype,
+            device=x.device,
+        )
+        tokens[:, T_bucket - T_x : T_bucket] = x
+        token_mask = torch.ones_like(tokens)
+        token_mask[:, : T_bucket - T_x] = 0
+        if padding_mask is not None:
+            token_mask[:, T_bucket - T_x : T_bucket] = padding_mask
+        slot_mask = token_mask[:, :block_size]
+        kv_caches = self.init_static_kv_caches(
+            batch_size=N, max_length=block_size
+        )
+        # with rolling caches: number of tokens written to them per row, its
+        # maximum over the rows and the column of the first sink token of
+        # each row (cf. `generate`)
+        num_rolling_tokens = None
+
+        # encode (bucketed) prompts
+        logits = forward(
+            tokens[:, :T_bucket],
+            kv_caches=kv_caches,
+            num_logits=1,
+            padding_mask=slot_mask,
+            cache_position=torch.arange(T_bucket, device=x.device),
+        )
+        for step in range(max_new_tokens):
+            next_token = sampler(logits[:, -1, :])
+            tokens[:, T_bucket + step] = next_token.squeeze(-1)
+            if step == max_new_tokens - 1:
+                break
+
+            length = T_bucket + step + 1  # number of tokens so far
+            if length <= block_size:
+                # decode a single token per row
+                logits = forward(
+                    next_token,
+                    kv_caches=kv_caches,
+                    num_logits=1,
+                    padding_mask=slot_mask,
+                    cache_position=torch.tensor(
+                        [T_bucket + step], device=x.device
+                    ),
+                )
+            elif rolling_kv_cache:
+                if num_rolling_tokens is None:
+                    # the slots are full, all padding precedes the tokens
+                    num_padding = block_size - slot_mask.sum(dim=-1)
+                    kv_caches = [
+                        RollingKVCache.from_kv_cache(kv_cache, num_padding)
+                        for kv_cache in kv_caches
+                    ]
+                    num_rolling_tokens = block_size - num_padding
+                    max__rolling_tokens = int(num_rolling_tokens.max())
+                    sink_start = num_padding
+                (
+                    logits,
+                    kv_caches,
+                    num_rolling_tokens,
+                    max__rolling_tokens,
+                ) = self._rolling_forward(
+                    forward,
+                    tokens[:, :length],
+                    kv_caches=kv_caches,
+                    num_rolling_tokens=num_rolling_tokens,
+                    max__rolling_tokens=max__rolling_tokens,
+                    sink_start=sink_start,
+                    block_size=block_size,
+                    num_sink_tokens=num_sink_tokens,
+                )
+            else:
+                # re-encode the last `block_size` tokens
+                logits = forward(
+                    tokens[:, length - block_size : length],
+                    num_logits=1,
+                    padding_mask=token_mask[:, length - block_size : length],
+                )
+
+        return torch.cat(
+            [
+                prompts[:, : T - T_x],
+                tokens[:, T_bucket - T_x : T_bucket + max_new_tokens],
+            ],
+            dim=-1,
+        )
@@ -0,0 +1,477 @@
+import math
+from typing import List, Optional, Tuple, Union
+
+import torch
+
+
+def _per_row(
+    value: Union[float, torch.Tensor], device: torch.device
+) -> Union[float, torch.Tensor]:
+    """
+    Bring a sampling parameter into a shape that broadcasts against logits of
+    shape `(N, vocab_size)`.
+
+    Args:
+        value: Either a float (shared by all rows) or one value per row in
+            shape `(N,)`.
+        device: Device of the logits.
+
+    Returns:
+        The float, or the values per row in shape `(N, 1)`.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.to(device=device, dtype=torch.float).unsqueeze(-1)
+    return value
+
+
+class LogitsProcessor:
+    """
+    Base class of the steps of the sampling pipeline, which modify logits of
+    shape `(N, vocab_size)`. Parameters can be shared by all rows or given
+    per row; the latter are reordered along with the batch (cf. `reorder`).
+    All steps avoid synchronizing with the device.
+    """
+
+    # whether `__call__` reads the counts of the tokens of each row
+    uses_token_counts = False
+
+    def __call__(
+        self, logits: torch.Tensor, token_counts: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        """
+        Modify the logits.
+
+        Args:
+            logits: Logits of the next token in shape `(N, vocab_size)`.
+            token_counts: Number of occurrences of every token in each row
+                (prompt and generated tokens) in shape `(N, vocab_size)`, if
+                any processor uses them.
+
+        Returns:
+            Modified logits in shape `(N, vocab_size)`.
+        """
+        raise NotImplementedError
+
+    def reorder(self, indices: torch.Tensor) -> None:
+        """
+        Select (and reorder) the rows of the parameters given per row.
+
+        Args:
+            indices: Indices of the rows to keep.
+        """
+        for name, value in vars(self).items():
+            if isinstance(value, torch.Tensor):
+                setattr(self, name, value[indices])
+
+
+class PenaltyProcessor(LogitsProcessor):
+    """
+    Penalize tokens that already occur in a row: the repetition penalty of
+    [Keskar et al., 2019] divides positive logits (and multiplies negative
+    ones) by `repetition_penalty`, the frequency penalty subtracts
+    `frequency_penalty` times the number of occurrences and the presence
+    penalty subtracts `presence_penalty` once.
+    """
+
+    uses_token_counts = True
+
+    def __init__(
+        self,
+        device: torch.device,
+        repetition_penalty: Optional[Union[float, torch.Tensor]] = None,
+        frequency_penalty: Optional[Union[float, torch.Tensor]] = None,
+        presence_penalty: Optional[Union[float, torch.Tensor]] = None,
+    ) -> None:
+        self.repetition_penalty = (
+            _per_row(repetition_penalty, device)
+            if repetition_penalty is not None
+            else None
+        )
+        self.frequency_penalty = (
+            _per_row(frequency_penalty, device)
+            if frequency_penalty is not None
+            else None
+        )
+        self.presence_penalty = (
+            _per_row(presence_penalty, device)
+            if presence_penalty is not None
+            else None
+        )
+
+    def __call__(
+        self, logits: torch.Tensor, token_counts: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        occurs = token_counts > 0
+        if self.repetition_penalty is not None:
+            penalized = torch.where(
+                logits > 0,
+                logits / self.repetition_penalty,
+                logits * self.repetition_penalty,
+            )
+            logits = torch.where(occurs, penalized, logits)
+        if self.frequency_penalty is not None:
+            logits = logits - self.frequency_penalty * token_counts
+        if self.presence_penalty is not None:
+            logits = logits - self.presence_penalty * occurs
+
+        return logits
+
+
+class TemperatureProcessor(LogitsProcessor):
+    """
+    Divide the logits by the temperature. For `temperature > 1`, predictions
+    will be more diverse, for `temperature < 1`, predictions will be more
+    conservative.
+    """
+
+    def __init__(
+        self, temperature: Union[float, torch.Tensor], device: torch.device
+    ) -> None:
+        self.temperature = _per_row(temperature, device)
+
+    def __call__(
+        self, logits: torch.Tensor, token_counts: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        return logits / self.temperature
+
+
+class TopKProcessor(LogitsProcessor):
+    """
+    Keep the `top_k` largest logits of each row. When sampling, the following
+    processors only see these candidates (cf. `select`).
+    """
+
+    def __init__(
+        self,
+        top_k: Union[int, torch.Tensor],
+        vocab_size: int,
+        device: torch.device,
+    ) -> None:
+        if isinstance(top_k, torch.Tensor):
+            top_k = top_k.to(device).clamp(min=1, max=vocab_size)
+            # read back once, instead of in every step
+            self.max_top_k = int(top_k.max())
+            self.top_k = top_k.unsqueeze(-1) - 1  # index of the k-th value
+        else:
+            self.max_top_k = min(top_k, vocab_size)
+            self.top_k = None
+
+    def __call__(
+        self, logits: torch.Tensor, token_counts: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        max_vals, _ = torch.topk(logits, k=self.max_top_k, dim=-1)
+        if self.top_k is not None:
+            # (a single row of parameters is shared by all rows of logits)
+            kth_vals = max_vals.gather(
+                dim=-1, index=self.top_k.expand(logits.shape[0], -1)
+            )
+        else:
+            kth_vals = max_vals[:, -1:]
+
+        return logits.masked_fill(logits < kth_vals, float("-inf"))
+
+    def select(
+        self, logits: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Restrict the logits to the top-k candidates, such that the rest of
+        the pipeline (and sampling) handles `max_top_k` instead of
+        `vocab_size` logits per row.
+
+        Args:
+            logits: Logits of the next token in shape `(N, vocab_size)`.
+
+        Returns:
+            Logits of the candidates (sorted, `-inf` beyond the `top_k` of a
+            row) and their tokens, both in shape `(N, max_top_k)`.
+        """
+        candidate_logits, candidate_ids = torch.topk(
+            logits, k=self.max_top_k, dim=-1
+        )
+        if self.top_k is not None:
+            candidate_logits = candidate_logits.masked_fill(
+                torch.arange(self.max_top_k, device=logits.device)
+                > self.top_k,
+                float("-inf"),
+            )
+
+        return candidate_logits, candidate_ids
+
+
+class TopPProcessor(LogitsProcessor):
+    """
+    Nucleus sampling [Holtzman et al., 2019]: keep the smallest set of
+    largest logits whose probabilities sum to at least `top_p`. If at most
+    `max_candidates` logits are finite (i.e. after top-k sampling), only
+    these are sorted instead of the whole vocabulary.
+    """
+
+    def __init__(
+        self,
+        top_p: Union[float, torch.Tensor],
+        device: torch.device,
+        max_candidates: Optional[int] = None,
+    ) -> None:
+        self.top_p = _per_row(top_p, device)
+        self.max_candidates = max_candidates
+
+    def __call__(
+        self, logits: torch.Tensor, token_counts: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        if self.max_candidates is not None:
+            sorted_logits, _ = torch.topk(
+                logits, k=self.max_candidates, dim=-1
+            )
+        else:
+            sorted_logits, _ = torch.sort(logits, dim=-1, descending=True)
+        # (the logits that were not sorted are `-inf`)
+        sorted_probs = torch.softmax(sorted_logits.float(), dim=-1)
+        # a logit is kept if the probabilities before it sum to < `top_p`
+        # (so the largest one is always kept)
+        num_kept = (
+            (sorted_probs.cumsum(dim=-1) - sorted_probs < self.top_p)
+            .sum(dim=-1, keepdim=True)
+            .clamp(min=1)
+        )
+        min_kept = sorted_logits.gather(dim=-1, index=num_kept - 1)
+
+        return logits.masked_fill(logits < min_kept, float("-inf"))
+
+
+class MinPProcessor(LogitsProcessor):
+    """
+    Min-p sampling [Nguyen et al., 2024]: keep the tokens whose probability
+    is at least `min_p` times the probability of the most likely token, i.e.
+    whose logit is at least `log(min_p)` below the largest one.
+    """
+
+    def __init__(
+        self, min_p: Union[float, torch.Tensor], device: torch.device
+    ) -> None:
+        min_p = _per_row(min_p, device)
+        self.log_min_p = (
+            min_p.log() if isinstance(min_p, torch.Tensor) else math.log(min_p)
+        )
+
+    def __call__(
+        self, logits: torch.Tensor, token_counts: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        max_logits = logits.max(dim=-1, keepdim=True).values
+        return logits.masked_fill(
+            logits < max_logits + self.log_min_p, float("-inf")
+        )
+
+
+class Sampler:
+    """
+    Sample the next token of a batch of rows after applying a chain of
+    logits processors. The number of occurrences of every token in each row
+    is tracked on the device if a processor uses them.
+    """
+
+    def __init__(
+        self,
+        processors: List[LogitsProcessor],
+        gumbel: bool = False,
+    ) -> None:
+        """
+        Initialize the sampler.
+
+        Args:
+            processors: Processors, applied in the given order.
+            gumbel: Whether to sample via the Gumbel-max trick, i.e. take the
+                `argmax` of the logits perturbed with Gumbel noise, instead
+                of computing the probabilities and drawing from a
+                multinomial distribution.
+        """
+        self.processors = processors
+        self.gumbel = gumbel
+        self.token_counts: Optional[torch.Tensor] = None
+
+    @property
+    def uses_token_counts(self) -> bool:
+        return any(
+            processor.uses_token_counts for processor in self.processors
+        )
+
+    @property
+    def num_rows(self) -> Optional[int]:
+        """
+        Number of rows of the parameters given per row, or `None` if all
+        parameters are shared by all rows.
+        """
+        for processor in self.processors:
+            for value in vars(processor).values():
+                if isinstance(value, torch.Tensor):
+                    return value.shape[0]
+        return None
+
+    def init_token_counts(
+        self,
+        x: torch.Tensor,
+        vocab_size: int,
+        padding_mask: Optional[torch.Tensor] = None,
+    ) -> None:
+        """
+        Count the tokens of the prompts, if a processor uses the counts.
+
+        Args:
+            x: Prompts in shape `(N, T)`.
+            vocab_size: Vocabulary size.
+            padding_mask: Mask of the prompts in shape `(N, T)`, which is `0`
+                for (uncounted) left padding.
+        """
+        if not self.uses_token_counts:
+            return
+
+        self.token_counts = torch.zeros(
+            x.shape[0], vocab_size, dtype=torch.float, device=x.device
+        )
+        self.token_counts.scatter_add_(
+            dim=-1,
+            index=x,
+            src=(
+                padding_mask.float()
+                if padding_mask is not None
+                else torch.ones_like(x, dtype=torch.float)
+            ),
+        )
+
+    def process(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        Apply the processors to the logits of the whole vocabulary.
+
+        Args:
+            logits: Logits of the next token in shape `(N, vocab_size)`.
+
+        Returns:
+            Processed logits in shape `(N, vocab_size)`.
+        """
+        for processor in self.processors:
+            logits = processor(logits, self.token_counts)
+        return logits
+
+    def __call__(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        Sample the next token and count it. After top-k sampling, only the
+        candidates are processed further and sampled from, instead of the
+        whole vocabulary.
+
+        Args:
+            logits: Logits of the next token in shape `(N, vocab_size)`.
+
+        Returns:
+            Next tokens in shape `(N, 1)`.
+        """
+        token_counts, candidate_ids = self.token_counts, None
+        for processor in self.processors:
+            if isinstance(processor, TopKProcessor):
+                logits, candidate_ids = processor.select(logits)
+                if token_counts is not None:
+                    token_counts = token_counts.gather(-1, candidate_ids)
+            else:
+                logits = processor(logits, token_counts)
+
+        if self.gumbel:
+            # `-log(E)` with `E ~ Exp(1)` is Gumbel distributed
+            noise = torch.empty_like(logits).exponential_().log()
+            next_token = (logits - noise).argmax(dim=-1, keepdim=True)
+        else:
+            probs = torch.softmax(logits, dim=-1)
+            next_token = torch.multinomial(probs, num_samples=1)
+        if candidate_ids is not None:
+            next_token = candidate_ids.gather(-1, next_token)
+
+        self.update(next_token)
+        return next_token
+
+    def update(self, tokens: torch.Tensor) -> None:
+        """
+        Count new tokens.
+
+        Args:
+            tokens: New tokens in shape `(N, num_tokens)`.
+        """
+        if self.token_counts is not None:
+            self.token_counts.scatter_add_(
+                dim=-1,
+                index=tokens,
+                src=torch.ones_like(tokens, dtype=torch.float),
+            )
+
+    def reorder(self, indices: torch.Tensor) -> None:
+        """
+        Select (and reorder) the rows of the token counts and of the
+        parameters given per row, e.g. when finished rows are dropped.
+
+        Args:
+            indices: Indices of the rows to keep.
+        """
+        if self.token_counts is not None:
+            self.token_counts = self.token_counts[indices]
+        for processor in self.processors:
+            processor.reorder(indices)
+
+
+def get_token_sampler(
+    vocab_size: int,
+    device: torch.device,
+    temperature: Union[float, torch.Tensor] = 1.0,
+    top_k: Optional[Union[int, torch.Tensor]] = None,
+    top_p: Optional[Union[float, torch.Tensor]] = None,
+    min_p: Optional[Union[float, torch.Tensor]] = None,
+    repetition_penalty: Optional[Union[float, torch.Tensor]] = None,
+    frequency_penalty: Optional[Union[float, torch.Tensor]] = None,
+    presence_penalty: Optional[Union[float, torch.Tensor]] = None,
+    gumbel: bool = False,
+) -> Sampler:
+    """
+    Build the sampling pipeline: penalties, temperature, top-k, top-p and
+    min-p (each only if given). Every parameter is either shared by all rows
+    or given per row in shape `(N,)`.
+
+    Args:
+        vocab_size: Vocabulary size.
+        device: Device of the logits.
+        temperature: Temperature for sampling.
+        top_k: Top-k sampling.
+        top_p: Top-p (nucleus) sampling.
+        min_p: Min-p sampling.
+        repetition_penalty: Repetition penalty (`1` means no penalty).
+        frequency_penalty: Frequency penalty (`0` means no penalty).
+        presence_penalty: Presence penalty (`0` means no penalty).
+        gumbel: Whether to sample via the Gumbel-max trick.
+
+    Returns:
+        Sampler.
+    """
+    processors = []
+    if (
+        repetition_penalty is not None
+        or frequency_penalty is not None
+        or presence_penalty is not None
+    ):
+        processors.append(
+            PenaltyProcessor(
+                device=device,
+                repetition_penalty=repetition_penalty,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+            )
+        )
+    if isinstance(temperature, torch.Tensor) or temperature != 1.0:
+        processors.append(TemperatureProcessor(temperature, device=device))
+    max_candidates = None
+    if top_k is not None:
+        processors.append(
+            TopKProcessor(top_k, vocab_size=vocab_size, device=device)
+        )
+        max_candidates = processors[-1].max_top_k
+    if top_p is not None:
+        processors.append(
+            TopPProcessor(top_p, device=device, max_candidates=max_candidates)
+        )
+    if min_p is not None:
+        processors.append(MinPProcessor(min_p, device=device))
+
+    return Sampler(processors, gumbel=gumbel)
@@ -0,0 +1,761 @@
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+from torch import nn
+from torch.nn.functional import one_hot
+
+from .attention import (
+    RollingKVCache,
+    get_rolling_cache_position,
+    get_rolling_window_mask,
+)
+from .sampling import Sampler, get_token_sampler
+
+
+class CachedDecoder:
+    """
+    Feed a growing sequence (of a single row) through a model, matching the
+    context of `Transformer.generate`: the logits of a position whose prefix
+    fits into `block_size` tokens are computed incrementally with key/value
+    caches (processing only the tokens that are not cached yet), and cached
+    tokens can be dropped again (cf. `crop`), e.g. rejected draft tokens.
+    The logits of a position with a longer prefix are computed from its last
+    `block_size` tokens, re-encoded from position `0` as in
+    `Transformer.generate`; the windows of several such positions are
+    encoded in a single batch.
+    """
+
+    def __init__(self, model: nn.Module, block_size: int) -> None:
+        """
+        Initialize the decoder.
+
+        Args:
+            model: Transformer (not wrapped). Its compiled forward pass is
+                used if available (cf. `Transformer.compile_decoding`).
+            block_size: Maximum context length for predictions.
+        """
+        self.forward = model._compiled_forward or model
+        self.block_size = block_size
+        # caches of (a prefix of) the first `block_size` tokens
+        self.kv_caches = model.init_kv_caches()
+
+    def __call__(
+        self,
+        x: torch.Tensor,
+        num_logits: int,
+        return_hidden_states: bool = False,
+    ) -> torch.Tensor:
+        """
+        Compute the logits of the last `num_logits` positions of `x`.
+
+        Args:
+            x: Whole sequence in shape `(1, T)`, of which the tokens
+                processed before are a prefix.
+            num_logits: Number of (last) positions to return logits for, at
+                most the number of new tokens.
+            return_hidden_states: Whether to also return the final hidden
+                states of these positions.
+
+        Returns:
+            Logits in shape `(1, num_logits, vocab_size)` (and the hidden
+            states in shape `(1, num_logits, embed_dim)`).
+        """
+        T = x.shape[1]
+        # number of positions whose prefix fits into the block size
+        num_cached_logits = min(
+            max(self.block_size - T + num_logits, 0), num_logits
+        )
+
+        outputs = []
+        if num_cached_logits > 0:
+            end = T - num_logits + num_cached_logits
+            pos_offset = self.kv_caches[0].seq_length
+            outputs.append(
+                self.forward(
+                    x[:, pos_offset:end],
+                    kv_caches=self.kv_caches,
+                    pos_offset=pos_offset,
+                    num_logits=num_cached_logits,
+                    is_causal=True,
+                    return_hidden_states=return_hidden_states,
+                )
+            )
+        if num_cached_logits < num_logits:
+            # one window of the last `block_size` tokens per position
+            windows = x[0].unfold(0, self.block_size, 1)
+            windows = windows[
+                windows.shape[0] - num_logits + num_cached_logits :
+            ]
+            output = self.forward(
+                windows,
+                num_logits=1,
+                is_causal=True,
+                return_hidden_states=return_hidden_states,
+            )
+            outputs.append(
+                tuple(tensor.transpose(0, 1) for tensor in output)
+                if return_hidden_states
+                else output.transpose(0, 1)
+            )
+
+        if len(outputs) == 1:
+            return outputs[0]
+        if return_hidden_states:
+            return tuple(
+                torch.cat(tensors, dim=1) for tensors in zip(*outputs)
+            )
+        return torch.cat(outputs, dim=1)
+
+    def crop(self, length: int) -> None:
+        """
+        Keep only the first `length` tokens of the sequence in the caches.
+
+        Args:
+            length: Number of leading tokens of the sequence to keep.
+        """
+        for kv_cache in self.kv_caches:
+            kv_cache.crop(length)
+
+
+class RollingDecoder:
+    """
+    Feed a growing sequence (of a single row) through a model with rolling
+    key/value caches of `block_size` slots (cf. `RollingKVCache`), matching
+    the context of `Transformer.generate` with `rolling_kv_cache=True`:
+    every new token is processed incrementally, also beyond `block_size`,
+    such that verifying (or drafting) a token costs the same at any length
+    of the sequence. New tokens are kept pending until `crop` writes the
+    kept ones into the slots, since a rejected draft token must not
+    overwrite a slot; each token attends to the slots and pending tokens
+    that the caches would hold once it is written (cf.
+    `get_rolling_window_mask`).
+    """
+
+    def __init__(
+        self, model: nn.Module, block_size: int, num_sink_tokens: int
+    ) -> None:
+        """
+        Initialize the decoder.
+
+        Args:
+            model: Transformer (not wrapped). Its compiled forward pass is
+                used if available (cf. `Transformer.compile_decoding`).
+            block_size: Maximum context length for predictions, i.e. the
+                number of slots per cache.
+            num_sink_tokens: Number of pinned (attention sink) tokens.
+        """
+        self.model = model
+        self.forward = model._compiled_forward or model
+        self.block_size = block_size
+        self.num_sink_tokens = num_sink_tokens
+        self.max__seq_length = model.pos_encod.pos_encod.shape[1]
+
+        # index of the first sink token in the sequence (set by the first
+        # call) and number of leading tokens of the sequence that are
+        # processed (including the pending ones)
+        self.sink_start: Optional[int] = None
+        self.seq_length = 0
+        self._init_state(pos_offset=0)
+        # state before re-encoding, until the token that triggered it is
+        # kept (cf. `crop`), and the index of that token
+        self._prev_state: Optional[Tuple] = None
+        self._reencode_idx: Optional[int] = None
+
+    def _init_state(self, pos_offset: int) -> None:
+        """
+        Create empty caches.
+
+        Args:
+            pos_offset: Position of token `i` of the sequence (except for the
+                sink tokens) is `i - pos_offset`.
+        """
+        self.kv_caches = [
+            RollingKVCache(kv_cache.k, kv_cache.v)
+            for kv_cache in self.model.init_static_kv_caches(
+                batch_size=1, max_length=self.block_size
+            )
+        ]
+        device = self.kv_caches[0].k.device
+        # position of the token in each slot (beyond any position if empty)
+        self.slot_positions = torch.full(
+            (self.block_size,), torch.iinfo(torch.long).max, device=device
+        )
+        # positions and indices in the sequence of the pending tokens
+        self.pending_positions = torch.empty(
+            0, dtype=torch.long, device=device
+        )
+        self.pending_idx: List[int] = []
+        self.pos_offset = pos_offset
+
+    def _get_state(self) -> Tuple:
+        return (
+            self.kv_caches,
+            self.slot_positions,
+            self.pending_positions,
+            self.pending_idx,
+            self.pos_offset,
+        )
+
+    def _set_state(self, state: Tuple) -> None:
+        (
+            self.kv_caches,
+            self.slot_positions,
+            self.pending_positions,
+            self.pending_idx,
+            self.pos_offset,
+        ) = state
+
+    def __call__(
+        self,
+        x: torch.Tensor,
+        num_logits: int,
+        return_hidden_states: bool = False,
+    ) -> torch.Tensor:
+        """
+        Compute the logits of the last `num_logits` positions of `x`.
+
+        Args:
+            x: Whole sequence in shape `(1, T)`, of which the tokens
+                processed before are a prefix.
+            num_logits: Number of (last) positions to return logits for, at
+                most the number of new tokens.
+            return_hidden_states: Whether to also return the final hidden
+                states of these positions.
+
+        Returns:
+            Logits in shape `(1, num_logits, vocab_size)` (and the hidden
+            states in shape `(1, num_logits, embed_dim)`).
+        """
+        T = x.shape[1]
+        if self.sink_start is None:
+            # as in `generate`, the first window ends with the first position
+            # to predict from
+            self.sink_start = max(T - num_logits + 1 - self.block_size, 0)
+            self.seq_length = self.pos_offset = self.sink_start
+
+        # as in `generate`, the token that would exceed `max__seq_length` is
+        # re-encoded together with the sink tokens and the tokens before it
+        reencode_idx = self.pos_offset + self.max__seq_length
+        num_reencoded = max(T - reencode_idx, 0)
+
+        outputs = []
+        if self.seq_length < T - num_reencoded:
+            # (also the tokens before `reencode_idx` whose logits are not
+            # needed, since the current caches are kept if it is rejected)
+            output = self._feed(
+                x[:, self.seq_length : T - num_reencoded],
+                idx=list(range(self.seq_length, T - num_reencoded)),
+                num_logits=max(num_logits - num_reencoded, 1),
+                return_hidden_states=return_hidden_states,
+            )
+            if num_logits > num_reencoded:
+                outputs.append(output)
+        if num_reencoded > 0:
+            outputs.append(
+                self._reencode(
+                    x,
+                    reencode_idx=reencode_idx,
+                    num_logits=min(num_logits, num_reencoded),
+                    return_hidden_states=return_hidden_states,
+                )
+            )
+        self.seq_length = T
+
+        if len(outputs) == 1:
+            return outputs[0]
+        if return_hidden_states:
+            return tuple(
+                torch.cat(tensors, dim=1) for tensors in zip(*outputs)
+            )
+        return torch.cat(outputs, dim=1)
+
+    def _feed(
+        self,
+        tokens: torch.Tensor,
+        idx: List[int],
+        num_logits: int,
+        return_hidden_states: bool = False,
+        positions: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Process new tokens, which are kept pending.
+
+        Args:
+            tokens: New tokens in shape `(1, S)`.
+            idx: Their indices in the sequence.
+            num_logits: Number of (last) positions to return logits for.
+            return_hidden_states: Whether to also return the final hidden
+                states of these positions.
+            positions: Their positions in shape `(S,)`. Default is
+                `idx - pos_offset`.
+
+        Returns:
+            Logits in shape `(1, num_logits, vocab_size)` (and the hidden
+            states in shape `(1, num_logits, embed_dim)`).
+        """
+        if positions is None:
+            positions = (
+                torch.tensor(idx, device=tokens.device) - self.pos_offset
+            )
+        self.pending_positions = torch.cat([self.pending_positions, positions])
+        self.pending_idx = self.pending_idx + idx
+        mask = get_rolling_window_mask(
+            positions,
+            torch.cat([self.slot_positions, self.pending_positions]),
+            max_length=self.block_size,
+            num_sink_tokens=self.num_sink_tokens,
+        )
+
+        return self.forward(
+            tokens,
+            mask=mask,
+            kv_caches=self.kv_caches,
+            num_logits=num_logits,
+            positions=positions.unsqueeze(0),
+            return_hidden_states=return_hidden_states,
+        )
+
+    def _reencode(
+        self,
+        x: torch.Tensor,
+        reencode_idx: int,
+        num_logits: int,
+        return_hidden_states: bool = False,
+    ) -> torch.Tensor:
+        """
+        Re-encode the sink tokens and the `block_size - num_sink_tokens - 1`
+        tokens before token `reencode_idx` from position `0`, followed by the
+        new tokens from token `reencode_idx` on, in new caches. The previous
+        caches are kept until `crop` keeps token `reencode_idx`.
+
+        Args:
+            x: Whole sequence in shape `(1, T)`.
+            reencode_idx: Index of the first token at position
+                `block_size - 1`.
+            num_logits: Number of (last) positions to return logits for.
+            return_hidden_states: Whether to also return the final hidden
+                states of these positions.
+
+        Returns:
+            Logits in shape `(1, num_logits, vocab_size)` (and the hidden
+            states in shape `(1, num_logits, embed_dim)`).
+        """
+        num_recent = self.block_size - self.num_sink_tokens - 1
+        sink_idx = list(
+            range(self.sink_start, self.sink_start + self.num_sink_tokens)
+        )
+        idx = sink_idx + list(range(reencode_idx - num_recent, x.shape[1]))
+
+        self._prev_state = self._get_state()
+        self._reencode_idx = reencode_idx
+        self._init_state(pos_offset=reencode_idx - (self.block_size - 1))
+
+        return self._feed(
+            x[:, idx],
+            idx=idx,
+            num_logits=num_logits,
+            return_hidden_states=return_hidden_states,
+            positions=torch.arange(len(idx), device=x.device),
+        )
+
+    def crop(self, length: int) -> None:
+        """
+        Keep only the first `length` tokens of the sequence, writing those
+        that are pending into the slots (except those that later ones
+        overwrite).
+
+        Args:
+            length: Number of leading tokens of the sequence to keep.
+        """
+        length = min(length, self.seq_length)
+        if self._reencode_idx is not None:
+            if length <= self._reencode_idx:
+                self._set_state(self._prev_state)
+            self._prev_state = self._reencode_idx = None
+
+        # (the kept pending tokens are a prefix of the pending tokens)
+        positions = self.pending_positions[
+            : sum(i < length for i in self.pending_idx)
+        ]
+        is_written = get_rolling_window_mask(
+            positions[-1:],
+            positions,
+            max_length=self.block_size,
+            num_sink_tokens=self.num_sink_tokens,
+        ).any(dim=0)
+        pending_idx = is_written.nonzero().squeeze(-1)
+        cache_position = get_rolling_cache_position(
+            positions[pending_idx],
+            max_length=self.block_size,
+            num_sink_tokens=self.num_sink_tokens,
+        )
+        for kv_cache in self.kv_caches:
+            kv_cache.commit(pending_idx, cache_position=cache_position)
+        self.slot_positions[cache_position] = positions[pending_idx]
+        self.pending_positions = positions[:0]
+        self.pending_idx = []
+        self.seq_length = length
+
+
+class NgramProposer:
+    """
+    Prompt lookup decoding [Saxena, 2023]: propose the continuation of the
+    most recent earlier occurrence of the last `n` tokens (for the largest
+    `n <= max_ngram_size` that occurred before) within the prompt and the
+    generated tokens. If the continuation reaches the end of the sequence,
+    it is continued periodically (e.g. a repeated token is proposed again).
+    The n-grams are indexed incrementally, such that a proposal is a
+    dictionary lookup per `n`.
+    """
+
+    def __init__(self, max_ngram_size: int = 3) -> None:
+        """
+        Initialize the proposer.
+
+        Args:
+            max_ngram_size: Maximum number of last tokens to match.
+        """
+        self.max_ngram_size = max_ngram_size
+        self.tokens: List[int] = []
+        # n-gram -> end of its most recent occurrence that is followed by
+        # (at least) one token
+        self.index: Dict[Tuple[int, ...], int] = {}
+
+    def extend(self, tokens: List[int]) -> None:
+        """
+        Append tokens to the sequence and index the n-grams that are now
+        followed by a token.
+
+        Args:
+            tokens: New tokens.
+        """
+        for token in tokens:
+            end = len(self.tokens)  # n-grams ending before `token`
+            for n in range(1, min(self.max_ngram_size, end) + 1):
+                self.index[tuple(self.tokens[end - n : end])] = end
+            self.tokens.append(token)
+
+    def propose(self, num_tokens: int) -> List[int]:
+        """
+        Propose a continuation of the sequence.
+
+        Args:
+            num_tokens: Maximum number of tokens to propose.
+
+        Returns:
+            Up to `num_tokens` proposed tokens (none if the last token never
+            occurred before).
+        """
+        for n in range(min(self.max_ngram_size, len(self.tokens)), 0, -1):
+            end = self.index.get(tuple(self.tokens[-n:]))
+            if end is not None:
+                proposal = self.tokens[end : end + num_tokens]
+                period = len(self.tokens) - end
+                for i in range(len(proposal), num_tokens):
+                    proposal.append(proposal[i - period])
+                return proposal
+
+        return []
+
+
+def get_probs(logits: torch.Tensor, sampler: Sampler) -> torch.Tensor:
+    """
+    Probabilities of the next token that `sampler` samples from.
+
+    Args:
+        logits: Logits in shape `(..., vocab_size)`.
+        sampler: Sampling pipeline without token counts.
+
+    Returns:
+        Probabilities in shape `(..., vocab_size)`.
+    """
+    return torch.softmax(sampler.process(logits).float(), dim=-1)
+
+
+def verify_draft(
+    draft_tokens: torch.Tensor,
+    draft_probs: torch.Tensor,
+    target_probs: torch.Tensor,
+) -> Tuple[torch.Tensor, int]:
+    """
+    Rejection sampling of [Leviathan et al., 2023]: draft token `i` is
+    accepted with probability `min(1, p_i / q_i)`, where `p` and `q` are the
+    target and draft distributions. At the first rejection, the token is
+    resampled from `max(0, p - q)` (normalized); if all draft tokens are
+    accepted, a bonus token is sampled from the last target distribution.
+    The output is distributed exactly as if sampled from the target model.
+
+    Args:
+        draft_tokens: Draft tokens in shape `(k,)`.
+        draft_probs: Draft distributions of the draft tokens in shape
+            `(k, vocab_size)`.
+        target_probs: Target distributions at the positions of the draft
+            tokens and after the last one in shape `(k + 1, vocab_size)`.
+
+    Returns:
+        Accepted draft tokens followed by a resampled (or bonus) token, and
+        the number of accepted draft tokens.
+    """
+    k = draft_tokens.shape[0]
+    idx = torch.arange(k, device=draft_tokens.device)
+    p = target_probs[idx, draft_tokens]
+    q = draft_probs[idx, draft_tokens]
+    accepted = torch.rand_like(q) * q < p
+    # (this synchronizes with the device)
+    num_accepted = int(accepted.cumprod(dim=0).sum())
+
+    if num_accepted < k:
+        # nonzero, since the rejected token is more likely under `q` than
+        # under `p`
+        probs = (target_probs[num_accepted] - draft_probs[num_accepted]).clamp(
+            min=0
+        )
+    else:
+        probs = target_probs[k]
+    next_token = torch.multinomial(probs, num_samples=1)
+
+    return torch.cat([draft_tokens[:num_accepted], next_token]), num_accepted
+
+
+@torch.no_grad()
+def speculative_generate(
+    model: nn.Module,
+    x: torch.Tensor,
+    max_new_tokens: int,
+    block_size: int,
+    draft_model: Optional[nn.Module] = None,
+    sampler: Optional[Sampler] = None,
+    num_draft_tokens: int = 4,
+    max_ngram_size: int = 3,
+    use_extra_heads: bool = False,
+    stop_tokens: Optional[List[int]] = None,
+    stop_sequences: Optional[List[List[int]]] = None,
+    rolling_kv_cache: bool = False,
+    num_sink_tokens: int = 4,
+) -> Tuple[torch.Tensor, Dict[str, float]]:
+    """
+    Speculative decoding [Leviathan et al., 2023]: up to `num_draft_tokens`
+    tokens are proposed, which the target model verifies in a single forward
+    pass (cf. `verify_draft`). Each target forward pass thus yields between
+    `1` and `num_draft_tokens + 1` tokens, distributed as if generated by
+    the target model alone. The tokens are proposed autoregressively by a
+    small draft model, sampled from the extra prediction heads of the target
+    model itself [Cai et al., 2024] or, otherwise, looked up in the prompt
+    and the generated tokens (cf. `NgramProposer`), whose (deterministic)
+    proposals have a draft distribution of probability `1`.
+
+    Beyond `block_size`, the context matches that of `Transformer.generate`:
+    with `rolling_kv_cache`, draft and target models keep processing the new
+    tokens incrementally (cf. `RollingDecoder`). Otherwise, every position
+    beyond `block_size` would re-encode a window of `block_size` tokens, so
+    that verifying `k` draft tokens would cost `k + 1` forward passes of a
+    whole window; instead, no tokens are drafted there, i.e. the target
+    model decodes on its own, one (re-encoded) window per token.
+
+    Args:
+        model: Target transformer (not wrapped).
+        x: Prompt in shape `(1, T)`.
+        max_new_tokens: Maximum number of tokens to generate.
+        block_size: Maximum context length for predictions.
+        draft_model: Draft transformer with the same vocabulary. If not
+            provided (and `use_extra_heads` is `False`), prompt lookup is
+            used.
+        sampler: Sampling pipeline (cf. `get_token_sampler`), applied to the
+            logits of both models. Penalties based on token counts are not
+            supported, and parameters given per row must be given for the
+            single prompt. Default is sampling with temperature `1`.
+        num_draft_tokens: Maximum number of tokens proposed per draft.
+        max_ngram_size: Maximum number of last tokens matched in prompt
+            lookup.
+        use_extra_heads: Whether to draft with the extra prediction heads of
+            `model` (cf. `Transformer.get_extra_heads_logits`): the hidden
+            state that predicts the next token in one verification step
+            drafts the (up to `num__extra_heads`) tokens after it for the
+            next step. Thus, the draft costs no extra forward pass.
+        stop_tokens: Tokens after which generation stops, which are included
+            in the output.
+        stop_sequences: Token sequences after which generation stops,
+            which are included in the output.
+        rolling_kv_cache: Whether to continue beyond `block_size` with
+            rolling key/value caches of constant size, cf.
+            `Transformer.generate`.
+        num_sink_tokens: Number of pinned (attention sink) tokens of the
+            rolling caches.
+
+    Returns:
+        Output tensor of shape `(1, T + num_new_tokens)` and statistics:
+        the number of new tokens, target forward passes, draft tokens and
+        accepted draft tokens, the acceptance rate and the number of new
+        tokens per target forward pass.
+    """
+    assert x.shape[0] == 1, (
+        f"Speculative decoding supports a single prompt, but got "
+        f"{x.shape[0]}."
+    )
+    assert num_draft_tokens + 1 < block_size, (
+        f"`num_draft_tokens + 1` ({num_draft_tokens + 1}) must be smaller "
+        f"than `block_size` ({block_size})."
+    )
+    vocab_size = model.embedding.num_embeddings
+    assert (
+        draft_model is None
+        or draft_model.embedding.num_embeddings == vocab_size
+    ), (
+        f"Vocabulary size of the draft model "
+        f"({draft_model.embedding.num_embeddings}) differs from that of the "
+        f"target model ({vocab_size})."
+    )
+    assert not (
+        draft_model is not None and use_extra_heads
+    ), "Please draft either with a draft model or with the extra heads."
+    assert not use_extra_heads or len(model.extra_heads) > 0, (
+        "Drafting with the extra heads requires a model with "
+        "`num__extra_heads > 0`."
+    )
+    if sampler is None:
+        sampler = get_token_sampler(vocab_size=vocab_size, device=x.device)
+    assert (
+        not sampler.uses_token_counts
+    ), "Penalties are not supported in speculative decoding."
+    assert sampler.num_rows in (None, 1), (
+        f"The sampling parameters are given for {sampler.num_rows} rows, "
+        f"but speculative decoding decodes a single prompt (cf. "
+        f"`Sampler.reorder`)."
+    )
+
+    if rolling_kv_cache:
+        assert 0 <= num_sink_tokens < block_size, (
+            f"`num_sink_tokens` is {num_sink_tokens}, must be in "
+            f"[0, {block_size})."
+        )
+        for decoder_model in [model, draft_model]:
+            if decoder_model is None:
+                continue
+            max__seq_length = decoder_model.pos_encod.pos_encod.shape[1]
+            assert 2 * block_size <= max__seq_length, (
+                f"Rolling caches require `2 * block_size` "
+                f"({2 * block_size}) to be at most `max__seq_length` "
+                f"({max__seq_length})."
+            )
+
+    def init_decoder(
+        decoder_model: nn.Module,
+    ) -> Union[CachedDecoder, RollingDecoder]:
+        if rolling_kv_cache:
+            return RollingDecoder(
+                decoder_model,
+                block_size=block_size,
+                num_sink_tokens=num_sink_tokens,
+            )
+        return CachedDecoder(decoder_model, block_size=block_size)
+
+    target = init_decoder(model)
+    if draft_model is not None:
+        draft = init_decoder(draft_model)
+    elif use_extra_heads:
+        # drafts of the extra heads (none before the first target pass)
+        head_tokens = x.new_empty(0)
+        head_probs = torch.empty(0, vocab_size, device=x.device)
+    else:
+        proposer = NgramProposer(max_ngram_size=max_ngram_size)
+        proposer.extend(x[0].tolist())
+    stop_tokens = set(stop_tokens or [])
+    stop_sequences = stop_sequences or []
+    new_tokens: List[int] = []
+    stats = {
+        "num_target_forwards": 0,
+        "num_draft_tokens": 0,
+        "num_accepted": 0,
+    }
+
+    is_finished = max_new_tokens == 0
+    while not is_finished:
+        # never draft beyond `max_new_tokens`
+        k = min(num_draft_tokens, max_new_tokens - len(new_tokens) - 1)
+        if not rolling_kv_cache:
+            # only draft tokens whose prefixes fit into the block size
+            k = min(k, max(block_size - x.shape[1], 0))
+        x_draft = x
+        if draft_model is not None:
+            draft_probs = []
+            for _ in range(k):
+                probs = get_probs(draft(x_draft, num_logits=1)[:, -1], sampler)
+                draft_probs.append(probs)
+                x_draft = torch.cat(
+                    [x_draft, torch.multinomial(probs, num_samples=1)], dim=-1
+                )
+        elif use_extra_heads:
+            k = min(k, head_tokens.shape[0])
+            draft_probs = [head_probs[:k]]
+            x_draft = torch.cat([x, head_tokens[:k].unsqueeze(0)], dim=-1)
+        else:
+            proposal = torch.tensor(
+                proposer.propose(k), dtype=torch.long, device=x.device
+            )
+            k = proposal.shape[0]
+            draft_probs = [one_hot(proposal, num_classes=vocab_size).float()]
+            x_draft = torch.cat([x, proposal.unsqueeze(0)], dim=-1)
+
+        # score all draft tokens (and the position after them) at once
+        if use_extra_heads:
+            logits, hidden = target(
+                x_draft, num_logits=k + 1, return_hidden_states=True
+            )
+        else:
+            logits = target(x_draft, num_logits=k + 1)
+        target_probs = get_probs(logits[0], sampler)
+        tokens, num_accepted = verify_draft(
+            draft_tokens=x_draft[0, x.shape[1] :],
+            draft_probs=(
+                torch.cat(draft_probs)
+                if draft_probs
+                else target_probs.new_empty(0, vocab_size)
+            ),
+            target_probs=target_probs,
+        )
+        stats["num_target_forwards"] += 1
+        stats["num_draft_tokens"] += k
+        stats["num_accepted"] += num_accepted
+        if use_extra_heads:
+            # the hidden state that predicted the resampled (or bonus) token
+            # drafts the tokens after it
+            head_probs = get_probs(
+                model.get_extra_heads_logits(hidden[0, num_accepted]), sampler
+            )
+            head_tokens = torch.multinomial(head_probs, num_samples=1)[:, 0]
+
+        # stop after the first stop token (or sequence)
+        tokens = tokens.tolist()
+        for num_kept, token in enumerate(tokens, start=1):
+            new_tokens.append(token)
+            is_finished = (
+                token in stop_tokens
+                or any(
+                    new_tokens[-len(stop_sequence) :] == stop_sequence
+                    for stop_sequence in stop_sequences
+                )
+                or len(new_tokens) == max_new_tokens
+            )
+            if is_finished:
+                break
+        x = torch.cat(
+            [x, torch.tensor([tokens[:num_kept]], device=x.device)], dim=-1
+        )
+
+        # drop the rejected tokens from the caches (the last token was not
+        # processed by the target model yet)
+        target.crop(x.shape[1] - 1)
+        if draft_model is not None:
+            draft.crop(x.shape[1] - 1)
+        elif not use_extra_heads:
+            proposer.extend(tokens[:num_kept])
+
+    stats["num_new_tokens"] = len(new_tokens)
+    stats["acceptance_rate"] = stats["num_accepted"] / max(
+        stats["num_draft_tokens"], 1
+    )
+    stats["tokens_per_target_forward"] = len(new_tokens) / max(
+        stats["num_target_forwards"], 1
+    )
+
+    return x, stats
@@ -0,0 +1,673 @@
+"""
+Benchmark performance-critical code paths.
+"""
+import logging
+import os
+import subprocess
+import sys
+from argparse import Namespace
+from contextlib import contextmanager
+from functools import partial
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+from utils import end_timer_and_log, get_batch, start_timer
+
+from architecture.attention import get_subsequent_mask
+from architecture.beam_search import beam_search
+from architecture.models import Transformer
+from architecture.sampling import get_token_sampler
+from architecture.speculative import speculative_generate
+from data import get_token_dtype
+from options import get_parser__benchmark
+
+
+def build_model(args: Namespace, attn_backend: str = "auto") -> Transformer:
+    """
+    Build a randomly initialized transformer in evaluation mode.
+
+    Args:
+        args: Benchmark arguments.
+        attn_backend: Implementation of the scaled dot-product attention.
+
+    Returns:
+        Transformer on `args.device`.
+    """
+    model = Transformer(
+        num__decoder_layers=args.num__decoder_layers,
+        embedding_dim=args.embedding_dim,
+        num_heads=args.num_heads,
+        vocab_size=args.vocab_size,
+        dim_feedfwd=args.dim_feedfwd,
+        attn_backend=attn_backend,
+    )
+    return model.to(args.device).eval()
+
+
+@contextmanager
+def track_saved_tensors() -> Iterator[List[int]]:
+    """
+    Sum up the memory of all tensors that autograd saves for the backward
+    pass (i.e. the activation memory), also on the CPU.
+
+    Returns:
+        Single-element list containing the number of saved bytes.
+    """
+    num_bytes = [0]
+    seen = set()
+
+    def pack_hook(tensor: torch.Tensor) -> torch.Tensor:
+        # parameters and tensors saved by several ops are counted once
+        storage = tensor.untyped_storage()
+        if not isinstance(tensor, nn.Parameter) and storage not in seen:
+            seen.add(storage)
+            num_bytes[0] += storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda x: x):
+        yield num_bytes
+
+
+@torch.no_grad()
+def benchmark_lm_head(args: Namespace) -> None:
+    """
+    Compare a forward pass over a full context window that projects all
+    hidden states onto the vocabulary with one that only projects the last
+    position, as done when sampling the next token.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    model = build_model(args)
+    x = torch.randint(
+        0,
+        args.vocab_size,
+        (args.batch_size, args.block_size),
+        device=args.device,
+    )
+    mask = get_subsequent_mask(size=args.block_size, rank=args.device)
+
+    for num_logits in [None, 1]:
+        model(x, mask=mask, num_logits=num_logits)  # warmup
+
+        start_time = start_timer(device=torch.device(args.device))
+        for _ in range(args.num_repeats):
+            logits = model(x, mask=mask, num_logits=num_logits)
+        time_diff = end_timer_and_log(
+            start_time=start_time,
+            device=torch.device(args.device),
+            local_msg=f"Logits of {num_logits or 'all'} position(s)",
+        )
+        logging.info(
+            f"\tLatency per token = "
+            f"{1e3 * time_diff / args.num_repeats:.3f} [ms]\n"
+            f"\tSize of logits = "
+            f"{logits.numel() * logits.element_size() / 1024**2:.3f} [MB]"
+        )
+
+
+def benchmark_attention(args: Namespace) -> None:
+    """
+    Compare training steps (forward and backward pass) with the different
+    attention backends.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    x = torch.randint(
+        0,
+        args.vocab_size,
+        (args.batch_size, args.block_size),
+        device=args.device,
+    )
+    mask = get_subsequent_mask(size=args.block_size, rank=args.device)
+
+    for attn_backend in ["naive", "sdpa", "auto"]:
+        torch.manual_seed(0)
+        model = build_model(args, attn_backend=attn_backend).train()
+        # only the naive backend relies on a materialized mask
+        kwargs = {"mask": mask} if attn_backend == "naive" else {}
+
+        model(x, is_causal=not kwargs, **kwargs).sum().backward()  # warmup
+
+        start_time = start_timer(device=torch.device(args.device))
+        for _ in range(args.num_repeats):
+            model.zero_grad(set_to_none=True)
+            with track_saved_tensors() as saved_bytes:
+                out = model(x, is_causal=not kwargs, **kwargs)
+            out.sum().backward()
+        time_diff = end_timer_and_log(
+            start_time=start_time,
+            device=torch.device(args.device),
+            local_msg=f"Attention backend '{attn_backend}'",
+        )
+        logging.info(
+            f"\tTime per training step = "
+            f"{1e3 * time_diff / args.num_repeats:.3f} [ms]\n"
+            f"\tActivation memory = {saved_bytes[0] / 1024**2:.3f} [MB]"
+        )
+
+
+def benchmark_get_batch(args: Namespace) -> None:
+    """
+    Compare the host-side time of sampling a batch with a Python loop over
+    the windows (with separate input and target windows) and with the
+    vectorized `get_batch`.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    data = np.random.randint(
+        0,
+        args.vocab_size,
+        size=args.num_tokens,
+        dtype=get_token_dtype(args.vocab_size),
+    )
+
+    def get_batch__loop() -> Tuple[torch.Tensor, torch.Tensor]:
+        indices = torch.randint(
+            low=0, high=len(data) - args.block_size, size=(args.batch_size,)
+        )
+        input = np.stack([data[i : i + args.block_size] for i in indices])
+        target = np.stack(
+            [data[i + 1 : i + args.block_size + 1] for i in indices]
+        )
+        input = torch.from_numpy(input.astype(np.int64)).to(args.device)
+        target = torch.from_numpy(target.astype(np.int64)).to(args.device)
+        return input, target
+
+    for name, fn in [
+        ("Python loop", get_batch__loop),
+        (
+            "vectorized",
+            lambda: get_batch(
+                data,
+                batch_size=args.batch_size,
+                block_size=args.block_size,
+                device=args.device,
+            ),
+        ),
+    ]:
+        fn()  # warmup
+
+        start_time = start_timer(device=torch.device(args.device))
+        for _ in range(args.num_repeats):
+            fn()
+        time_diff = end_timer_and_log(
+            start_time=start_time,
+            device=torch.device(args.device),
+            local_msg=f"Batch sampling ({name})",
+        )
+        logging.info(
+            f"\tTime per step = {1e3 * time_diff / args.num_repeats:.3f} [ms]"
+        )
+
+
+@torch.inference_mode()
+def benchmark_generate(args: Namespace) -> None:
+    """
+    Measure the aggregate throughput of generating from batches of
+    left-padded prompts of different lengths, for batch sizes `1, 2, 4, ...`
+    up to `args.batch_size`.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    model = build_model(args)
+    generator = torch.Generator().manual_seed(0)
+
+    batch_size = 1
+    while batch_size <= args.batch_size:
+        # prompts of up to half the context window, left-padded
+        prompt_lengths = torch.randint(
+            1, args.block_size // 2 + 1, (batch_size,), generator=generator
+        )
+        max_len = int(prompt_lengths.max())
+        x = torch.randint(
+            0, args.vocab_size, (batch_size, max_len), generator=generator
+        )
+        padding_mask = (
+            torch.arange(max_len) >= max_len - prompt_lengths.unsqueeze(-1)
+        ).long()
+        x, padding_mask = x.to(args.device), padding_mask.to(args.device)
+
+        def generate() -> torch.Tensor:
+            return model.generate(
+                x,
+                max_new_tokens=args.max_new_tokens,
+                block_size=args.block_size,
+                padding_mask=padding_mask,
+            )
+
+        generate()  # warmup
+
+        start_time = start_timer(device=torch.device(args.device))
+        for _ in range(args.num_repeats):
+            generate()
+        time_diff = end_timer_and_log(
+            start_time=start_time,
+            device=torch.device(args.device),
+            local_msg=f"Generation with batch size {batch_size}",
+        )
+        num_tokens = args.num_repeats * batch_size * args.max_new_tokens
+        logging.info(f"\tThroughput = {num_tokens / time_diff:.1f} [tokens/s]")
+
+        batch_size *= 2
+
+
+@torch.inference_mode()
+def benchmark_decode(args: Namespace) -> None:
+    """
+    Compare the decoding latency of the eager model with the compiled model,
+    decoding with dynamic shapes (growing caches and inputs) and with static
+    shapes (preallocated caches and bucketed prompts).
+
+    Args:
+        args: Benchmark arguments.
+    """
+    from torch._dynamo.utils import counters
+
+    x = torch.randint(
+        0, args.vocab_size, (args.batch_size, 8), device=args.device
+    )
+    # prompt, new tokens and padding to the bucket size fit into the context
+    block_size = max(args.block_size, 2 * (8 + args.max_new_tokens))
+
+    for name, compile, static_shapes in [
+        ("eager", False, False),
+        ("compiled, dynamic shapes", True, False),
+        ("compiled, static shapes", True, True),
+    ]:
+        torch._dynamo.reset()
+        counters.clear()
+        torch.manual_seed(0)
+        model = build_model(args)
+        if compile:
+            model.compile_decoding(dynamic=not static_shapes)
+
+        def generate() -> torch.Tensor:
+            return model.generate(
+                x,
+                max_new_tokens=args.max_new_tokens,
+                block_size=block_size,
+                static_shapes=static_shapes,
+                bucket_size=8,
+            )
+
+        generate()  # warmup (and compilation)
+
+        start_time = start_timer(device=torch.device(args.device))
+        for _ in range(args.num_repeats):
+            generate()
+        time_diff = end_timer_and_log(
+            start_time=start_time,
+            device=torch.device(args.device),
+            local_msg=f"Decoding ({name})",
+        )
+        num_tokens = args.num_repeats * args.max_new_tokens
+        logging.info(
+            f"\tLatency per token = {1e3 * time_diff / num_tokens:.3f} [ms]\n"
+            f"\tCompiled graphs = {counters['stats']['unique_graphs']}"
+        )
+
+
+@torch.inference_mode()
+def benchmark_sampling(args: Namespace) -> None:
+    """
+    Measure the per-step overhead of sampling the next token from logits of
+    shape `(batch_size, vocab_size)`: top-k sampling as previously done in
+    `generate` (boolean-mask assignment and a new `nn.Softmax` per step) vs.
+    the sampling pipeline with various processors.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    logits = torch.randn(args.batch_size, args.vocab_size, device=args.device)
+    x = torch.randint(
+        0,
+        args.vocab_size,
+        (args.batch_size, args.block_size),
+        device=args.device,
+    )
+
+    def sample__top_k_previous() -> torch.Tensor:
+        scaled_logits = logits / 0.8
+        max_vals, _ = torch.topk(scaled_logits, k=50, dim=-1)
+        scaled_logits[scaled_logits < max_vals[:, [-1]]] = float("-inf")
+        probs = nn.Softmax(dim=-1)(scaled_logits)
+        return torch.multinomial(probs, num_samples=1)
+
+    variants = [("top-k (previous)", sample__top_k_previous)]
+    for name, kwargs in [
+        ("top-k", {"top_k": 50}),
+        ("top-k, Gumbel-max", {"top_k": 50, "gumbel": True}),
+        ("top-k, top-p", {"top_k": 50, "top_p": 0.9}),
+        ("top-p", {"top_p": 0.9}),
+        ("min-p", {"min_p": 0.1}),
+        (
+            "penalties, top-k",
+            {
+                "top_k": 50,
+                "repetition_penalty": 1.2,
+                "frequency_penalty": 0.1,
+            },
+        ),
+    ]:
+        sampler = get_token_sampler(
+            vocab_size=args.vocab_size,
+            device=torch.device(args.device),
+            temperature=0.8,
+            **kwargs,
+        )
+        sampler.init_token_counts(x, vocab_size=args.vocab_size)
+        variants.append((name, partial(sampler, logits)))
+
+    for name, sample in variants:
+        sample()  # warmup
+
+        start_time = start_timer(device=torch.device(args.device))
+        for _ in range(args.num_repeats):
+            sample()
+        time_diff = end_timer_and_log(
+            start_time=start_time,
+            device=torch.device(args.device),
+            local_msg=f"Sampling ({name})",
+        )
+        logging.info(
+            f"\tTime per step = {1e3 * time_diff / args.num_repeats:.3f} [ms]"
+        )
+
+
+@torch.inference_mode()
+def benchmark_speculative(args: Namespace) -> None:
+    """
+    Compare the latency of greedy decoding with the target model alone and
+    with speculative decoding, with a draft model and with prompt lookup,
+    within the context window and beyond it (re-encoding the window or with
+    rolling caches). The draft model consists of the embedding and the first
+    decoder block of the target model (a randomly initialized, independent
+    draft would hardly ever be accepted). The prompt repeats a random
+    sequence, like the repetitive text that prompt lookup exploits.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    model = build_model(args)
+    draft_model = Transformer(
+        num__decoder_layers=1,
+        embedding_dim=args.embedding_dim,
+        num_heads=args.num_heads,
+        vocab_size=args.vocab_size,
+        dim_feedfwd=args.dim_feedfwd,
+    )
+    draft_model.load_state_dict(model.state_dict(), strict=False)
+    draft_model.to(args.device).eval()
+
+    x = torch.randint(0, args.vocab_size, (1, 16), device=args.device)
+    x = x.repeat(1, 4)
+    sampler = get_token_sampler(
+        vocab_size=args.vocab_size, device=torch.device(args.device), top_k=1
+    )
+
+    variants = [("target model only", None)]
+    for num_draft_tokens in [2, 4, 8]:
+        variants.append(
+            (
+                f"draft model, {num_draft_tokens} draft tokens",
+                {
+                    "draft_model": draft_model,
+                    "num_draft_tokens": num_draft_tokens,
+                },
+            )
+        )
+    for num_draft_tokens in [4, 8]:
+        variants.append(
+            (
+                f"prompt lookup, {num_draft_tokens} draft tokens",
+                {"num_draft_tokens": num_draft_tokens},
+            )
+        )
+
+    # the prompt and new tokens fit into the context window, or most new
+    # tokens exceed it (where tokens are only drafted with rolling caches)
+    cases = [
+        ("within block_size", args.max_new_tokens, False),
+        ("beyond block_size", 4 * args.block_size, False),
+        ("beyond block_size, rolling caches", 4 * args.block_size, True),
+    ]
+    time_diffs__target = {}
+    for name, kwargs in variants:
+        for case, max_new_tokens, rolling_kv_cache in cases:
+
+            def generate() -> Dict[str, float]:
+                if kwargs is None:
+                    model.generate(
+                        x,
+                        max_new_tokens=max_new_tokens,
+                        block_size=args.block_size,
+                        sampler=sampler,
+                        rolling_kv_cache=rolling_kv_cache,
+                    )
+                    return {}
+
+                return speculative_generate(
+                    model,
+                    x,
+                    max_new_tokens=max_new_tokens,
+                    block_size=args.block_size,
+                    sampler=sampler,
+                    rolling_kv_cache=rolling_kv_cache,
+                    **kwargs,
+                )[1]
+
+            generate()  # warmup
+
+            start_time = start_timer(device=torch.device(args.device))
+            for _ in range(args.num_repeats):
+                stats = generate()
+            time_diff = end_timer_and_log(
+                start_time=start_time,
+                device=torch.device(args.device),
+                local_msg=f"Decoding ({name}, {case})",
+            )
+            num_tokens = args.num_repeats * max_new_tokens
+            log_msg = (
+                f"\tLatency per token = "
+                f"{1e3 * time_diff / num_tokens:.3f} [ms]"
+            )
+            if kwargs is None:
+                time_diffs__target[case] = time_diff
+            else:
+                log_msg += (
+                    f"\n\tAcceptance rate = {stats['acceptance_rate']:.3f}\n"
+                    f"\tTokens per target forward pass = "
+                    f"{stats['tokens_per_target_forward']:.2f}\n"
+                    f"\tSpeedup = {time_diffs__target[case] / time_diff:.2f}"
+                )
+            logging.info(log_msg)
+
+
+def benchmark_beam_search(args: Namespace) -> None:
+    """
+    Measure the decoding latency of beam search for increasing beam widths,
+    compared to greedy decoding (a beam width of 1). Stop conditions are
+    not used, such that every width generates `max_new_tokens` tokens.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    model = build_model(args)
+    x = torch.randint(
+        0, args.vocab_size, (args.batch_size, 16), device=args.device
+    )
+
+    time_diff__greedy = None
+    for num_beams in [1, 2, 4, 8, 16]:
+
+        def generate() -> None:
+            beam_search(
+                model,
+                x,
+                max_new_tokens=args.max_new_tokens,
+                block_size=args.block_size,
+                num_beams=num_beams,
+            )
+
+        generate()  # warmup
+
+        start_time = start_timer(device=torch.device(args.device))
+        for _ in range(args.num_repeats):
+            generate()
+        time_diff = end_timer_and_log(
+            start_time=start_time,
+            device=torch.device(args.device),
+            local_msg=f"Beam search ({num_beams} beams)",
+        )
+        if time_diff__greedy is None:
+            time_diff__greedy = time_diff
+        num_tokens = args.num_repeats * args.max_new_tokens
+        logging.info(
+            f"\tLatency per token = {1e3 * time_diff / num_tokens:.3f} [ms]\n"
+            f"\tRelative to greedy = {time_diff / time_diff__greedy:.2f}"
+        )
+
+
+def benchmark_rolling(args: Namespace) -> None:
+    """
+    Compare the decoding latency beyond `block_size` of re-encoding the
+    truncated window in every step and of rolling key/value caches. The
+    prompt fills the window, so that every generated token exceeds it.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    model = build_model(args)
+    x = torch.randint(
+        0,
+        args.vocab_size,
+        (args.batch_size, args.block_size),
+        device=args.device,
+    )
+    sampler = get_token_sampler(
+        vocab_size=args.vocab_size, device=torch.device(args.device), top_k=1
+    )
+
+    time_diff__window = None
+    for rolling_kv_cache in [False, True]:
+        name = "rolling caches" if rolling_kv_cache else "window re-encoding"
+
+        def generate() -> None:
+            model.generate(
+                x,
+                max_new_tokens=args.max_new_tokens,
+                block_size=args.block_size,
+                sampler=sampler,
+                rolling_kv_cache=rolling_kv_cache,
+            )
+
+        generate()  # warmup
+
+        start_time = start_timer(device=torch.device(args.device))
+        for _ in range(args.num_repeats):
+            generate()
+        time_diff = end_timer_and_log(
+            start_time=start_time,
+            device=torch.device(args.device),
+            local_msg=f"Decoding ({name})",
+        )
+        num_tokens = args.num_repeats * args.max_new_tokens
+        log_msg = (
+            f"\tLatency per token = {1e3 * time_diff / num_tokens:.3f} [ms]"
+        )
+        if time_diff__window is None:
+            time_diff__window = time_diff
+        else:
+            log_msg += f"\n\tSpeedup = {time_diff__window / time_diff:.2f}"
+        logging.info(log_msg)
+
+
+def benchmark_import_time(args: Namespace) -> None:
+    """
+    Measure the import time of the modules of `run.py` (which is all that
+    inference pays before loading the model) and `data.py` (e.g. for
+    `--dataset shakespeare`) in fresh interpreters via `python -X importtime`,
+    and list its most expensive direct imports.
+
+    Args:
+        args: Benchmark arguments.
+    """
+    for module in ["run", "data"]:
+        times = []
+        for _ in range(args.num_repeats):
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            # lines look like `import time: <self> | <cumulative> | <name>`,
+            # where the name is indented by the nesting depth, and nested
+            # imports are listed before the importing module
+            children = {}
+            for line in result.stderr.splitlines()[1:]:
+                _, cumulative_us, name = line.split("|")
+                depth = (len(name) - len(name.lstrip()) - 1) // 2
+                if depth == 1:
+                    children[name.strip()] = int(cumulative_us)
+                elif depth == 0 and name.strip() != module:
+                    children = {}
+                elif depth == 0:
+                    children[module] = int(cumulative_us)
+                    break
+            times.append(children)
+
+        # the fastest repetition is the least affected by noise
+        fastest = min(times, key=lambda t: t[module])
+        heaviest = sorted(
+            fastest.items(), key=lambda item: item[1], reverse=True
+        )[
+            1:6
+        ]  # without the module itself
+        logging.info(
+            f"Import of '{module}': {fastest[module] / 1e3:.1f} [ms]\n"
+            + "\n".join(
+                f"\t{name}: {time_us / 1e3:.1f} [ms]"
+                for name, time_us in heaviest
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = get_parser__benchmark()
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    logging.info(args)
+
+    if args.task == "lm_head":
+        benchmark_lm_head(args)
+    elif args.task == "attention":
+        benchmark_attention(args)
+    elif args.task == "get_batch":
+        benchmark_get_batch(args)
+    elif args.task == "import_time":
+        benchmark_import_time(args)
+    elif args.task == "generate":
+        benchmark_generate(args)
+    elif args.task == "decode":
+        benchmark_decode(args)
+    elif args.task == "sampling":
+        benchmark_sampling(args)
+    elif args.task == "speculative":
+        benchmark_speculative(args)
+    elif args.task == "beam_search":
+        benchmark_beam_search(args)
+    elif args.task == "rolling":
+        benchmark_rolling(args)
@@ -0,0 +1,329 @@
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from copy import deepcopy
+from glob import glob
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from torch import Tensor
+
+
+class CheckpointManager:
+    """
+    Save checkpoints without stalling training: the state is copied into
+    reusable (pinned) CPU buffers and serialized on a background thread. The
+    `keep_best` checkpoints with the lowest validation loss and the
+    `keep_last` most recent checkpoints are kept, all others are deleted.
+    Files are written to a temporary file first and then renamed, such that
+    a crash never leaves a partially written checkpoint behind.
+    """
+
+    def __init__(
+        self,
+        saving_path: str,
+        prefix: str = "cp",
+        keep_best: int = 1,
+        keep_last: int = 0,
+        save_interval: Optional[int] = None,
+        save_interval__minutes: Optional[float] = None,
+    ) -> None:
+        """
+        Initialize the checkpoint manager.
+
+        Args:
+            saving_path: Directory in which the checkpoints are saved.
+            prefix: Prefix of the checkpoint filenames.
+            keep_best: Number of checkpoints with the lowest validation loss
+                to keep.
+            keep_last: Number of most recent checkpoints to keep.
+            save_interval: If provided, a checkpoint is saved every
+                `save_interval` steps.
+            save_interval__minutes: If provided, a checkpoint is saved every
+                `save_interval__minutes` minutes.
+        """
+        assert keep_best >= 1, f"`keep_best` is {keep_best}, must be >= 1."
+        assert keep_last >= 0, f"`keep_last` is {keep_last}, must be >= 0."
+        self.saving_path = saving_path
+        self.prefix = prefix
+        self.keep_best = keep_best
+        self.keep_last = keep_last
+        self.save_interval = save_interval
+        self.save_interval__minutes = save_interval__minutes
+
+        # pinned memory speeds up (and allows asynchronous) device-to-host
+        # copies
+        self.pin_memory = torch.cuda.is_available()
+        # buffers of the last save, keyed by the memory the tensors alias
+        self._buffers: Dict[Tuple, Tensor] = {}
+
+        # a single worker writes the files in the order they were saved
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Optional[Future] = None
+
+        # saved checkpoints as `(step, val_loss, filename)`
+        self.records: List[Tuple[int, Optional[float], str]] = []
+        self._last_save_time = monotonic()
+
+    @property
+    def best_checkpoint_path(self) -> Optional[str]:
+        """
+        Path of the checkpoint with the lowest validation loss.
+        """
+        evaluated = [
+            record for record in self.records if record[1] is not None
+        ]
+        if not evaluated:
+            return None
+        return min(evaluated, key=lambda record: record[1])[2]
+
+    @property
+    def last_checkpoint_path(self) -> Optional[str]:
+        """
+        Path of the most recent checkpoint.
+        """
+        if not self.records:
+            return None
+        return max(self.records, key=lambda record: record[0])[2]
+
+    def is_best(self, val_loss: float) -> bool:
+        """
+        Check whether a validation loss is among the `keep_best` lowest ones.
+
+        Args:
+            val_loss: Validation loss.
+
+        Returns:
+            Whether a checkpoint with this validation loss would be kept.
+        """
+        val_losses = sorted(
+            record[1] for record in self.records if record[1] is not None
+        )
+        return (
+            len(val_losses) < self.keep_best
+            or val_loss < val_losses[self.keep_best - 1]
+        )
+
+    def is_save_due(self, step: int, is_last_step: bool = False) -> bool:
+        """
+        Check whether a periodic checkpoint is due.
+
+        Args:
+            step: Current step.
+            is_last_step: Whether this is the last step of training, after
+                which the latest state is always saved.
+
+        Returns:
+            Whether a periodic checkpoint is due.
+        """
+        if self.keep_last == 0:
+            return False
+
+        if is_last_step:
+            return True
+        if self.save_interval is not None and step % self.save_interval == 0:
+            return step > 0
+        if self.save_interval__minutes is not None:
+            return (
+                monotonic() - self._last_save_time
+                >= 60 * self.save_interval__minutes
+            )
+
+        return False
+
+    def save(
+        self, state: Dict, step: int, val_loss: Optional[float] = None
+    ) -> None:
+        """
+        Snapshot a state to the CPU and write it asynchronously. Only blocks
+        if the previous checkpoint is still being written, since its buffers
+        are reused.
+
+        Args:
+            state: State of model and optimizer in a dictionary.
+            step: Current step.
+            val_loss: Validation loss of the state, if evaluated.
+        """
+        self.wait()
+
+        buffers = {}
+        snapshot = self._copy_to_buffers(state, buffers=buffers)
+        # (buffers of tensors that no longer exist are released)
+        self._buffers = buffers
+        # device-to-host copies might still be running
+        event = None
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()
+
+        filename = os.path.join(
+            self.saving_path, f"{self.prefix}_step{step:08d}.pt"
+        )
+        # a checkpoint of the same step is overwritten
+        self.records = [r for r in self.records if r[2] != filename]
+        self.records.append((step, val_loss, filename))
+        stale_filenames = self._apply_retention()
+
+        log_msg = f"=> Saving checkpoint '{filename}' at step {step}"
+        if val_loss is not None:
+            log_msg += (
+                f", corresponding to a validation loss of {val_loss:.4f}"
+            )
+        logging.info(f"{log_msg}.")
+
+        # the retention state is saved along, such that it can be restored
+        # when resuming from this checkpoint
+        snapshot["checkpoint_manager"] = deepcopy(self.state_dict())
+
+        self._pending = self._executor.submit(
+            self._write, snapshot, filename, event, stale_filenames
+        )
+        self._last_save_time = monotonic()
+
+    def state_dict(self) -> Dict:
+        """
+        Get the filename prefix and the records of the saved checkpoints.
+        """
+        return {"prefix": self.prefix, "records": self.records}
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        """
+        Restore the filename prefix and the records of the checkpoints that
+        still exist, e.g. when resuming training.
+        """
+        self.prefix = state_dict["prefix"]
+        self.records = [
+            tuple(record)
+            for record in state_dict["records"]
+            if os.path.exists(record[2])
+        ]
+
+    def wait(self) -> None:
+        """
+        Wait until the pending checkpoint is written (and re-raise errors of
+        the background thread).
+        """
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self) -> None:
+        """
+        Wait for the pending checkpoint and stop the background thread.
+        """
+        self.wait()
+        self._executor.shutdown()
+
+    def _copy_to_buffers(self, obj: Any, buffers: Dict[Tuple, Tensor]) -> Any:
+        """
+        Recursively copy all tensors of a (nested) state into CPU buffers,
+        which are allocated once and reused by subsequent saves. Buffers are
+        identified by the memory the tensors alias, such that tensors that
+        share memory (e.g. the tied embedding and pre-softmax weights) are
+        copied into the same buffer and remain shared in the saved file.
+
+        Args:
+            obj: State (or part of it).
+            buffers: Buffers of the current save, which are filled in.
+
+        Returns:
+            Copy of the state with all tensors in CPU buffers.
+        """
+        if isinstance(obj, Tensor):
+            key = (
+                obj.untyped_storage().data_ptr(),
+                obj.storage_offset(),
+                tuple(obj.shape),
+                obj.stride(),
+                obj.dtype,
+            )
+            if key in buffers:
+                return buffers[key]
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = torch.empty(
+                    obj.shape,
+                    dtype=obj.dtype,
+                    pin_memory=self.pin_memory and obj.is_cuda,
+                )
+            buffer.copy_(obj.detach(), non_blocking=buffer.is_pinned())
+            buffers[key] = buffer
+            return buffer
+        if isinstance(obj, dict):
+            return {
+                k: self._copy_to_buffers(v, buffers=buffers)
+                for k, v in obj.items()
+            }
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(
+                self._copy_to_buffers(v, buffers=buffers) for v in obj
+            )
+
+        return deepcopy(obj)
+
+    def _apply_retention(self) -> List[str]:
+        """
+        Drop all records that are neither among the `keep_best` lowest
+        validation losses nor among the `keep_last` most recent ones.
+
+        Returns:
+            Filenames of the dropped checkpoints.
+        """
+        evaluated = [r for r in self.records if r[1] is not None]
+        best = sorted(evaluated, key=lambda r: r[1])[: self.keep_best]
+        last = sorted(self.records, key=lambda r: r[0])[
+            len(self.records) - self.keep_last :
+        ]
+        kept = set(best) | set(last)
+
+        stale_filenames = [r[2] for r in self.records if r not in kept]
+        self.records = [r for r in self.records if r in kept]
+
+        return stale_filenames
+
+    @staticmethod
+    def _write(
+        snapshot: Dict,
+        filename: str,
+        event: Optional[torch.cuda.Event],
+        stale_filenames: List[str],
+    ) -> None:
+        """
+        Write a snapshot atomically and delete stale checkpoints (runs on
+        the background thread).
+
+        Args:
+            snapshot: State in CPU buffers.
+            filename: Name of the checkpoint.
+            event: CUDA event marking the end of the device-to-host copies.
+            stale_filenames: Checkpoints to delete after writing.
+        """
+        if event is not None:
+            event.synchronize()
+
+        tmp_filename = f"{filename}.tmp"
+        torch.save(snapshot, tmp_filename)
+        os.replace(tmp_filename, filename)
+
+        for stale_filename in stale_filenames:
+            if os.path.exists(stale_filename):
+                os.remove(stale_filename)
+
+
+def find_latest_checkpoint(saving_path: str) -> Optional[str]:
+    """
+    Find the most recently written checkpoint in a directory.
+
+    Args:
+        saving_path: Directory in which the checkpoints are saved.
+
+    Returns:
+        Path of the latest checkpoint, or `None` if there is none.
+    """
+    # temporary files of interrupted writes do not match the pattern
+    filenames = glob(os.path.join(saving_path, "cp_*_step*.pt"))
+    if not filenames:
+        return None
+
+    return max(filenames, key=os.path.getmtime)
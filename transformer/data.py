@@ -6,13 +6,11 @@ For the OpenWebText dataset, the GPT2 tokenizer is used.
 import json
 import os
 import shutil
-import urllib
+import urllib.request
 from typing import Dict, List, Optional
 from warnings import warn
 
-import datasets
 import numpy as np
-import tiktoken
 
 from options import get_parser__data_prep
 
@@ -47,6 +45,78 @@ def decode(tokens: List[int], vocab: List[str]) -> List[str]:
     return "".join([int_to_string[idx] for idx in tokens])
 
 
+def get_token_dtype(vocab_size: int) -> np.dtype:
+    """
+    Get the narrowest dtype that can store all token IDs of a vocabulary.
+
+    Args:
+        vocab_size: Vocabulary size.
+
+    Returns:
+        `uint8`, `uint16` or `int32`.
+    """
+    for dtype in [np.uint8, np.uint16, np.int32]:
+        if vocab_size - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+    raise ValueError(f"Vocabulary size {vocab_size} exceeds `int32`.")
+
+
+def convert_tokens(
+    filename: str, vocab_size: int, chunk_size: int = 2**24
+) -> None:
+    """
+    Convert an existing token file (e.g. written as `int64` by an older
+    version of this script) in-place to the narrowest dtype for
+    `vocab_size`. The file is converted in chunks, so it does not need to
+    fit into memory.
+
+    Args:
+        filename: Path to the token file.
+        vocab_size: Vocabulary size.
+        chunk_size: Number of tokens converted at once.
+    """
+    data = load_tokens(filename)
+    dtype = get_token_dtype(vocab_size)
+    if data.dtype == dtype:
+        print(f"'{filename}' is already stored as {dtype}.")
+        return
+
+    tmp_filename = f"{filename}.tmp"
+    array = np.lib.format.open_memmap(
+        filename=tmp_filename, dtype=dtype, mode="w+", shape=data.shape
+    )
+    for idx in range(0, len(data), chunk_size):
+        array[idx : idx + chunk_size] = data[idx : idx + chunk_size]
+    array.flush()
+    del array, data  # close memory maps before replacing the file
+
+    os.replace(tmp_filename, filename)
+    print(f"Converted '{filename}' to {dtype}.")
+
+
+def load_tokens(filename: str) -> np.ndarray:
+    """
+    Memory-map a token file written by `save_shakespeare` or `save_openweb`.
+    Nothing is read into memory until the tokens are accessed, so loading is
+    near-instant, works for datasets larger than RAM, and the page cache is
+    shared between processes (e.g. DDP ranks) reading the same file.
+
+    Args:
+        filename: Path to the `.npy` token file.
+
+    Returns:
+        Read-only memory-mapped token array of shape `(num_tokens,)`.
+    """
+    try:
+        # `dtype` and shape are read from the `.npy` header
+        return np.load(filename, mmap_mode="r")
+    except ValueError:
+        # raw `int64` token stream without header (written by older versions
+        # of `save_openweb`)
+        return np.memmap(filename, dtype=np.int64, mode="r")
+
+
 def save_shakespeare(train_split: int) -> None:
     """
     Save the Shakespeare dataset as well as meta data to disk.
@@ -70,8 +140,10 @@ def save_shakespeare(train_split: int) -> None:
     vocab = sorted(list(set(text)))
     vocab_size = len(vocab)
 
-    # tokenize the text
-    data = np.array(encode(text, vocab=vocab), dtype=np.int64)
+    # tokenize the text (stored in the narrowest possible dtype)
+    data = np.array(
+        encode(text, vocab=vocab), dtype=get_token_dtype(vocab_size)
+    )
     print(
         f"Length of dataset in characters: {len(text)}\nFirst 100 "
         f"characters of dataset: {text[:100]}\nVocabulary size: "
@@ -87,7 +159,11 @@ def save_shakespeare(train_split: int) -> None:
     # save train/val data and metadata
     np.save("train_data_shakespeare.npy", train_data)
     np.save("val_data_shakespeare.npy", val_data)
-    meta_data = {"vocab": vocab, "vocab_size": vocab_size}
+    meta_data = {
+        "vocab": vocab,
+        "vocab_size": vocab_size,
+        "dtype": data.dtype.name,
+    }
     with open("meta.json", "w") as f:
         json.dump(meta_data, f)
 
@@ -101,6 +177,10 @@ def save_openweb(train_split: int, num_proc: Optional[int] = None) -> None:
         num_proc: Number of processes when downloading and generating the
             dataset locally. Multiprocessing is disabled by default.
     """
+    # heavy dependencies, only imported for the OpenWebText dataset
+    import datasets
+    import tiktoken
+
     split_dataset = datasets.load_dataset(
         "openwebtext", split=datasets.Split.TRAIN, num_proc=num_proc
     ).train_test_split(
@@ -144,9 +224,11 @@ def save_openweb(train_split: int, num_proc: Optional[int] = None) -> None:
     for split, dset in dataset_dict.items():
         # total number of tokens over all sentences summed:
         arr_len = np.sum(dset["len"], dtype=np.int64)
-        array = np.memmap(
+        # memory-mapped `.npy` file, i.e. including a header with `dtype` and
+        # shape, such that it can be memory-mapped again by `load_tokens`
+        array = np.lib.format.open_memmap(
             filename=f"{split}_data_openweb.npy",
-            dtype=np.int64,
+            dtype=get_token_dtype(bpe_tokenizer.n_vocab),
             mode="w+",
             shape=(arr_len,),
         )
@@ -171,6 +253,7 @@ def main(
     train_split: int = 0.8,
     dataset: str = "shakespeare",
     num_proc: Optional[int] = None,
+    convert: bool = False,
 ) -> None:
     """
     Save the chosen dataset (and some meta data for the Shakespeare dataset)
@@ -181,6 +264,8 @@ def main(
         dataset: Dataset to use. Options are 'shakespeare' and 'openweb'.
         num_proc: Number of processes when downloading and generating the
             openweb dataset locally. Multiprocessing is disabled by default.
+        convert: Whether to convert the existing token files of the dataset
+            to the narrowest dtype instead of saving the dataset.
     """
     assert (
         0 < train_split < 1
@@ -193,7 +278,24 @@ def main(
     if dataset == "shakespeare" and num_proc is not None:
         warn("Argument `num_proc` is ignored for the Shakespeare dataset.")
 
-    if dataset == "shakespeare":
+    if convert:
+        if dataset == "shakespeare":
+            with open("meta.json", "r") as f:
+                meta_data = json.load(f)
+            vocab_size = meta_data["vocab_size"]
+        else:
+            import tiktoken
+
+            vocab_size = tiktoken.get_encoding("gpt2").n_vocab
+
+        for split in ["train", "val"]:
+            convert_tokens(f"{split}_data_{dataset}.npy", vocab_size)
+
+        if dataset == "shakespeare":
+            meta_data["dtype"] = get_token_dtype(vocab_size).name
+            with open("meta.json", "w") as f:
+                json.dump(meta_data, f)
+    elif dataset == "shakespeare":
         save_shakespeare(train_split=train_split)
     else:
         save_openweb(train_split=train_split, num_proc=num_proc)
@@ -208,4 +310,5 @@ if __name__ == "__main__":
         train_split=args.train_split,
         dataset=args.dataset,
         num_proc=args.num_proc,
+        convert=args.convert,
     )
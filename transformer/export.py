@@ -0,0 +1,65 @@
+"""
+Export a training checkpoint to a slim weights-only checkpoint for inference.
+"""
+import logging
+import sys
+
+import torch
+from utils import get_model_args, retrieve_args, strip_state_dict_prefixes
+
+from options import get_parser
+
+if __name__ == "__main__":
+    # configure logging before parsing the arguments, since checking them
+    # might already log (which would configure the root logger implicitly)
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    parser = get_parser()
+    args = retrieve_args(parser)
+
+    assert args.loading_path is not None and args.export_path is not None, (
+        "Please specify the checkpoint to export (`--loading_path`) and the "
+        "path of the exported checkpoint (`--export_path`)."
+    )
+
+    checkpoint = torch.load(args.loading_path, map_location="cpu", mmap=True)
+    state_dict = strip_state_dict_prefixes(checkpoint["state_dict"])
+    # the embedding and pre-softmax weights are tied, but checkpoints might
+    # store them separately (e.g. written before the checkpoint manager kept
+    # shared tensors shared), so tie them again to store them only once
+    if torch.equal(
+        state_dict["embedding.weight"], state_dict["pre_softmax_linear.weight"]
+    ):
+        state_dict["embedding.weight"] = state_dict[
+            "pre_softmax_linear.weight"
+        ]
+
+    # cast floating-point tensors, keeping tensors that share memory (i.e.
+    # the tied embedding and pre-softmax weights) shared
+    dtype = getattr(torch, args.export_dtype)
+    cast_tensors = {}
+    for key, tensor in state_dict.items():
+        if tensor.data_ptr() not in cast_tensors:
+            cast_tensors[tensor.data_ptr()] = (
+                tensor.to(dtype) if tensor.is_floating_point() else tensor
+            )
+        state_dict[key] = cast_tensors[tensor.data_ptr()]
+
+    # the vocabulary size is determined by the tokenizer of the dataset
+    vocab_size, embedding_dim = state_dict["pre_softmax_linear.weight"].shape
+    assert embedding_dim == args.embedding_dim, (
+        f"Checkpoint has an embedding dimension of {embedding_dim}, but "
+        f"`--embedding_dim` is {args.embedding_dim}."
+    )
+    model_args = get_model_args(args, vocab_size=vocab_size)
+
+    torch.save(
+        {"model_args": model_args, "state_dict": state_dict}, args.export_path
+    )
+    logging.info(
+        f"=> Exported '{args.loading_path}' to '{args.export_path}' "
+        f"({args.export_dtype})."
+    )
@@ -32,6 +32,153 @@ def get_parser__data_prep() -> argparse.ArgumentParser:
             "openweb dataset locally. Multiprocessing is disabled by default."
         ),
     )
+    parser.add_argument(
+        "--convert",
+        action="store_true",
+        help=(
+            "Convert the existing token files of the dataset (e.g. stored "
+            "as `int64`) to the narrowest dtype instead of saving the "
+            "dataset."
+        ),
+    )
+    return parser
+
+
+def get_parser__benchmark() -> argparse.ArgumentParser:
+    """
+    Get parser for command line arguments when running benchmark script.
+
+    Returns:
+        parser for command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Parameters when running benchmark script."
+    )
+    parser.add_argument(
+        "--task",
+        type=str,
+        default="lm_head",
+        choices=[
+            "lm_head",
+            "attention",
+            "get_batch",
+            "import_time",
+            "generate",
+            "decode",
+            "sampling",
+            "speculative",
+            "beam_search",
+            "rolling",
+        ],
+        help=(
+            "Benchmark to run. 'lm_head': forward pass with logits for all "
+            "vs. only the last position. 'attention': training step with "
+            "the different attention backends. 'get_batch': host-side batch "
+            "sampling. 'import_time': startup (import) time of `run.py` and "
+            "`data.py`. 'generate': generation throughput for batches of "
+            "prompts (of different lengths) up to `batch_size`. 'decode': "
+            "decoding latency in eager mode and compiled with dynamic or "
+            "static shapes. 'sampling': per-step overhead of sampling the "
+            "next token with the different logits processors. 'speculative': "
+            "decoding latency with and without speculative decoding, within "
+            "and beyond `block_size`. 'beam_search': decoding latency of beam search for increasing "
+            "beam widths. 'rolling': decoding latency beyond `block_size` "
+            "with and without rolling key/value caches."
+        ),
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Batch size.",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=512,
+        help="Maximum context length.",
+    )
+    parser.add_argument(
+        "--vocab_size",
+        type=int,
+        default=50257,
+        help="Vocabulary size (default: GPT-2 tokenizer).",
+    )
+    parser.add_argument(
+        "--num_tokens",
+        type=int,
+        default=int(1e7),
+        help="Number of tokens of the synthetic dataset.",
+    )
+    parser.add_argument(
+        "--embedding_dim",
+        type=int,
+        default=512,
+        help="Embedding dimensionality (`d_model`).",
+    )
+    parser.add_argument(
+        "--num__decoder_layers",
+        type=int,
+        default=6,
+        help="Number of times to stack the decoder block.",
+    )
+    parser.add_argument(
+        "--num_heads",
+        type=int,
+        default=8,
+        help="Number of heads for the multi-head attention.",
+    )
+    parser.add_argument(
+        "--dim_feedfwd",
+        type=int,
+        default=2048,
+        help="Hidden dimension when applying two-layer MLP in decoder blocks.",
+    )
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=64,
+        help="Number of tokens to generate per prompt.",
+    )
+    parser.add_argument(
+        "--num_repeats",
+        type=int,
+        default=10,
+        help="Number of timed repetitions per benchmarked variant.",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cpu",
+        help="Device on which the benchmark is run, e.g. 'cpu' or 'cuda:0'.",
+    )
+    return parser
+
+
+def get_parser__supervise() -> argparse.ArgumentParser:
+    """
+    Get parser for command line arguments when running supervisor script.
+    All unknown arguments are passed on to `run.py`.
+
+    Returns:
+        parser for command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Parameters when running supervisor script."
+    )
+    parser.add_argument(
+        "--max_restarts",
+        type=int,
+        default=10,
+        help="Maximum number of relaunches after a crash.",
+    )
+    parser.add_argument(
+        "--restart_delay",
+        type=float,
+        default=10,
+        help="Time (in seconds) to wait before relaunching.",
+    )
+
     return parser
 
 
@@ -71,24 +218,86 @@ def get_parser() -> argparse.ArgumentParser:
         default=None,
         help="Configuration file.",
     )
+    parser.add_argument(
+        "--export_path",
+        type=str,
+        default=None,
+        help=(
+            "Path of the weights-only checkpoint that `export.py` writes for "
+            "the checkpoint in `--loading_path`."
+        ),
+    )
+    parser.add_argument(
+        "--export_dtype",
+        type=str,
+        choices=["float32", "float16", "bfloat16"],
+        default="float32",
+        help="Data type of the weights of the exported checkpoint.",
+    )
     parser.add_argument(
         "--dataset",
         type=str,
         default="shakespeare",
         help="Dataset to use. Should be 'shakespeare' or 'openweb'.",
     )
+    parser.add_argument(
+        "--debug_syncs",
+        action="store_true",
+        help=(
+            "Whether to warn about host-device synchronizations in the "
+            "training loop (CUDA only), apart from reading back the logged "
+            "metrics. Note that with AMP, the gradient scaler synchronizes "
+            "once per step."
+        ),
+    )
     parser.add_argument(
         "--eps",
         type=float,
         default=1e-8,
         help="epsilon of the ADAM(W) optimizer.",
     )
+    parser.add_argument(
+        "--eval_interval",
+        type=int,
+        default=None,
+        help=(
+            "Frequency (in steps) at which the validation loss is estimated. "
+            "Defaults to `--log_freq_loss`."
+        ),
+    )
+    parser.add_argument(
+        "--eval_iters",
+        type=int,
+        default=10,
+        help="Number of validation batches per validation loss estimate.",
+    )
+    parser.add_argument(
+        "--grad_accum_steps",
+        type=int,
+        default=1,
+        help=(
+            "Number of micro-batches (each of `--batch_size`) whose gradients "
+            "are accumulated per optimizer step, i.e. the effective batch "
+            "size is `batch_size * grad_accum_steps`. With DDP, gradients "
+            "are only all-reduced for the last micro-batch."
+        ),
+    )
     parser.add_argument(
         "--log_freq_loss",
         type=int,
         default=1,
         help="Frequency at which train and val losser are logged.",
     )
+    parser.add_argument(
+        "--loss_chunk_size",
+        type=int,
+        default=None,
+        help=(
+            "If specified, the logits and the loss are computed in chunks of "
+            "this many positions (and recomputed in the backward pass), "
+            "such that the logits of the whole batch are never materialized."
+        ),
+    )
     parser.add_argument(
         "--lr_multiplier",
         type=float,
@@ -104,16 +313,67 @@ def get_parser() -> argparse.ArgumentParser:
         default=None,
         help="Max norm for gradient clipping.",
     )
+    parser.add_argument(
+        "--keep_best",
+        type=int,
+        default=1,
+        help="Number of checkpoints with the lowest validation loss to keep.",
+    )
+    parser.add_argument(
+        "--keep_last",
+        type=int,
+        default=0,
+        help=(
+            "Number of most recent checkpoints to keep. If positive, the "
+            "state after the last step is saved as well."
+        ),
+    )
+    parser.add_argument(
+        "--save_interval",
+        type=int,
+        default=None,
+        help=(
+            "Frequency (in steps) of periodic checkpoints (requires "
+            "`--keep_last` > 0)."
+        ),
+    )
+    parser.add_argument(
+        "--save_interval__minutes",
+        type=float,
+        default=None,
+        help=(
+            "Frequency (in minutes) of periodic checkpoints (requires "
+            "`--keep_last` > 0)."
+        ),
+    )
     parser.add_argument(
         "--num_workers",
         type=int,
         default=0,
-        help="Number of subprocesses used in the dataloaders.",
+        help=(
+            "Number of background threads that prefetch batches. For `0`, "
+            "batches are sampled synchronously."
+        ),
     )
     parser.add_argument(
         "--pin_memory",
         action="store_true",
-        help="Whether tensors are copied into CUDA pinned memory.",
+        help=(
+            "Whether prefetched batches are gathered into CUDA pinned memory "
+            "and copied asynchronously to the GPU."
+        ),
+    )
+    parser.add_argument(
+        "--sampling",
+        type=str,
+        default="random",
+        choices=["random", "shuffle"],
+        help=(
+            "How training and validation windows are sampled. 'random': "
+            "uniformly at random with replacement. 'shuffle': without "
+            "replacement, i.e. non-overlapping windows that are shuffled per "
+            "epoch and sharded across DDP ranks."
+        ),
     )
     parser.add_argument(
         "--saving_path",
@@ -162,6 +422,16 @@ def get_parser() -> argparse.ArgumentParser:
             "`args.num_steps` steps.",
         ),
     )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+        help=(
+            "Checkpoint to resume training from, including the learning rate "
+            "schedule, gradient scaler, data cursors and random states. For "
+            "`auto`, the latest checkpoint in `saving_path` is used (if any)."
+        ),
+    )
     parser.add_argument(
         "--use_amp",
         action="store_true",
@@ -180,6 +450,19 @@ def get_parser() -> argparse.ArgumentParser:
     )
 
     # transformer-specific arguments
+    parser.add_argument(
+        "--attn_backend",
+        type=str,
+        default="auto",
+        choices=["naive", "sdpa", "auto"],
+        help=(
+            "Implementation of the scaled dot-product attention. 'naive' "
+            "materializes the attention weights, 'sdpa' uses the fused "
+            "`torch.nn.functional.scaled_dot_product_attention` with "
+            "implicit causal masking, 'auto' uses 'sdpa' unless attention "
+            "weights are requested."
+        ),
+    )
     parser.add_argument(
         "--dim_feedfwd",
         type=int,
@@ -192,6 +475,25 @@ def get_parser() -> argparse.ArgumentParser:
         default=0.0,
         help="Dropout rate for the dropout layer.",
     )
+    parser.add_argument(
+        "--num__extra_heads",
+        type=int,
+        default=0,
+        help=(
+            "Number of extra prediction heads, which are trained to predict "
+            "the tokens 2, 3, ... positions ahead and can draft tokens in "
+            "speculative decoding (cf. `--use_extra_heads`)."
+        ),
+    )
+    parser.add_argument(
+        "--extra_heads_loss_weight",
+        type=float,
+        default=0.2,
+        help=(
+            "Weight of the auxiliary loss of the extra prediction heads, "
+            "added to the next-token loss."
+        ),
+    )
     parser.add_argument(
         "--embedding_dim",
         type=int,
@@ -222,6 +524,127 @@ def get_parser() -> argparse.ArgumentParser:
         default=100,
         help="Maximum number of tokens to generate.",
     )
+    parser.add_argument(
+        "--prompts",
+        type=str,
+        nargs="+",
+        default=None,
+        help=(
+            "Prompts to generate from (in a single batch). Default is a "
+            "single newline."
+        ),
+    )
+    parser.add_argument(
+        "--static_decoding",
+        action="store_true",
+        help=(
+            "Whether to generate with static shapes (preallocated caches and "
+            "bucketed prompts), such that with `--compile_mode`, a single "
+            "compiled decoding step is reused for every token. Stop strings "
+            "are not supported."
+        ),
+    )
+    parser.add_argument(
+        "--rolling_kv_cache",
+        action="store_true",
+        help=(
+            "Whether to generate beyond `block_size` with rolling key/value "
+            "caches of `block_size` slots (constant memory and cost per "
+            "token), instead of re-encoding the last `block_size` tokens in "
+            "every step."
+        ),
+    )
+    parser.add_argument(
+        "--num_sink_tokens",
+        type=int,
+        default=4,
+        help=(
+            "Number of first tokens that the rolling key/value caches keep "
+            "(attention sinks)."
+        ),
+    )
+    parser.add_argument(
+        "--draft_loading_path",
+        type=str,
+        default=None,
+        help=(
+            "Exported checkpoint (cf. `export.py`) of a small draft model "
+            "with the same vocabulary (e.g. fewer `num__decoder_layers` and "
+            "a smaller `embedding_dim`). If provided, text is generated with "
+            "speculative decoding."
+        ),
+    )
+    parser.add_argument(
+        "--num_draft_tokens",
+        type=int,
+        default=4,
+        help=(
+            "Maximum number of tokens proposed per draft in speculative "
+            "decoding."
+        ),
+    )
+    parser.add_argument(
+        "--prompt_lookup",
+        action="store_true",
+        help=(
+            "Whether to generate with speculative decoding without a draft "
+            "model, proposing the tokens that followed the most recent "
+            "earlier occurrence of the last tokens (in the prompt or the "
+            "generated text)."
+        ),
+    )
+    parser.add_argument(
+        "--max_ngram_size",
+        type=int,
+        default=3,
+        help="Maximum number of last tokens matched in prompt lookup.",
+    )
+    parser.add_argument(
+        "--use_extra_heads",
+        action="store_true",
+        help=(
+            "Whether to generate with speculative decoding, where the extra "
+            "prediction heads of the model (cf. `--num__extra_heads`) draft "
+            "the next tokens."
+        ),
+    )
+    parser.add_argument(
+        "--num_beams",
+        type=int,
+        default=1,
+        help=(
+            "Number of beams. If larger than 1, text is generated "
+            "deterministically with beam search instead of sampling."
+        ),
+    )
+    parser.add_argument(
+        "--length_penalty",
+        type=float,
+        default=1.0,
+        help=(
+            "Exponent of the length normalization of the beam scores: values "
+            "> 0 favor longer, values < 0 shorter sequences."
+        ),
+    )
+    parser.add_argument(
+        "--early_stopping",
+        action="store_true",
+        help=(
+            "Whether beam search stops for a prompt as soon as it has "
+            "`num_beams` finished hypotheses."
+        ),
+    )
+    parser.add_argument(
+        "--stop_strings",
+        type=str,
+        nargs="+",
+        default=None,
+        help=(
+            "Strings after which generation stops (for each prompt "
+            "separately). With GPT2 encoding, generation also stops at the "
+            "end-of-text token."
+        ),
+    )
     parser.add_argument(
         "--temperature",
         type=float,
@@ -234,6 +657,59 @@ def get_parser() -> argparse.ArgumentParser:
         default=None,
         help="Top-k sampling.",
     )
+    parser.add_argument(
+        "--top_p",
+        type=float,
+        default=None,
+        help=(
+            "Top-p (nucleus) sampling: sample from the smallest set of most "
+            "likely tokens whose probabilities sum to at least `top_p`."
+        ),
+    )
+    parser.add_argument(
+        "--min_p",
+        type=float,
+        default=None,
+        help=(
+            "Min-p sampling: sample from the tokens whose probability is at "
+            "least `min_p` times that of the most likely token."
+        ),
+    )
+    parser.add_argument(
+        "--repetition_penalty",
+        type=float,
+        default=None,
+        help=(
+            "Repetition penalty for tokens that already occur (prompt or "
+            "generated), e.g. `1.2`. `1` means no penalty."
+        ),
+    )
+    parser.add_argument(
+        "--frequency_penalty",
+        type=float,
+        default=None,
+        help=(
+            "Subtracted from the logit of a token per occurrence. `0` means "
+            "no penalty."
+        ),
+    )
+    parser.add_argument(
+        "--presence_penalty",
+        type=float,
+        default=None,
+        help=(
+            "Subtracted once from the logit of every token that occurs. `0` "
+            "means no penalty."
+        ),
+    )
+    parser.add_argument(
+        "--gumbel_sampling",
+        action="store_true",
+        help=(
+            "Whether to sample via the Gumbel-max trick (`argmax` of the "
+            "logits perturbed with Gumbel noise) instead of a multinomial."
+        ),
+    )
     parser.add_argument(
         "--vocab_size",
         type=int,
@@ -8,7 +8,7 @@ from argparse import Namespace
 from datetime import datetime as dt
 
 import torch
-import wandb
+from checkpoint import CheckpointManager, find_latest_checkpoint
 from scheduler import LRScheduler
 from torch import multiprocessing as mp
 from torch import optim
@@ -16,13 +16,15 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from utils import (
     cleanup,
     generate_text,
+    get_model_args,
     load_checkpoint,
     load_datasets,
+    load_model,
     log_parameter_table,
     retrieve_args,
-    save_checkpoint,
     setup,
     train_and_validate,
+    unwrap_model,
 )
 
 from architecture.models import Transformer
@@ -58,15 +60,21 @@ def main(
     )
 
     # define transformer
-    model = Transformer(
-        num__decoder_layers=args.num__decoder_layers,
-        embedding_dim=args.embedding_dim,
-        num_heads=args.num_heads,
-        vocab_size=vocab_size,
-        dim_feedfwd=args.dim_feedfwd,
-        dropout_rate=args.dropout_rate,
-    )
-    model.to(rank)
+    model_args = get_model_args(args, vocab_size=vocab_size)
+    if args.train or args.loading_path is None:
+        model = Transformer(**model_args, attn_backend=args.attn_backend)
+        model.to(rank)
+    else:
+        # inference only: skip the random initialization and assign the
+        # memory-mapped weights of the checkpoint directly
+        model = load_model(
+            filename=args.loading_path,
+            model_args=model_args,
+            device=rank,
+            # half precision is slow on the CPU
+            dtype=torch.float32 if rank == torch.device("cpu") else None,
+            attn_backend=args.attn_backend,
+        )
     if args.use_ddp:
         model = DDP(model, device_ids=[rank])
 
@@ -74,6 +82,9 @@ def main(
     if rank in [0, torch.device("cpu")]:
         wandb_logging = args.wandb__api_key is not None and args.train
         if wandb_logging:
+            # heavy optional dependency, only imported when used
+            import wandb
+
             wandb.login(key=args.wandb__api_key)
             wandb.init(
                 project="transformer",
@@ -90,18 +101,19 @@ def main(
         logging.info(f"\nCompiling model in ``{args.compile_mode}`` mode...\n")
         model = torch.compile(model, mode=args.compile_mode, fullgraph=False)
 
-    # Optimizer:
-    optimizer = optim.Adam(
-        params=model.parameters(),
-        lr=1e-3,  # dummy, will be set by scheduler
-        betas=(args.beta_1, args.beta_2),
-        eps=args.eps,
-    )
+    if args.train:
+        # Optimizer:
+        optimizer = optim.Adam(
+            params=model.parameters(),
+            lr=1e-3,  # dummy, will be set by scheduler
+            betas=(args.beta_1, args.beta_2),
+            eps=args.eps,
+        )
 
-    # Set network to train mode:
-    model.train()
+        # Set network to train mode:
+        model.train()
 
-    if args.loading_path is not None:
+    if args.train and args.loading_path is not None:
         if rank == torch.device("cpu"):
             map_location = {"cuda:0": "cpu"}
         else:
@@ -115,6 +127,23 @@ def main(
             ),
         )
 
+    # resume training from a full training state
+    train_state = None
+    if args.train and args.resume is not None:
+        if args.resume == "auto":
+            resume_path = find_latest_checkpoint(args.saving_path)
+        else:
+            resume_path = args.resume
+
+        if resume_path is not None:
+            logging.info(f"=> Resuming from checkpoint '{resume_path}'.")
+            train_state = torch.load(resume_path, map_location="cpu")
+            load_checkpoint(
+                model=model, optimizer=optimizer, checkpoint=train_state
+            )
+        else:
+            logging.info(f"No checkpoint found in '{args.saving_path}'.")
+
     if args.train:
         lr_scheduler = LRScheduler(
             optimizer=optimizer,
@@ -122,7 +151,25 @@ def main(
             warmup_steps=args.warmup_steps,
             lr_multiplier=args.lr_multiplier,
         )
-        checkpoint = train_and_validate(
+        # only a single process saves checkpoints
+        if rank in [0, torch.device("cpu")]:
+            checkpoint_manager = CheckpointManager(
+                saving_path=args.saving_path,
+                prefix=f"cp_{dt.now().strftime('%dp%mp%Y_%Hp%M')}",
+                keep_best=args.keep_best,
+                keep_last=args.keep_last,
+                save_interval=args.save_interval,
+                save_interval__minutes=args.save_interval__minutes,
+            )
+            if train_state is not None:
+                # continue the retention of the resumed run
+                checkpoint_manager.load_state_dict(
+                    train_state["checkpoint_manager"]
+                )
+        else:
+            checkpoint_manager = None
+
+        train_and_validate(
             model=model,
             optimizer=optimizer,
             num_steps=args.num_steps,
@@ -136,17 +183,24 @@ def main(
             log_freq_loss=args.log_freq_loss,
             max_norm=args.max_norm,
             wandb_logging=wandb_logging,
+            loss_chunk_size=args.loss_chunk_size,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_memory,
+            sampling=args.sampling,
+            seed=args.seed_number,
+            grad_accum_steps=args.grad_accum_steps,
+            eval_interval=args.eval_interval,
+            eval_iters=args.eval_iters,
+            debug_syncs=args.debug_syncs,
+            checkpoint_manager=checkpoint_manager,
+            train_state=train_state,
+            extra_heads_loss_weight=args.extra_heads_loss_weight,
         )
+        del train_state
 
-        if rank in [0, torch.device("cpu")]:
-            # save model and optimizer state dicts
-            save_checkpoint(
-                state=checkpoint,
-                filename=os.path.join(
-                    args.saving_path,
-                    f"cp_{dt.now().strftime('%dp%mp%Y_%Hp%M')}.pt",
-                ),
-            )
+        if checkpoint_manager is not None:
+            # wait until all checkpoints are written
+            checkpoint_manager.close()
 
     # destroy process group if DDP was used (for clean exit)
     if args.use_ddp:
@@ -157,14 +211,46 @@ def main(
             wandb.finish()
 
         if args.train:
-            # load checkpoint with lowest validation loss for final evaluation;
-            # device does not need to be specified, since the checkpoint will
-            # be loaded on the CPU or GPU with ID 0 depending on where the
-            # checkpoint was saved
-            load_checkpoint(model=model, checkpoint=checkpoint)
+            # load checkpoint with lowest validation loss (or else the most
+            # recent one) for final evaluation; checkpoints are saved from
+            # CPU buffers, and `load_state_dict()` copies the tensors onto
+            # the device of the model
+            checkpoint_path = (
+                checkpoint_manager.best_checkpoint_path
+                or checkpoint_manager.last_checkpoint_path
+            )
+            if checkpoint_path is not None:
+                load_checkpoint(
+                    model=model,
+                    checkpoint=torch.load(checkpoint_path, map_location="cpu"),
+                )
+            else:
+                logging.info(
+                    "No checkpoint was saved, continuing with the trained "
+                    "model."
+                )
 
         model.eval()
 
+        draft_model = None
+        if args.draft_loading_path is not None:
+            draft_model = load_model(
+                filename=args.draft_loading_path,
+                device=rank,
+                dtype=torch.float32 if rank == torch.device("cpu") else None,
+                attn_backend=args.attn_backend,
+            )
+
+        if args.compile_mode is not None:
+            # `generate()` calls the forward pass of the unwrapped model
+            unwrap_model(model).compile_decoding(
+                mode=args.compile_mode, dynamic=not args.static_decoding
+            )
+            if draft_model is not None:
+                draft_model.compile_decoding(
+                    mode=args.compile_mode, dynamic=True
+                )
+
         generate_text(
             model=model,
             vocab=vocab,
@@ -174,6 +260,25 @@ def main(
             rank=rank,
             temperature=args.temperature,
             top_k=args.top_k,
+            top_p=args.top_p,
+            min_p=args.min_p,
+            repetition_penalty=args.repetition_penalty,
+            frequency_penalty=args.frequency_penalty,
+            presence_penalty=args.presence_penalty,
+            gumbel_sampling=args.gumbel_sampling,
+            prompts=args.prompts,
+            stop_strings=args.stop_strings,
+            static_shapes=args.static_decoding,
+            rolling_kv_cache=args.rolling_kv_cache,
+            num_sink_tokens=args.num_sink_tokens,
+            draft_model=draft_model,
+            num_draft_tokens=args.num_draft_tokens,
+            prompt_lookup=args.prompt_lookup,
+            max_ngram_size=args.max_ngram_size,
+            use_extra_heads=args.use_extra_heads,
+            num_beams=args.num_beams,
+            length_penalty=args.length_penalty,
+            early_stopping=args.early_stopping,
         )
 
 
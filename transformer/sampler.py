@@ -0,0 +1,180 @@
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+
+def derive_seed(*entropy: int) -> int:
+    """
+    Derive a seed for a random number generator from several integers (e.g.
+    base seed, rank and epoch), such that different inputs give independent
+    streams.
+
+    Args:
+        entropy: Non-negative integers.
+
+    Returns:
+        32-bit seed.
+    """
+    return int(np.random.SeedSequence(list(entropy)).generate_state(1)[0])
+
+
+class RandomWindowSampler:
+    """
+    Sample start indices of windows uniformly at random (with replacement),
+    using a dedicated random number generator.
+    """
+
+    def __init__(
+        self,
+        num_tokens: int,
+        batch_size: int,
+        block_size: int,
+        seed: Optional[int] = None,
+    ) -> None:
+        """
+        Initialize the sampler.
+
+        Args:
+            num_tokens: Number of tokens in the dataset.
+            batch_size: Number of windows per batch.
+            block_size: Maximum context length (each window has
+                `block_size + 1` tokens, as input and target overlap).
+            seed: Seed of the random number generator. If not provided, a
+                non-deterministic seed is used.
+        """
+        self.num_tokens = num_tokens
+        self.batch_size = batch_size
+        self.block_size = block_size
+
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def next_indices(self) -> np.ndarray:
+        """
+        Sample the start indices of the windows of the next batch.
+
+        Returns:
+            Start indices in shape `(batch_size,)`.
+        """
+        return torch.randint(
+            low=0,
+            high=self.num_tokens - self.block_size,
+            size=(self.batch_size,),
+            generator=self.generator,
+        ).numpy()
+
+    def state_dict(self) -> Dict:
+        """
+        Get the state of the sampler.
+        """
+        return {"generator": self.generator.get_state()}
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        """
+        Restore the state of the sampler.
+        """
+        self.generator.set_state(state_dict["generator"])
+
+
+class ShuffledWindowSampler:
+    """
+    Sample without replacement: the token stream is partitioned into
+    non-overlapping windows, which are shuffled once per epoch (with a seed
+    derived from `(seed, epoch)`, so that all ranks agree on the order) and
+    sharded across ranks, such that every rank sees different windows.
+    """
+
+    def __init__(
+        self,
+        num_tokens: int,
+        batch_size: int,
+        block_size: int,
+        seed: int = 0,
+        rank: int = 0,
+        world_size: int = 1,
+    ) -> None:
+        """
+        Initialize the sampler.
+
+        Args:
+            num_tokens: Number of tokens in the dataset.
+            batch_size: Number of windows per batch (per rank).
+            block_size: Maximum context length (each window has
+                `block_size + 1` tokens, as input and target overlap).
+            seed: Seed for shuffling, identical on all ranks.
+            rank: Rank of the current process.
+            world_size: Number of processes participating in the job.
+        """
+        assert (
+            0 <= rank < world_size
+        ), f"Rank should be between 0 and {world_size - 1}, but is {rank}."
+        self.num_tokens = num_tokens
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+
+        # cursor, i.e. position in the shard of the current epoch
+        self.epoch = 0
+        self.position = 0
+        self._set_epoch(self.epoch)
+
+    def _set_epoch(self, epoch: int) -> None:
+        """
+        Compute the window start indices of this rank for an epoch.
+
+        Args:
+            epoch: Epoch.
+        """
+        rng = np.random.default_rng(derive_seed(self.seed, epoch))
+
+        # shift the window grid randomly per epoch, such that windows do not
+        # always start at the same tokens
+        offset = rng.integers(self.block_size)
+        num_windows = (self.num_tokens - 1 - offset) // self.block_size
+        starts = offset + self.block_size * rng.permutation(num_windows)
+
+        # equally sized shards, such that all ranks take the same number of
+        # steps per epoch
+        num_windows__rank = num_windows // self.world_size
+        assert num_windows__rank >= self.batch_size, (
+            f"Dataset of {self.num_tokens} tokens is too small for a batch "
+            f"size of {self.batch_size} on each of {self.world_size} rank(s)."
+        )
+        self.starts = starts[self.rank :: self.world_size][:num_windows__rank]
+        self.epoch = epoch
+
+    def next_indices(self) -> np.ndarray:
+        """
+        Get the start indices of the windows of the next batch; a new epoch
+        starts once the remaining windows do not fill a batch.
+
+        Returns:
+            Start indices in shape `(batch_size,)`.
+        """
+        if self.position + self.batch_size > len(self.starts):
+            self._set_epoch(self.epoch + 1)
+            self.position = 0
+
+        indices = self.starts[self.position : self.position + self.batch_size]
+        self.position += self.batch_size
+
+        return indices
+
+    def state_dict(self) -> Dict:
+        """
+        Get the state (cursor) of the sampler.
+        """
+        return {"epoch": self.epoch, "position": self.position}
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        """
+        Restore the state (cursor) of the sampler.
+        """
+        self._set_epoch(state_dict["epoch"])
+        self.position = state_dict["position"]
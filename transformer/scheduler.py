@@ -1,3 +1,5 @@
+from typing import Dict
+
 from torch.optim import Optimizer
 
 
@@ -55,3 +57,22 @@ class LRScheduler:
         """
         self.step_num += 1
         self._update_lr()
+
+    def state_dict(self) -> Dict:
+        """
+        Get the state of the scheduler (without the optimizer).
+        """
+        return {
+            key: value
+            for key, value in self.__dict__.items()
+            if key != "optimizer"
+        }
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        """
+        Restore the state of the scheduler and the learning rate of the
+        optimizer.
+        """
+        self.__dict__.update(state_dict)
+        if self.step_num > 0:
+            self._update_lr()
@@ -0,0 +1,48 @@
+"""
+Relaunch `run.py` after a crash (e.g. preemption), resuming from the latest
+checkpoint in `saving_path`.
+"""
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from options import get_parser__supervise
+
+if __name__ == "__main__":
+    parser = get_parser__supervise()
+    args, run_args = parser.parse_known_args()
+
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+
+    # always resume from the latest checkpoint (a fresh run on first launch)
+    if "--resume" not in run_args:
+        run_args += ["--resume", "auto"]
+    if "--train" not in run_args:
+        run_args.append("--train")
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py"),
+        *run_args,
+    ]
+
+    for num_restarts in range(args.max_restarts + 1):
+        logging.info(f"Launching (restart {num_restarts}): {command}")
+        return_code = subprocess.call(command)
+        if return_code == 0:
+            break
+
+        if num_restarts == args.max_restarts:
+            logging.info(f"Giving up after {args.max_restarts} restarts.")
+            sys.exit(return_code)
+
+        logging.info(
+            f"`run.py` exited with code {return_code}, relaunching in "
+            f"{args.restart_delay} s..."
+        )
+        time.sleep(args.restart_delay)
@@ -3,31 +3,33 @@ import gc
 import json
 import logging
 import os
-import shutil
+import random
 import sys
-import urllib
 from argparse import ArgumentParser, Namespace
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from copy import deepcopy
-from math import ceil
+from functools import partial
 from time import perf_counter
 from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-import datasets
 import numpy as np
-import tiktoken
 import torch
-import wandb
-from prettytable import PrettyTable
+from checkpoint import CheckpointManager
+from sampler import RandomWindowSampler, ShuffledWindowSampler, derive_seed
 from scheduler import LRScheduler
 from torch import Tensor, autocast
 from torch import distributed as dist
 from torch import nn
 from torch.cuda.amp import GradScaler
 from torch.nn.utils import clip_grad_norm_
-from torch.utils.data import DataLoader, DistributedSampler, IterableDataset
 
-from architecture.attention import get_subsequent_mask
-from data import decode, encode
+from architecture.beam_search import beam_search
+from architecture.models import Transformer
+from architecture.sampling import get_token_sampler
+from architecture.speculative import speculative_generate
+from data import decode, encode, load_tokens
 
 
 def total_norm__grads(model: nn.Module) -> float:
@@ -147,6 +149,95 @@ def check_args(args: Namespace) -> None:
         "``dropout_rate`` should be chosen between 0 (inclusive) and 1 "
         f"(exclusive), but is {args.dropout_rate}."
     )
+    assert args.eval_iters >= 1, (
+        f"Number of validation batches should be at least 1, but is "
+        f"{args.eval_iters}."
+    )
+    if args.resume is not None:
+        assert args.loading_path is None, (
+            "Either resume training (`--resume`) or load a checkpoint "
+            "(`--loading_path`), but not both."
+        )
+    assert (
+        args.top_p is None or 0 < args.top_p <= 1
+    ), f"`top_p` is {args.top_p}, must be in `(0, 1]`."
+    assert (
+        args.min_p is None or 0 < args.min_p <= 1
+    ), f"`min_p` is {args.min_p}, must be in `(0, 1]`."
+    assert (
+        args.repetition_penalty is None or args.repetition_penalty > 0
+    ), f"`repetition_penalty` is {args.repetition_penalty}, must be > 0."
+    assert args.num__extra_heads >= 0, (
+        f"`num__extra_heads` is {args.num__extra_heads}, must be "
+        "non-negative."
+    )
+    num_draft_modes = sum(
+        [
+            args.draft_loading_path is not None,
+            args.prompt_lookup,
+            args.use_extra_heads,
+        ]
+    )
+    if num_draft_modes > 0:
+        assert num_draft_modes == 1, (
+            "Please draft either with a draft model, with prompt lookup or "
+            "with the extra heads."
+        )
+        assert (
+            not args.use_extra_heads or args.num__extra_heads > 0
+        ), "Drafting with the extra heads requires `num__extra_heads > 0`."
+        assert (
+            not args.static_decoding
+        ), "Speculative decoding does not support static shapes."
+        assert (
+            args.repetition_penalty is None
+            and args.frequency_penalty is None
+            and args.presence_penalty is None
+        ), "Speculative decoding does not support penalties."
+        assert (
+            args.num_draft_tokens >= 1
+        ), f"`num_draft_tokens` is {args.num_draft_tokens}, must be >= 1."
+        assert (
+            args.max_ngram_size >= 1
+        ), f"`max_ngram_size` is {args.max_ngram_size}, must be >= 1."
+    assert not (
+        args.static_decoding and args.stop_strings
+    ), "Stop strings are not supported when decoding with static shapes."
+    if args.rolling_kv_cache:
+        assert (
+            args.num_beams == 1
+        ), "Rolling caches are not supported with beam search."
+        assert 0 <= args.num_sink_tokens < args.block_size, (
+            f"`num_sink_tokens` is {args.num_sink_tokens}, must be in "
+            f"[0, {args.block_size})."
+        )
+    assert (
+        args.num_beams >= 1
+    ), f"`num_beams` is {args.num_beams}, must be >= 1."
+    if args.num_beams > 1:
+        assert (
+            num_draft_modes == 0
+        ), "Beam search does not support speculative decoding."
+        assert (
+            not args.static_decoding
+        ), "Beam search does not support static shapes."
+    assert args.keep_best >= 1, (
+        "Number of best checkpoints to keep should be at least 1, but is "
+        f"{args.keep_best}."
+    )
+    assert args.keep_last >= 0, (
+        "Number of latest checkpoints to keep should be non-negative, but is "
+        f"{args.keep_last}."
+    )
+    if args.save_interval is not None or args.save_interval__minutes:
+        assert args.keep_last > 0, (
+            "Periodic checkpoints require `--keep_last` to be positive, but "
+            f"it is {args.keep_last}."
+        )
+    assert args.grad_accum_steps >= 1, (
+        "Number of gradient accumulation steps should be at least 1, but is "
+        f"{args.grad_accum_steps}."
+    )
     if args.train:
         assert (
             args.num_steps > 0
@@ -165,9 +256,10 @@ def check_args(args: Namespace) -> None:
 
 def load_datasets(
     dataset: str,
-) -> Tuple[Tensor, Tensor, int, Optional[List[str]]]:
+) -> Tuple[np.ndarray, np.ndarray, int, Optional[List[str]]]:
     """
-    Load Shakespeare or OpenWebText dataset.
+    Load Shakespeare or OpenWebText dataset. The token files written by
+    `data.py` are memory-mapped, not read into memory.
 
     Args:
         dataset: Dataset to load. Should be 'shakespeare' or 'openweb'.
@@ -177,18 +269,20 @@ def load_datasets(
         For the openwebtext dataset, the vocabulary is `None`.
     """
     if dataset == "shakespeare":
-        train_data = torch.load("train_data_shakespeare.pt")
-        val_data = torch.load("val_data_shakespeare.pt")
+        train_data = load_tokens("train_data_shakespeare.npy")
+        val_data = load_tokens("val_data_shakespeare.npy")
         with open("meta.json", "r") as f:
             meta_data = json.load(f)
         vocab_size = meta_data["vocab_size"]
         vocab = meta_data["vocab"]
 
     elif dataset == "openweb":
+        import tiktoken
+
         bpe_tokenizer = tiktoken.get_encoding("gpt2")
 
-        train_data = torch.load("train_data_openweb.pt")
-        val_data = torch.load("val_data_openweb.pt")
+        train_data = load_tokens("train_data_openweb.npy")
+        val_data = load_tokens("val_data_openweb.npy")
         vocab_size = bpe_tokenizer.n_vocab
         vocab = None
 
@@ -202,7 +296,7 @@ def load_datasets(
 
 
 def get_batch(
-    data: Tensor,
+    data: np.ndarray,
     batch_size: int,
     block_size: int,
     device: torch.device | str | int = "cpu",
@@ -211,7 +305,7 @@ def get_batch(
     Get batch of data.
 
     Args:
-        data: Train or validation data.
+        data: Train or validation data (memory-mapped token array).
         batch_size: Batch size.
         block_size: Maximum context length.
         device: Device on which the code is executed.
@@ -222,16 +316,240 @@ def get_batch(
     """
     indices = torch.randint(
         low=0, high=len(data) - block_size, size=(batch_size,)
-    )
+    ).numpy()
+    windows = gather_windows(data, indices=indices, block_size=block_size)
+    windows = widen_tokens(windows, device=device)
 
-    input = torch.stack(
-        [data[idx : idx + block_size] for idx in indices], dim=0
-    )
-    target = torch.stack(
-        [data[idx + 1 : idx + block_size + 1] for idx in indices], dim=0
-    )
+    # input and target are views of the same tensor
+    return windows[:, :-1], windows[:, 1:]
 
-    return input.to(device), target.to(device)
+
+def gather_windows(
+    data: np.ndarray, indices: np.ndarray, block_size: int
+) -> Tensor:
+    """
+    Gather windows of `block_size + 1` tokens (input and target overlap) in a
+    single indexing operation; only the sampled windows are read from the
+    memory-mapped buffer.
+
+    Args:
+        data: Train or validation data (memory-mapped token array).
+        indices: Start indices of the windows, shape `(N,)`.
+        block_size: Maximum context length.
+
+    Returns:
+        Windows in shape `(N, block_size + 1)`, kept in the compact storage
+        dtype (cf. `widen_tokens`).
+    """
+    windows = data[indices[:, None] + np.arange(block_size + 1)]
+    if windows.dtype == np.uint16:
+        # there is no `uint16` tensor dtype, so reinterpret the bits as
+        # `int16` (undone by `widen_tokens`)
+        windows = windows.view(np.int16)
+
+    return torch.from_numpy(windows)
+
+
+def widen_tokens(
+    tokens: Tensor,
+    device: torch.device | str | int = "cpu",
+    non_blocking: bool = False,
+) -> Tensor:
+    """
+    Move tokens to the device in their compact storage dtype and only widen
+    them to `int64` (as required by the embedding layer) there.
+
+    Args:
+        tokens: Tokens stored as `uint8`, `int16` (reinterpreted `uint16`),
+            `int32` or `int64`.
+        device: Device on which the code is executed.
+        non_blocking: Whether to copy asynchronously (from pinned memory).
+
+    Returns:
+        Tokens as `int64` tensor on the device.
+    """
+    tokens = tokens.to(device, non_blocking=non_blocking)
+    if tokens.dtype == torch.int16:
+        # undo the sign extension of the reinterpreted `uint16` tokens
+        return tokens.long() & 0xFFFF
+
+    return tokens.long()
+
+
+def get_sampler(
+    sampling: str,
+    num_tokens: int,
+    batch_size: int,
+    block_size: int,
+    seed: Optional[int] = None,
+    stream: int = 0,
+) -> RandomWindowSampler | ShuffledWindowSampler:
+    """
+    Get the sampler of the windows for the current process.
+
+    Args:
+        sampling: `"random"` or `"shuffle"`.
+        num_tokens: Number of tokens in the dataset.
+        batch_size: Batch size (per rank).
+        block_size: Maximum context length.
+        seed: Base seed. For `"shuffle"`, `0` is used if not provided.
+        stream: Index of the stream, to decorrelate e.g. the train and
+            validation samplers.
+
+    Returns:
+        Sampler.
+    """
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+
+    if sampling == "random":
+        return RandomWindowSampler(
+            num_tokens=num_tokens,
+            batch_size=batch_size,
+            block_size=block_size,
+            seed=derive_seed(seed, rank, stream) if seed is not None else None,
+        )
+    elif sampling == "shuffle":
+        return ShuffledWindowSampler(
+            num_tokens=num_tokens,
+            batch_size=batch_size,
+            block_size=block_size,
+            seed=derive_seed(seed or 0, stream),
+            rank=rank,
+            world_size=world_size,
+        )
+    else:
+        raise NotImplementedError(
+            f"Sampling '{sampling}' not recognized. Please choose either "
+            "'random' or 'shuffle'."
+        )
+
+
+class BatchPrefetcher:
+    """
+    Iterator over batches of data that are gathered by background threads,
+    such that sampling (and the host-to-device copy) overlaps with the
+    computation on the device. Up to `num_workers * prefetch_factor` batches
+    are kept ready in a bounded queue.
+    """
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        sampler: RandomWindowSampler | ShuffledWindowSampler,
+        block_size: int,
+        device: torch.device | str | int = "cpu",
+        num_workers: int = 0,
+        pin_memory: bool = False,
+        prefetch_factor: int = 2,
+    ) -> None:
+        """
+        Args:
+            data: Train or validation data (memory-mapped token array).
+            sampler: Sampler of the start indices of the windows per batch.
+            block_size: Maximum context length.
+            device: Device on which the code is executed.
+            num_workers: Number of background threads. For `0`, batches are
+                sampled synchronously (as with `get_batch`).
+            pin_memory: Whether batches are gathered into pinned memory and
+                copied asynchronously to the (CUDA) device.
+            prefetch_factor: Number of batches prefetched per thread; the
+                default of `2` amounts to double buffering.
+        """
+        self.data = data
+        self.sampler = sampler
+        self.block_size = block_size
+        self.device = device
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.num_prefetch = num_workers * prefetch_factor
+
+        self.executor = (
+            ThreadPoolExecutor(max_workers=num_workers)
+            if num_workers > 0
+            else None
+        )
+        # futures of the prefetched batches and sampler states after drawing
+        # them
+        self.pending = deque()
+        # sampler state after drawing the last consumed batch
+        self.sampler_state = deepcopy(sampler.state_dict())
+
+    def _sample_indices(self) -> Tuple[np.ndarray, Dict]:
+        """
+        Sample start indices of the windows of the next batch; this happens
+        in the main thread, so batches are drawn in a deterministic order.
+
+        Returns:
+            Start indices and sampler state after drawing them.
+        """
+        indices = self.sampler.next_indices()
+
+        return indices, deepcopy(self.sampler.state_dict())
+
+    def _load(self, indices: np.ndarray) -> Tensor:
+        """
+        Gather the windows of a batch (executed by the background threads).
+        """
+        windows = gather_windows(
+            self.data, indices=indices, block_size=self.block_size
+        )
+        # pinned memory is taken from PyTorch's caching host allocator, so
+        # buffers are reused once their asynchronous copy has finished
+        return windows.pin_memory() if self.pin_memory else windows
+
+    def __iter__(self) -> "BatchPrefetcher":
+        return self
+
+    def __next__(self) -> Tuple[Tensor, Tensor]:
+        """
+        Get the next batch.
+
+        Returns:
+            Batch of input in shape `(N, block_size)` and target tensors in
+            shape `(N, block_size)`.
+        """
+        if self.executor is None:
+            indices, self.sampler_state = self._sample_indices()
+            windows = self._load(indices)
+        else:
+            while len(self.pending) <= self.num_prefetch:
+                indices, sampler_state = self._sample_indices()
+                self.pending.append(
+                    (self.executor.submit(self._load, indices), sampler_state)
+                )
+            future, self.sampler_state = self.pending.popleft()
+            windows = future.result()
+
+        windows = widen_tokens(
+            windows, device=self.device, non_blocking=self.pin_memory
+        )
+
+        # input and target are views of the same tensor
+        return windows[:, :-1], windows[:, 1:]
+
+    def state_dict(self) -> Dict:
+        """
+        Get the sampler state (cursor) as of the last consumed batch, i.e.
+        ignoring prefetched batches.
+        """
+        return self.sampler_state
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        """
+        Restore the sampler state (cursor); must be called before the first
+        batch is drawn.
+        """
+        assert not self.pending, "Cannot restore state after prefetching."
+        self.sampler.load_state_dict(state_dict)
+        self.sampler_state = deepcopy(state_dict)
+
+    def close(self) -> None:
+        """
+        Stop the background threads.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.pending.clear()
 
 
 def train_and_validate(
@@ -239,8 +557,8 @@ def train_and_validate(
     optimizer: torch.optim.Optimizer,
     num_steps: int,
     batch_size: int,
-    train_data: Tensor,
-    val_data: Tensor,
+    train_data: np.ndarray,
+    val_data: np.ndarray,
     block_size: int,
     rank: int | torch.device,
     use_amp: bool,
@@ -248,14 +566,26 @@ def train_and_validate(
     log_freq_loss: int = 100,
     max_norm: Optional[float] = None,
     wandb_logging: bool = False,
-) -> Dict[torch.Tensor, torch.Tensor]:
+    loss_chunk_size: Optional[int] = None,
+    num_workers: int = 0,
+    pin_memory: bool = False,
+    sampling: str = "random",
+    seed: Optional[int] = None,
+    grad_accum_steps: int = 1,
+    eval_interval: Optional[int] = None,
+    eval_iters: int = 10,
+    debug_syncs: bool = False,
+    checkpoint_manager: Optional[CheckpointManager] = None,
+    train_state: Optional[Dict] = None,
+    extra_heads_loss_weight: float = 0.2,
+) -> None:
     """
     Train and validate the model.
 
     Args:
         model: Model to train.
         optimizer: Optimizer to use.
-        num_steps: Number of iterations to train.
+        num_steps: Number of iterations (optimizer steps) to train.
         batch_size: Batch size.
         train_data: Training data.
         val_data: Validation data.
@@ -270,121 +600,464 @@ def train_and_validate(
         world_size: Number of processes participating in the job. Used to get
             the number of iterations correctly in a DDP setup.
         wandb_logging: API key for Weights & Biases.
-
-    Returns:
-        checkpoint: Checkpoint of the model.
+        loss_chunk_size: If provided, the logits and the cross-entropy loss
+            are computed in chunks of `loss_chunk_size` positions, such that
+            the logits are never materialized for the whole batch.
+        num_workers: Number of background threads that prefetch batches.
+        pin_memory: Whether batches are prefetched into pinned memory and
+            copied asynchronously to the device.
+        sampling: How windows are sampled, `"random"` (uniformly, with
+            replacement) or `"shuffle"` (non-overlapping windows, shuffled
+            per epoch and sharded across DDP ranks).
+        seed: Seed of the samplers. Streams are derived per rank, so that DDP
+            ranks draw different windows.
+        grad_accum_steps: Number of micro-batches (of size `batch_size`)
+            whose gradients are accumulated per optimizer step.
+        eval_interval: Frequency (in steps) at which the validation loss is
+            estimated; defaults to `log_freq_loss`.
+        eval_iters: Number of validation batches per estimate.
+        debug_syncs: Whether to warn about every host-device synchronization
+            in the training loop (CUDA only), apart from reading back the
+            logged metrics.
+        checkpoint_manager: Saves the best (and periodic) checkpoints in the
+            background. Only provided on the process that saves checkpoints.
+        train_state: Checkpoint to resume from. The model and optimizer are
+            expected to be loaded already; the learning rate scheduler,
+            gradient scaler, data cursors and random number generators are
+            restored here, and training continues after the saved step. With
+            DDP, only the random state of rank 0 is saved, so the other ranks
+            continue with fresh random streams.
+        extra_heads_loss_weight: Weight of the auxiliary loss of the extra
+            prediction heads (if the model has any), which is added to the
+            next-token loss.
     """
 
-    # loss function:
-    cce_mean = nn.CrossEntropyLoss(reduction="mean")
-
-    # auxiliary variables:
-    train_losses, val_losses = [], []
-    min_val_loss = float("inf")
+    if wandb_logging:
+        # heavy optional dependency, only imported when used
+        import wandb
+
+    # auxiliary variables (running sums are kept on the device and only read
+    # back at logging steps, to avoid a host synchronization in every step):
+    train_loss_sum = torch.zeros((), device=rank)
+    extra_loss_sum = torch.zeros((), device=rank)
+    grad_norm_sum = torch.zeros((), device=rank)
+    has_extra_heads = len(unwrap_model(model).extra_heads) > 0
+    num_losses, num_grad_norms = 0, 0
+    eval_interval = eval_interval or log_freq_loss
+
+    is_main_process = rank in [0, torch.device("cpu")]
+    start_step = 0 if train_state is None else train_state["step"] + 1
+    if train_state is not None and not is_main_process:
+        # the random streams of the other ranks are not checkpointed, so they
+        # are re-derived from the step to not repeat those of the first run
+        torch.manual_seed(derive_seed(seed or 0, rank, start_step))
+        if sampling == "random" and seed is not None:
+            seed = derive_seed(seed, start_step)
 
     # for automatic mixed precision (AMP):
     scaler = GradScaler(enabled=use_amp)
 
-    # start timing:
-    start_time = start_timer(device=rank)
-
-    for step in range(num_steps):
-        model.train()
-
-        X, Y = get_batch(
-            data=train_data,
-            batch_size=batch_size,
+    # background batch producers:
+    train_loader, val_loader = [
+        BatchPrefetcher(
+            data=data,
+            sampler=get_sampler(
+                sampling=sampling,
+                num_tokens=len(data),
+                batch_size=batch_size,
+                block_size=block_size,
+                seed=seed,
+                stream=stream,
+            ),
             block_size=block_size,
             device=rank,
-        )  # X: `[N, block_size]`, Y: `[N, block_size]`
-        mask = get_subsequent_mask(size=X.shape[1], rank=rank)
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+        )
+        for stream, data in enumerate([train_data, val_data])
+    ]
 
-        optimizer.zero_grad()
+    if train_state is not None:
+        scaler.load_state_dict(train_state["scaler"])
         if lr_scheduler is not None:
-            lr_scheduler.step()
+            lr_scheduler.load_state_dict(train_state["lr_scheduler"])
+        # the cursor of the shuffled sampler is the same on all ranks
+        if is_main_process or sampling == "shuffle":
+            train_loader.load_state_dict(train_state["train_loader"])
+            val_loader.load_state_dict(train_state["val_loader"])
+        if is_main_process:
+            set_rng_state(train_state["rng_state"])
+        logging.info(f"=> Resuming training at step {start_step}.")
 
-        with autocast(
-            device_type=X.device.type,
-            dtype=torch.float16,
-            enabled=use_amp,
-        ):
-            output = model(X, mask=mask)  # `[N, block_size, vocab_size]`
-            loss = cce_mean(
-                output.reshape(-1, output.shape[-1]), Y.reshape(-1)
-            )
+    # start timing:
+    start_time = start_timer(device=rank)
 
-        scaler.scale(loss).backward()
-        if max_norm is not None:
-            scaler.unscale_(optimizer)
-            for param_group in optimizer.param_groups:
-                clip_grad_norm_(param_group["params"], max_norm=max_norm)
-        scaler.step(optimizer)
-        scaler.update()
-
-        train_losses.append(loss.item())
-
-        # validation stuff:
-        model.eval()
-        with torch.no_grad():
-            X, Y = get_batch(
-                data=val_data,
-                batch_size=batch_size,
-                block_size=block_size,
-                device=rank,
-            )
-            mask = get_subsequent_mask(size=X.shape[1], rank=rank)
+    for step in range(start_step, num_steps):
+        model.train()
 
-            with autocast(
-                device_type=X.device.type,
-                dtype=torch.float16,
-                enabled=use_amp,
-            ):
-                val_output = model(X, mask=mask)
-                val_loss = cce_mean(
-                    val_output.reshape(-1, val_output.shape[-1]),
-                    Y.reshape(-1),
+        # with `debug_syncs`, all host synchronizations apart from reading
+        # back the metrics at logging steps are reported
+        with sync_debug_mode("warn" if debug_syncs else "default"):
+            optimizer.zero_grad()
+            if lr_scheduler is not None:
+                lr_scheduler.step()
+
+            # accumulate gradients over micro-batches; with DDP, the gradient
+            # all-reduce is skipped for all but the last micro-batch
+            for micro_step in range(grad_accum_steps):
+                X, Y = next(train_loader)  # X, Y: `[N, block_size]`
+
+                if micro_step < grad_accum_steps - 1:
+                    sync_context = getattr(model, "no_sync", nullcontext)
+                else:
+                    sync_context = nullcontext
+                with sync_context():
+                    with autocast(
+                        device_type=X.device.type,
+                        dtype=torch.float16,
+                        enabled=use_amp,
+                    ):
+                        loss = model(
+                            X,
+                            is_causal=True,
+                            targets=Y,
+                            loss_chunk_size=loss_chunk_size,
+                            return_extra_loss=has_extra_heads,
+                        )
+                        if has_extra_heads:
+                            loss, extra_loss = loss
+                            total_loss = (
+                                loss + extra_heads_loss_weight * extra_loss
+                            )
+                            extra_loss_sum += extra_loss.detach()
+                        else:
+                            total_loss = loss
+
+                    # average (not sum) the gradients over the micro-batches
+                    scaler.scale(total_loss / grad_accum_steps).backward()
+
+                train_loss_sum += loss.detach()
+                num_losses += 1
+
+            if max_norm is not None:
+                scaler.unscale_(optimizer)
+                for param_group in optimizer.param_groups:
+                    grad_norm = clip_grad_norm_(
+                        param_group["params"], max_norm=max_norm
+                    )
+                    grad_norm_sum += grad_norm
+                    num_grad_norms += 1
+            # NOTE: with AMP, `scaler.step()` synchronizes to check for
+            # infs/NaNs in the gradients
+            scaler.step(optimizer)
+            scaler.update()
+
+            # validation (only every `eval_interval` steps):
+            is_eval_step = step % eval_interval == 0
+            if is_eval_step:
+                val_loss = evaluate(
+                    model=model,
+                    loader=val_loader,
+                    eval_iters=eval_iters,
+                    use_amp=use_amp,
+                    loss_chunk_size=loss_chunk_size,
                 )
-            val_losses.append(val_loss.item())
-
-        # log train and val losses:
-        if step % log_freq_loss == 0 and rank in [0, torch.device("cpu")]:
-            train_loss = np.mean(train_losses)
-            val_loss = np.mean(val_losses)
-            # reset losses:
-            train_losses, val_losses = [], []
 
-            logging.info(
-                f"step {step}: train loss: {train_loss:.4f}, val loss: "
-                f"{val_loss:.4f}, lr: {optimizer.param_groups[0]['lr']}"
-            )
+        # log train (and val) losses:
+        is_log_step = step % log_freq_loss == 0 or is_eval_step
+        if is_log_step:
+            # read back and reset running sums (single synchronization)
+            train_loss = (train_loss_sum / num_losses).item()
+            extra_loss = (extra_loss_sum / num_losses).item()
+            grad_norm = (grad_norm_sum / max(num_grad_norms, 1)).item()
+            if is_eval_step:
+                val_loss = val_loss.item()
+            train_loss_sum.zero_()
+            extra_loss_sum.zero_()
+            grad_norm_sum.zero_()
+            num_losses, num_grad_norms = 0, 0
+
+        if is_log_step and rank in [0, torch.device("cpu")]:
+            log_msg = f"step {step}: train loss: {train_loss:.4f}"
+            metrics = {"train_loss": train_loss, "step": step}
+            if is_eval_step:
+                log_msg += f", val loss: {val_loss:.4f}"
+                metrics["val_loss"] = val_loss
+            if has_extra_heads:
+                log_msg += f", extra heads loss: {extra_loss:.4f}"
+                metrics["extra_heads_loss"] = extra_loss
+            if max_norm is not None:
+                log_msg += f", grad norm: {grad_norm:.4f}"
+                metrics["grad_norm"] = grad_norm
+            # the learning rate is a Python float (no synchronization)
+            metrics["lr"] = optimizer.param_groups[0]["lr"]
+            logging.info(f"{log_msg}, lr: {metrics['lr']}")
             # log to Weights & Biases
             if wandb_logging:
-                wandb.log(
-                    {
-                        "train_loss": train_loss,
-                        "val_loss": val_loss,
-                        "step": step,
-                    },
-                    step=step,
-                )
+                wandb.log(metrics, step=step)
 
-            if val_loss < min_val_loss:
-                min_val_loss = val_loss
+        # save checkpoints (only on the process that owns the manager)
+        if checkpoint_manager is not None:
+            is_best = is_eval_step and checkpoint_manager.is_best(val_loss)
+            is_save_due = checkpoint_manager.is_save_due(
+                step, is_last_step=step == num_steps - 1
+            )
+            if is_best or is_save_due:
+                # full training state, such that training can be resumed
                 checkpoint = {
-                    "state_dict": deepcopy(model.state_dict()),
-                    "optimizer": deepcopy(optimizer.state_dict()),
-                    "val_loss": val_loss,
+                    "state_dict": model.state_dict(),
+                    "optimizer": optimizer.state_dict(),
                     "step": step,
+                    "lr_scheduler": (
+                        lr_scheduler.state_dict()
+                        if lr_scheduler is not None
+                        else None
+                    ),
+                    "scaler": scaler.state_dict(),
+                    "train_loader": train_loader.state_dict(),
+                    "val_loader": val_loader.state_dict(),
+                    "rng_state": get_rng_state(),
                 }
+                if is_eval_step:
+                    checkpoint["val_loss"] = val_loss
+                checkpoint_manager.save(
+                    state=checkpoint,
+                    step=step,
+                    val_loss=val_loss if is_eval_step else None,
+                )
 
-    if rank in [0, torch.device("cpu")]:
+    train_loader.close()
+    val_loader.close()
+
+    if is_main_process:
+        local_msg = f"Training {num_steps - start_step} steps"
+        if loss_chunk_size is not None:
+            # size of the logits with and without chunking
+            vocab_size = unwrap_model(model).pre_softmax_linear.out_features
+            num_bytes = (2 if use_amp else 4) * batch_size * vocab_size
+            chunk_mb = num_bytes * min(loss_chunk_size, block_size) / 1024**2
+            full_mb = num_bytes * block_size / 1024**2
+            local_msg += (
+                f" (logits: {chunk_mb:.3f} [MB] per chunk of "
+                f"{loss_chunk_size} positions instead of {full_mb:.3f} [MB])"
+            )
         end_timer_and_log(
             start_time=start_time,
             device=rank,
-            local_msg=f"Training {num_steps} steps",
+            local_msg=local_msg,
         )
 
-    return checkpoint
+
+def get_model_args(args: Namespace, vocab_size: int) -> Dict:
+    """
+    Get the keyword arguments of the transformer from the command line
+    arguments (apart from the attention backend, which does not affect the
+    weights).
+
+    Args:
+        args: Command line arguments.
+        vocab_size: Vocabulary size of the tokenizer.
+
+    Returns:
+        Keyword arguments of `Transformer`.
+    """
+    return {
+        "num__decoder_layers": args.num__decoder_layers,
+        "embedding_dim": args.embedding_dim,
+        "num_heads": args.num_heads,
+        "vocab_size": vocab_size,
+        "dim_feedfwd": args.dim_feedfwd,
+        "dropout_rate": args.dropout_rate,
+        "num__extra_heads": args.num__extra_heads,
+    }
+
+
+def strip_state_dict_prefixes(
+    state_dict: Dict[str, Tensor]
+) -> Dict[str, Tensor]:
+    """
+    Strip the key prefixes that `torch.compile()` (`_orig_mod.`) and DDP
+    (`module.`) add to the state dict of the wrapped model.
+
+    Args:
+        state_dict: State dict of a possibly wrapped model.
+
+    Returns:
+        State dict of the unwrapped model.
+    """
+    stripped = {}
+    for key, value in state_dict.items():
+        for prefix in ["_orig_mod.", "module."]:
+            key = key.removeprefix(prefix)
+        stripped[key] = value
+
+    return stripped
+
+
+def load_model(
+    filename: str,
+    model_args: Optional[Dict] = None,
+    device: torch.device | int = "cpu",
+    dtype: Optional[torch.dtype] = None,
+    attn_backend: str = "auto",
+) -> Transformer:
+    """
+    Load a transformer for inference. The model is constructed on the `meta`
+    device (skipping the random initialization) and the memory-mapped tensors
+    of the checkpoint are assigned directly, such that no weights are copied
+    on the CPU.
+
+    Args:
+        filename: Exported checkpoint (cf. `export.py`) or training
+            checkpoint.
+        model_args: Keyword arguments of `Transformer`, only needed for
+            training checkpoints (exported ones contain them).
+        device: Device on which the model is placed.
+        dtype: If provided, the weights are cast to this data type.
+        attn_backend: Implementation of the scaled dot-product attention.
+
+    Returns:
+        Transformer in evaluation mode.
+    """
+    checkpoint = torch.load(filename, map_location="cpu", mmap=True)
+    model_args = checkpoint.get("model_args", model_args)
+    assert model_args is not None, (
+        f"Checkpoint '{filename}' does not contain the model arguments, so "
+        "they have to be provided."
+    )
+
+    with torch.device("meta"):
+        model = Transformer(**model_args, attn_backend=attn_backend)
+    model.load_state_dict(
+        strip_state_dict_prefixes(checkpoint["state_dict"]), assign=True
+    )
+    # restore the weight sharing and the (non-persistent) buffer
+    model.embedding.weight = model.pre_softmax_linear.weight
+    model.pos_encod.reset_buffer(dtype=model.embedding.weight.dtype)
+
+    if dtype is not None:
+        model.to(dtype)
+
+    return model.to(device).eval()
+
+
+def get_rng_state() -> Dict:
+    """
+    Get the states of all random number generators (Python, NumPy, PyTorch
+    and CUDA).
+
+    Returns:
+        States of the random number generators.
+    """
+    rng_state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.get_rng_state_all()
+
+    return rng_state
+
+
+def set_rng_state(rng_state: Dict) -> None:
+    """
+    Restore the states of all random number generators.
+
+    Args:
+        rng_state: States of the random number generators, cf.
+            `get_rng_state`.
+    """
+    random.setstate(rng_state["python"])
+    np.random.set_state(rng_state["numpy"])
+    torch.set_rng_state(rng_state["torch"])
+    if "cuda" in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    """
+    Get the underlying model of a compiled and/or DDP-wrapped model.
+
+    Args:
+        model: Possibly wrapped model.
+
+    Returns:
+        Unwrapped model.
+    """
+    # `torch.compile()` stores the original module in `_orig_mod`
+    model = getattr(model, "_orig_mod", model)
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+
+    return model
+
+
+@torch.inference_mode()
+def evaluate(
+    model: nn.Module,
+    loader: BatchPrefetcher,
+    eval_iters: int,
+    use_amp: bool,
+    loss_chunk_size: Optional[int] = None,
+) -> float:
+    """
+    Estimate the loss of the model by averaging over several batches.
+
+    Args:
+        model: Model to evaluate.
+        loader: Batch producer of the validation data.
+        eval_iters: Number of batches.
+        use_amp: Whether to use automatic mixed precision.
+        loss_chunk_size: If provided, the loss is computed in chunks of
+            `loss_chunk_size` positions.
+
+    Returns:
+        Mean loss as a tensor on the device (read it back with `.item()`
+        only when needed, since this synchronizes with the device).
+    """
+    model.eval()
+
+    loss_sum = 0
+    for _ in range(eval_iters):
+        X, Y = next(loader)
+        with autocast(
+            device_type=X.device.type,
+            dtype=torch.float16,
+            enabled=use_amp,
+        ):
+            loss = model(
+                X,
+                is_causal=True,
+                targets=Y,
+                loss_chunk_size=loss_chunk_size,
+            )
+        loss_sum = loss_sum + loss.float()
+
+    model.train()
+
+    return loss_sum / eval_iters
+
+
+@contextmanager
+def sync_debug_mode(debug_mode: str) -> Iterator[None]:
+    """
+    Set the CUDA sync debug mode within the context, cf.
+    `torch.cuda.set_sync_debug_mode`. Without CUDA, this is a no-op.
+
+    Args:
+        debug_mode: `"default"` (no reports), `"warn"` or `"error"`.
+    """
+    if not torch.cuda.is_available():
+        yield
+        return
+
+    prev_debug_mode = torch.cuda.get_sync_debug_mode()
+    torch.cuda.set_sync_debug_mode(debug_mode)
+    try:
+        yield
+    finally:
+        torch.cuda.set_sync_debug_mode(prev_debug_mode)
 
 
 def start_timer(device: torch.device | int) -> float:
@@ -518,6 +1191,8 @@ def log_parameter_table(model: nn.Module) -> None:
     Args:
         model: Model for which we want the total number of parameters.
     """
+    from prettytable import PrettyTable
+
     table = PrettyTable(["Modules", "Parameters"])
     total_params = 0
     for name, parameter in model.named_parameters():
@@ -537,11 +1212,34 @@ def generate_text(
     use_amp: bool,
     vocab: Optional[List[str]],
     rank: str | int | torch.device,
-    temperature: float = 1.0,
-    top_k: Optional[int] = None,
-) -> None:
+    temperature: float | Tensor = 1.0,
+    top_k: Optional[int | Tensor] = None,
+    top_p: Optional[float | Tensor] = None,
+    min_p: Optional[float | Tensor] = None,
+    repetition_penalty: Optional[float | Tensor] = None,
+    frequency_penalty: Optional[float | Tensor] = None,
+    presence_penalty: Optional[float | Tensor] = None,
+    gumbel_sampling: bool = False,
+    prompts: Optional[List[str]] = None,
+    stop_strings: Optional[List[str]] = None,
+    max_lengths: Optional[List[int]] = None,
+    static_shapes: bool = False,
+    rolling_kv_cache: bool = False,
+    num_sink_tokens: int = 4,
+    draft_model: Optional[nn.Module] = None,
+    num_draft_tokens: int = 4,
+    prompt_lookup: bool = False,
+    max_ngram_size: int = 3,
+    use_extra_heads: bool = False,
+    num_beams: int = 1,
+    length_penalty: float = 1.0,
+    early_stopping: bool = False,
+) -> List[str]:
     """
-    Generate text from the model.
+    Generate text from the model. Several prompts are left-padded to the same
+    length and generated from in a single batch. With speculative decoding
+    (with a draft model, prompt lookup or the extra heads), the prompts are
+    generated from one after the other.
 
     Args:
         model: Transformer.
@@ -552,38 +1250,205 @@ def generate_text(
         rank: Device on which the code is executed.
         temperature: Temperature for sampling. For `temperature > 1`,
             predictions will be more diverse, for `temperature < 1`,
-            predictions will be more conservative.
-        top_k: Top-k sampling.
+            predictions will be more conservative. Either a float or one
+            temperature per prompt.
+        top_k: Top-k sampling. Either an int or one `k` per prompt.
+        top_p: Top-p (nucleus) sampling, either a float or one per prompt.
+        min_p: Min-p sampling, either a float or one per prompt.
+        repetition_penalty: Repetition penalty, either a float or one per
+            prompt.
+        frequency_penalty: Frequency penalty, either a float or one per
+            prompt.
+        presence_penalty: Presence penalty, either a float or one per prompt.
+        gumbel_sampling: Whether to sample via the Gumbel-max trick.
+        prompts: Prompts to continue. Default is a single newline.
+        stop_strings: Strings after which generation stops for a prompt
+            (matched on the token level, i.e. as encoded on their own). With
+            GPT2 encoding, generation also stops at the end-of-text token.
+        max_lengths: Maximum number of new tokens per prompt.
+        static_shapes: Whether to decode with static shapes (preallocated
+            caches and bucketed prompts), cf. `Transformer.generate`.
+        rolling_kv_cache: Whether to continue beyond `block_size` with
+            rolling key/value caches of constant size instead of re-encoding
+            the truncated window in every step, cf. `Transformer.generate`.
+        num_sink_tokens: Number of pinned (attention sink) tokens of the
+            rolling caches.
+        draft_model: Small transformer with the same vocabulary. If
+            provided, text is generated with speculative decoding (cf.
+            `speculative_generate`), and the acceptance rate and the number
+            of tokens per forward pass of `model` are logged.
+        num_draft_tokens: Maximum number of tokens proposed per draft.
+        prompt_lookup: Whether to generate with speculative decoding, where
+            tokens are proposed by looking up the last `max_ngram_size`
+            tokens in the prompt and the generated tokens (instead of by a
+            draft model).
+        max_ngram_size: Maximum number of last tokens matched in prompt
+            lookup.
+        use_extra_heads: Whether to generate with speculative decoding,
+            where tokens are drafted by the extra prediction heads of
+            `model`.
+        num_beams: If larger than `1`, text is generated deterministically
+            with beam search (cf. `beam_search`) and the sampling arguments
+            are ignored.
+        length_penalty: Exponent of the length normalization of the beam
+            scores.
+        early_stopping: Whether beam search stops for a prompt as soon as
+            it has `num_beams` finished hypotheses.
+
+    Returns:
+        Generated texts (including the prompts).
     """
     model.eval()
 
     if vocab is not None:
-        start_ids = encode("\n", vocab=vocab)
+        encode_fn = partial(encode, vocab=vocab)
+        decode_fn = partial(decode, vocab=vocab)
+        stop_tokens = None
     else:
         # assume GPT-2 encoding
+        import tiktoken
+
         tokenizer = tiktoken.get_encoding("gpt2")
-        start_ids = tokenizer.encode(
-            text="\n", allowed_special={"<|endoftext|>"}
+        encode_fn = partial(
+            tokenizer.encode, allowed_special={"<|endoftext|>"}
         )
-    x = torch.tensor(start_ids, dtype=torch.long, device=rank).unsqueeze(dim=0)
+        decode_fn = tokenizer.decode
+        # (stop conditions are not supported with static shapes)
+        stop_tokens = None if static_shapes else [tokenizer.eot_token]
+
+    # left-pad the prompts (with an arbitrary token, which is masked)
+    start_ids = [encode_fn(prompt) for prompt in (prompts or ["\n"])]
+    max_len = max(len(ids) for ids in start_ids)
+    x = torch.zeros(len(start_ids), max_len, dtype=torch.long)
+    padding_mask = torch.zeros_like(x)
+    for row, ids in enumerate(start_ids):
+        x[row, max_len - len(ids) :] = torch.tensor(ids, dtype=torch.long)
+        padding_mask[row, max_len - len(ids) :] = 1
+    x, padding_mask = x.to(rank), padding_mask.to(rank)
+    # masking is only needed if the prompts have different lengths
+    if all(len(ids) == max_len for ids in start_ids):
+        padding_mask = None
+
+    sampler = get_token_sampler(
+        vocab_size=unwrap_model(model).embedding.num_embeddings,
+        device=x.device,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        min_p=min_p,
+        repetition_penalty=repetition_penalty,
+        frequency_penalty=frequency_penalty,
+        presence_penalty=presence_penalty,
+        gumbel=gumbel_sampling,
+    )
+
+    stop_sequences = (
+        [encode_fn(stop_string) for stop_string in stop_strings]
+        if stop_strings is not None
+        else None
+    )
+
+    if draft_model is not None or prompt_lookup or use_extra_heads:
+        generated_texts = []
+        for row, ids in enumerate(start_ids):
+            # the sampling parameters of this row (if given per row)
+            row_sampler = deepcopy(sampler)
+            row_sampler.reorder(torch.tensor([row], device=x.device))
+            start_time = start_timer(device=rank)
+            with autocast(
+                device_type=x.device.type,
+                dtype=torch.float16,
+                enabled=use_amp,
+            ):
+                gen_tok, stats = speculative_generate(
+                    model=unwrap_model(model),
+                    x=torch.tensor([ids], dtype=torch.long, device=x.device),
+                    max_new_tokens=(
+                        max_lengths[row]
+                        if max_lengths is not None
+                        else max_new_tokens
+                    ),
+                    block_size=block_size,
+                    draft_model=(
+                        unwrap_model(draft_model)
+                        if draft_model is not None
+                        else None
+                    ),
+                    sampler=row_sampler,
+                    num_draft_tokens=num_draft_tokens,
+                    max_ngram_size=max_ngram_size,
+                    use_extra_heads=use_extra_heads,
+                    stop_tokens=stop_tokens,
+                    stop_sequences=stop_sequences,
+                    rolling_kv_cache=rolling_kv_cache,
+                    num_sink_tokens=num_sink_tokens,
+                )
+            time_diff = end_timer_and_log(
+                start_time=start_time,
+                device=rank,
+                local_msg="Speculative decoding",
+            )
+            logging.info(
+                f"\tAcceptance rate = {stats['acceptance_rate']:.3f}, "
+                f"tokens per forward pass = "
+                f"{stats['tokens_per_target_forward']:.2f}, throughput = "
+                f"{stats['num_new_tokens'] / time_diff:.1f} [tokens/s]"
+            )
+            generated_texts.append(decode_fn(gen_tok[0].tolist()))
+            logging.info(f"Generated text:\n\n{generated_texts[-1]}")
+
+        return generated_texts
 
     with autocast(
         device_type=x.device.type,
         dtype=torch.float16,
         enabled=use_amp,
     ):
-        gen_tok = model.generate(
-            x,
-            max_new_tokens=max_new_tokens,
-            block_size=block_size,
-            temperature=temperature,
-            top_k=top_k,
-        )
+        if num_beams > 1:
+            gen_tok = beam_search(
+                model=unwrap_model(model),
+                x=x,
+                max_new_tokens=max_new_tokens,
+                block_size=block_size,
+                num_beams=num_beams,
+                length_penalty=length_penalty,
+                early_stopping=early_stopping,
+                padding_mask=padding_mask,
+                stop_tokens=stop_tokens,
+                stop_sequences=stop_sequences,
+                max_lengths=(
+                    torch.tensor(max_lengths)
+                    if max_lengths is not None
+                    else None
+                ),
+            )
+        else:
+            gen_tok = model.generate(
+                x,
+                max_new_tokens=max_new_tokens,
+                block_size=block_size,
+                sampler=sampler,
+                padding_mask=padding_mask,
+                stop_tokens=stop_tokens,
+                stop_sequences=stop_sequences,
+                max_lengths=(
+                    torch.tensor(max_lengths)
+                    if max_lengths is not None
+                    else None
+                ),
+                static_shapes=static_shapes,
+                rolling_kv_cache=rolling_kv_cache,
+                num_sink_tokens=num_sink_tokens,
+            )
 
-    if vocab is not None:
-        generated_text = decode(gen_tok.squeeze(dim=0).tolist(), vocab=vocab)
-    else:
-        generated_text = tokenizer.decode(
-            tokens=gen_tok.squeeze(dim=0).tolis()
+    # remove left padding and right padding (`-1`) of finished rows
+    generated_texts = [
+        decode_fn(
+            [token for token in tokens[max_len - len(ids) :] if token >= 0]
         )
-    logging.info(f"Generated text:\n\n{generated_text}")
+        for tokens, ids in zip(gen_tok.tolist(), start_ids)
+    ]
+    for generated_text in generated_texts:
+        logging.info(f"Generated text:\n\n{generated_text}")
+
+    return generated_texts